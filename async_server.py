@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+from worker_pool import busy_response
+
+# Longest request line and headers a client may send
+MAX_HEAD = 64 * 1024
+# Response bytes a handler buffers before handing them to the loop
+FLUSH_BYTES = 64 * 1024
+# Request body bytes a handler takes from the loop at once
+RECEIVE_BYTES = 64 * 1024
+
+
+def body_length(head):
+    """ Returns the Content-Length of a request head, 0 without one, or None for a body the loop can't frame (chunked or invalid). """
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"transfer-encoding":
+            return None
+        if name == b"content-length":
+            try:
+                length = int(value)
+            except ValueError:
+                return None
+            return length if length >= 0 else None
+    return 0
+
+
+class Connection:
+    """ One client connection. Read by the loop, and written by the handler thread through write() and flush(), like a wfile. """
+
+    def __init__(self, loop, reader, writer):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")
+        self.buffer = bytearray()
+        # Requests answered so far, for MAX_REQUESTS_PER_CONNECTION
+        self.served = 0
+        # True while a handler runs, idle connections are closed straight away on shutdown
+        self.busy = False
+        # Set once a handler took the socket
+        self.detached = False
+
+    def write(self, data):
+        """ Buffers data. Past FLUSH_BYTES it is handed to the loop, waiting until the client has taken enough of it. Raises if it went away. """
+        self.buffer += data
+        if len(self.buffer) >= FLUSH_BYTES:
+            asyncio.run_coroutine_threadsafe(self.send(), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        # The rest of the response is sent by the loop once the handler returns, which saves a round trip to it per response
+        pass
+
+    async def send(self):
+        """ Writes the buffered bytes. Runs on the loop. """
+        if self.buffer:
+            self.writer.write(bytes(self.buffer))
+            self.buffer.clear()
+        await self.writer.drain()
+
+    async def receive(self, size, timeout, send_continue=False):
+        """ Reads up to size bytes of a request body, b"" if the client closed. Runs on the loop. """
+        if send_continue:
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await self.writer.drain()
+        return await asyncio.wait_for(self.reader.read(size), timeout)
+
+    def detach(self):
+        """ Returns a socket of its own for the connection and makes the loop let go of it. """
+        return asyncio.run_coroutine_threadsafe(self.take_socket(), self.loop).result()
+
+    async def take_socket(self):
+        transport = self.writer.transport
+        transport.pause_reading()
+        # Everything written so far must be out before anyone else writes to the socket
+        transport.set_write_buffer_limits(0)
+        await self.send()
+        sock = transport.get_extra_info("socket")
+        self.detached = True
+        # The loop closes its own descriptor once the handler returns, this one stays open
+        return socket.socket(fileno=os.dup(sock.fileno()))
+
+
+class RequestStream(io.RawIOBase):
+    """ A request as its handler reads it: the head the loop already read, then the body, taken from the connection only as
+    the handler reads it and never past its Content-Length. Wrapped in a BufferedReader, like a socket's rfile. """
+
+    def __init__(self, connection, head, length, timeout):
+        self.connection = connection
+        self.head = memoryview(head)
+        # Body bytes not taken from the connection yet
+        self.remaining = length
+        self.timeout = timeout
+        # Set when the client waits for 100 Continue before it sends the body
+        self.continue_needed = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            size = min(len(buffer), len(self.head))
+            buffer[:size] = self.head[:size]
+            self.head = self.head[size:]
+            return size
+        if self.remaining <= 0:
+            return 0
+        receive = self.connection.receive(min(len(buffer), self.remaining), self.timeout, self.continue_needed)
+        data = asyncio.run_coroutine_threadsafe(receive, self.connection.loop).result()
+        self.continue_needed = False
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+class AsyncHandlerMixIn:
+    """ For BaseHTTPRequestHandler subclasses: handles one request, whose head the loop has read, on a worker thread.
+    The body is read through a RequestStream and the response goes out through the Connection. """
+
+    def __init__(self, connection, stream, server):
+        # Not BaseRequestHandler.__init__, which would serve a socket
+        self.bridge = connection
+        self.server = server
+        self.client_address = connection.client_address
+        self.stream = stream
+        self.rfile = io.BufferedReader(stream, RECEIVE_BYTES)
+        self.wfile = connection
+        self.requests_served = connection.served
+        self.close_connection = True
+
+    @property
+    def connection(self):
+        """ The client's socket, for handlers that hand it over. Only taken when asked for. """
+        return self.bridge.detach()
+
+    def handle_expect_100(self):
+        # Sent once the handler reads the body, so a body the handler refuses is never asked for
+        self.stream.continue_needed = True
+        return True
+
+    def run(self):
+        """ Handles the request. Returns whether the connection stays open. """
+        try:
+            self.handle_one_request()
+        except Exception:
+            print("-" * 40, file=sys.stderr)
+            print("Exception occurred during processing of request from", self.client_address, file=sys.stderr)
+            traceback.print_exc()
+            print("-" * 40, file=sys.stderr)
+            return False
+        finally:
+            self.bridge.served = self.requests_served
+        return not self.close_connection
+
+
+class AsyncHTTPServer:
+    """ Serves HTTP/1.1 from an asyncio event loop, use in place of ThreadedHTTPServer with the same handler class.
+    The loop reads and writes every connection, so an idle keep-alive connection holds no thread. Each request, once its head is read,
+    runs on one of `workers` threads, which reads the body as it goes, where its blocking database and password hashing calls happen. At most queue_size requests
+    wait for a thread, past that they get a 503 with Retry-After from the loop. Works with PreforkMaster like the threaded servers. """
+
+    def __init__(self, server_address, handler_class, workers=32, queue_size=128, retry_after=1, idle_timeout=None, backlog=128):
+        self.server_address = server_address
+        self.handler_class = type("Async" + handler_class.__name__, (AsyncHandlerMixIn, handler_class), {})
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        # Idle connections are cheap here, so they are kept as long as with a thread per connection
+        self.idle_timeout = idle_timeout or handler_class.timeout
+        self.socket = socket.create_server(server_address, backlog=backlog)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.executor = None
+        self.stop_requested = None
+        self.stopped = threading.Event()
+        self.connections = set()
+        self.tasks = set()
+        self.stopping = False
+        # Requests handed to the executor and not finished, and of those the ones running
+        self.pending = 0
+        self.busy = 0
+        self.served = 0
+        self.rejected = 0
+
+    def serve_forever(self):
+        """ Serves until shutdown() is called. Started after a fork, so every worker process gets its own loop and threads. """
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="http-worker")
+        self.stopped.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        """ Stops accepting, closes idle connections, lets the running requests finish and waits for serve_forever to return.
+        Call it from another thread. """
+        loop = self.loop
+        if loop == None:
+            return
+        loop.call_soon_threadsafe(self.stop_requested.set)
+        self.stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        if self.executor != None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_requested = asyncio.Event()
+        self.stopping = False
+        server = await asyncio.start_server(self.serve_connection, sock=self.socket, limit=MAX_HEAD)
+        try:
+            await self.stop_requested.wait()
+        finally:
+            server.close()
+            self.stopping = True
+            for connection in list(self.connections):
+                if not connection.busy:
+                    connection.writer.close()
+            if self.tasks:
+                await asyncio.wait(list(self.tasks))
+            self.loop = None
+
+    async def serve_connection(self, reader, writer):
+        """ Reads requests off one connection and answers them in order, until either side closes it. """
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        connection = Connection(self.loop, reader, writer)
+        self.connections.add(connection)
+        try:
+            while not self.stopping:
+                stream, keep_open = await self.read_request(connection)
+                if stream == None:
+                    break
+                if self.pending >= self.workers + self.queue_size:
+                    with self.lock:
+                        self.rejected += 1
+                    REGISTRY.inc("http_connections_rejected_total", (("reason", "queue_full"),))
+                    writer.write(busy_response(self.retry_after))
+                    await writer.drain()
+                    break
+                connection.busy = True
+                self.pending += 1
+                try:
+                    handler = self.handler_class(connection, stream, self)
+                    stays_open = await self.loop.run_in_executor(self.executor, self.run_handler, handler, time.monotonic())
+                finally:
+                    self.pending -= 1
+                    connection.busy = False
+                await connection.send()
+                # A body the handler left unread would be taken for the next request
+                if connection.detached or not (stays_open and keep_open and stream.remaining == 0):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.connections.discard(connection)
+            self.tasks.discard(task)
+            if connection.detached:
+                # The socket lives on in the handler's duplicate, so this doesn't reach the client
+                writer.transport.abort()
+            else:
+                writer.close()
+
+    async def read_request(self, connection):
+        """ Reads the head of the next request. Returns a RequestStream of the request and whether the connection can serve another
+        after it, or (None, False) when the client closed it or kept it idle for too long. The body is left for the handler. """
+        reader = connection.reader
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return None, False
+        length = body_length(head)
+        if length == None:
+            # The handler answers it from the head alone, and the unread body ends the connection
+            return RequestStream(connection, head, 0, self.idle_timeout), False
+        return RequestStream(connection, head, length, self.idle_timeout), True
+
+    def run_handler(self, handler, queued_at):
+        REGISTRY.observe("http_queue_wait_seconds", (), time.monotonic() - queued_at)
+        with self.lock:
+            self.busy += 1
+        try:
+            return handler.run()
+        finally:
+            with self.lock:
+                self.busy -= 1
+                self.served += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': max(0, self.pending - self.busy),
+                'queue_size': self.queue_size,
+                'connections': len(self.connections),
+                'served': self.served,
+                'rejected': self.rejected,
+            }
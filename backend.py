@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import math
+import os
+
+# Results of writes that check ownership
+OK = "ok"
+NOT_FOUND = "not_found"
+FORBIDDEN = "forbidden"
+
+
+class IntegrityError(Exception):
+    """ A write broke a constraint the SQL backends leave to the database, such as a foreign key to a missing row.
+    Raised by the backends that have no database to check them. """
+    pass
+
+
+class GardensBackend:
+    """ Interface of the storage behind the gardens web app. Rows are returned as dicts with the same keys as the postgres tables.
+    Writes to flowers, comments and gardens publish a garden event once they are done. """
+
+    @classmethod
+    def close_shared(cls):
+        """ Releases state shared by every instance in this process (connection pools, file handles). Called before forking. """
+        pass
+
+    @classmethod
+    def shared_stats(cls):
+        """ Returns connection pool stats, or None if the backend has no pool. """
+        return None
+
+    @classmethod
+    def listen(cls, hub):
+        """ Starts forwarding garden events published by other processes to hub (see events.py).
+        Backends that call events.publish in-process have nothing to forward. """
+        pass
+
+    def create_tables(self):
+        """ Create the tables for initial use. Will NOT drop old tables. """
+        raise NotImplementedError
+
+    def reset(self):
+        """ Drop and recreate the tables. Deletes ALL data. """
+        raise NotImplementedError
+
+    def batch(self, transaction=False):
+        """ Returns a context manager under which calls on this handle, from the thread that entered it, share one connection.
+        With transaction they commit together when the block ends, or none of them do if it raises. Yields the handle. """
+        raise NotImplementedError
+
+    # USERS
+    def create_user(self, first_name, last_name, email, password):
+        """ Creates a user with an already hashed password. Returns {'id': ...}. """
+        raise NotImplementedError
+
+    def get_user(self, email):
+        raise NotImplementedError
+
+    def get_user_by_id(self, uid):
+        raise NotImplementedError
+
+    def update_user_password(self, uid, password):
+        raise NotImplementedError
+
+    # GARDENS
+    def create_garden(self, name, author, userid):
+        """ Returns {'id': ...} of the created garden. """
+        raise NotImplementedError
+
+    def get_gardens(self):
+        raise NotImplementedError
+
+    def get_gardens_page(self, limit, after=None):
+        """ Returns up to limit gardens with id > after, in id order, and the cursor for the next page (None on the last page). """
+        raise NotImplementedError
+
+    def iter_gardens(self, batch_size=500):
+        """ Yields lists of at most batch_size gardens in id order. """
+        raise NotImplementedError
+
+    def get_user_gardens(self, userid):
+        raise NotImplementedError
+
+    def get_one_garden(self, id):
+        """ Returns the garden with its 'comments' and 'flowers', or None. """
+        raise NotImplementedError
+
+    def get_one_garden_json(self, id, materialized=False):
+        """ Returns get_one_garden serialized as JSON text, or None. """
+        raise NotImplementedError
+
+    def get_garden_changes(self, id, since):
+        """ Returns the garden with the flowers and comments written at or after version since, and under 'deleted' the ids of those
+        removed, as JSON text, or None. 'version' is the since of the next call. With since 0 every row is sent and 'full' is true. """
+        raise NotImplementedError
+
+    def get_garden_owner(self, id):
+        """ Returns the author_id of a garden, or None if it doesn't exist. """
+        raise NotImplementedError
+
+    def update_garden(self, id, name, owner):
+        """ Returns OK, NOT_FOUND or FORBIDDEN. """
+        raise NotImplementedError
+
+    def delete_garden(self, id, owner):
+        """ Returns OK, NOT_FOUND or FORBIDDEN. Deletes the garden's flowers and comments too. """
+        raise NotImplementedError
+
+    # COMMENTS
+    def create_comment(self, garden_id, comment, user_id):
+        raise NotImplementedError
+
+    def get_comments(self, garden_id):
+        """ Returns the garden's comments as {id, content, author (first name), author_id}. """
+        raise NotImplementedError
+
+    def get_one_comment(self, id):
+        raise NotImplementedError
+
+    def update_comment(self, id, content, owner):
+        """ Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        raise NotImplementedError
+
+    def delete_comment(self, id, owner):
+        """ Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        raise NotImplementedError
+
+    # FLOWERS
+    def create_flower(self, garden_id, color, x, y):
+        raise NotImplementedError
+
+    def create_flowers(self, garden_id, flowers):
+        """ Inserts (color, x, y) flowers all at once. Returns the created ids in order. """
+        raise NotImplementedError
+
+    def get_flowers(self, garden_id):
+        raise NotImplementedError
+
+    def get_flowers_in_box(self, garden_id, x0, y0, x1, y1, limit=None):
+        """ Returns the garden's flowers with x0 <= x <= x1 and y0 <= y <= y1 in id order, and whether they were sampled.
+        When more than limit flowers are in the box, the box is split into a grid of at most limit cells and only the
+        lowest id flower of each cell is returned. """
+        raise NotImplementedError
+
+    def get_one_flower(self, id):
+        raise NotImplementedError
+
+    def delete_flower(self, id, owner):
+        """ Returns (OK, NOT_FOUND or FORBIDDEN, the flower's garden id). """
+        raise NotImplementedError
+
+    # EXPORT
+    def export_garden(self, id, write):
+        """ Calls write with the bytes of the garden's export (see garden_export.py) as its rows are read, never holding them all.
+        Writes nothing if the garden doesn't exist. """
+        raise NotImplementedError
+
+    def import_garden(self, garden, userid):
+        """ Creates a garden owned by userid from a garden_export.GardenImport, in one transaction, reading its rows as they are inserted.
+        Flowers and comments get new ids and the comments are written by userid. If the export turns out broken part way
+        BadImport is raised and nothing is kept. Returns {'id': ..., 'flowers': count, 'comments': count}. """
+        raise NotImplementedError
+
+
+def flower_point(x, y):
+    """ Returns a flower's x and y as floats. Raises ValueError for NaN or infinity, which have no place on the canvas or in a spatial index. """
+    x, y = float(x), float(y)
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise ValueError(f"Flower coordinates must be finite numbers, not {x}, {y}")
+    return x, y
+
+
+def grid_size(limit):
+    """ Cells per side of the grid a viewport of more than limit flowers is sampled with. """
+    return max(1, math.isqrt(limit))
+
+
+def backend_class():
+    """ Returns the backend class picked by GARDENS_BACKEND (postgres, memory or sqlite). Imported lazily so unused drivers aren't needed. """
+    name = os.environ.get("GARDENS_BACKEND", "postgres")
+    if name == "memory":
+        from memory_db import MemoryGardensDB
+        return MemoryGardensDB
+    if name == "sqlite":
+        from sqlite_db import SQLiteGardensDB
+        return SQLiteGardensDB
+    from garden_db import GardensDB
+    return GardensDB
+
+
+def open_db():
+    """ Returns a handle on the configured backend. Cheap, call it per request. """
+    return backend_class()()
+
+
+def close_db():
+    backend_class().close_shared()
+
+
+def db_stats():
+    return backend_class().shared_stats()
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+""" Load tests the REST API. Starts server.py, seeds it through the API, then runs traffic mixes over a range of concurrencies.
+
+Usage:
+    bench.py [options]                      run and print a table, save results with --out
+    bench.py --baseline FILE [options]      also compare against a saved run, exit 1 on regressions
+    bench.py --compare NEW BASELINE         only compare two saved runs
+
+Mixes:
+    browse  listing pages, streaming the collection, garden documents (fresh and revalidated), /me, preflights, /metrics
+    paint   single and bulk flower inserts, flower deletes, garden and comment writes
+    login   login storms, logouts and sign ups
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+# Statuses that count as a successful request
+EXPECTED = {200, 201, 204, 304}
+# Colors picked for seeded and painted flowers
+COLORS = ["red", "orange", "yellow", "pink", "purple", "blue", "white"]
+# Flowers sent per bulk insert
+BULK_SIZE = 20
+# Flowers and comments a worker's scratch garden may hold before it is replaced by an empty one.
+# The paint mix adds more than it deletes, and without a cap its garden reads would slow down with --duration and server speed.
+SCRATCH_MAX_ROWS = 500
+# Seconds to wait for the server to start answering
+START_TIMEOUT = 30
+# Keeps sign up emails unique between runs against the same database
+SIGNUP_PREFIX = f"signup-{int(time.time())}-{os.getpid()}"
+
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies, errors, duration):
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'rps': round(len(ordered) / duration, 2),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+    }
+
+
+class Recorder:
+    """ Latencies and errors per endpoint label, written by one worker thread. """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, label, elapsed, ok):
+        self.latencies.setdefault(label, []).append(elapsed)
+        if not ok:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def merge(self, other):
+        for label, values in other.latencies.items():
+            self.latencies.setdefault(label, []).extend(values)
+        for label, count in other.errors.items():
+            self.errors[label] = self.errors.get(label, 0) + count
+
+
+class Client:
+    """ One keep-alive connection with its own session cookie. """
+
+    def __init__(self, port, recorder=None):
+        self.port = port
+        self.recorder = recorder
+        self.con = None
+        self.cookie = None
+
+    def request(self, label, method, path, body=None, headers=None, expected=EXPECTED):
+        """ Sends one request, reconnecting once if the server closed the connection. Returns (status, headers, body), status is 0 on failure. """
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if isinstance(body, dict):
+            body = urlencode(body)
+            headers['Content-Type'] = "application/x-www-form-urlencoded"
+        start = time.perf_counter()
+        status, response_headers, data = 0, None, b""
+        for attempt in range(2):
+            try:
+                if self.con == None:
+                    self.con = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+                self.con.request(method, path, body=body, headers=headers)
+                response = self.con.getresponse()
+                data = response.read()
+                status, response_headers = response.status, response
+                if response.will_close:
+                    self.close()
+                break
+            except (OSError, http.client.HTTPException):
+                self.close()
+        elapsed = time.perf_counter() - start
+        if response_headers != None:
+            for value in response_headers.headers.get_all("Set-Cookie") or []:
+                morsel = SimpleCookie(value).get("sessionId")
+                if morsel != None:
+                    self.cookie = "sessionId=" + morsel.coded_value
+        if self.recorder != None and label != None:
+            self.recorder.record(label, elapsed, status in expected)
+        return status, response_headers, data
+
+    def login(self, email, password, label=None):
+        self.cookie = None
+        status, _, _ = self.request(label, "POST", "/sessions", {'email': email, 'password': password})
+        return status == 201
+
+    def close(self):
+        if self.con != None:
+            self.con.close()
+            self.con = None
+
+
+def user_email(i):
+    return f"bench-{i}@bench.test"
+
+
+def user_password(i):
+    return f"bench-password-{i}"
+
+
+def seed(port, users, gardens, flowers, comments, rng):
+    """ Creates the dataset through the API. The same arguments and seed always produce the same rows. Returns the garden ids. """
+    client = Client(port)
+    for i in range(users):
+        status, _, _ = client.request(None, "POST", "/users", {'first_name': f"Bench{i}", 'last_name': "User", 'email': user_email(i), 'password': user_password(i)})
+        if status not in (201, 422):
+            raise RuntimeError(f"creating user {i} failed with {status}")
+
+    # Gardens are spread round robin over the users, each logged in once
+    owners = [i % users for i in range(gardens)]
+    garden_ids = []
+    for i in range(users):
+        if i not in owners:
+            continue
+        if not client.login(user_email(i), user_password(i)):
+            raise RuntimeError(f"logging in user {i} failed")
+        for g in range(i, gardens, users):
+            _, _, data = client.request(None, "POST", "/gardens", {'name': f"Garden {g}", 'author': f"Bench{i}"})
+            garden_id = json.loads(data)['id']
+            garden_ids.append(garden_id)
+            batch = [{'color': rng.choice(COLORS), 'x': round(rng.uniform(0, 1000), 2), 'y': round(rng.uniform(0, 1000), 2)} for _ in range(flowers)]
+            if batch:
+                client.request(None, "POST", f"/gardens/{garden_id}/flowers", json.dumps(batch), {'Content-Type': "application/json"})
+
+    # Comments come from random users, so log in once per commenter
+    plan = {}
+    for garden_id in garden_ids:
+        for _ in range(comments):
+            plan.setdefault(rng.randrange(users), []).append(garden_id)
+    for i, targets in sorted(plan.items()):
+        client.login(user_email(i), user_password(i))
+        for garden_id in targets:
+            client.request(None, "POST", "/comments", {'gardenId': garden_id, 'content': f"Comment by Bench{i}"})
+    client.close()
+    return sorted(garden_ids)
+
+
+class Worker(threading.Thread):
+    """ Sends one mix of requests on its own connection until the deadline. """
+
+    def __init__(self, port, mix, garden_ids, user, rng, deadline):
+        super().__init__(daemon=True)
+        self.mix = mix
+        self.recorder = Recorder()
+        self.client = Client(port, self.recorder)
+        self.ops = [getattr(self, "op_" + name) for name, _ in MIXES[mix]]
+        self.weights = [weight for _, weight in MIXES[mix]]
+        self.garden_ids = garden_ids
+        self.user = user
+        self.rng = rng
+        self.deadline = deadline
+        self.etags = {}
+        self.garden = None
+        self.flower_ids = []
+        self.comment_ids = []
+        # Flowers and comments in the scratch garden, as far as this worker knows
+        self.scratch_rows = 0
+        self.extra_gardens = []
+        self.signups = 0
+        self.error = None
+
+    def prepare(self):
+        """ Logs in and creates a scratch garden to paint in, so writes never touch the seeded gardens. Not recorded. """
+        if not self.client.login(user_email(self.user), user_password(self.user)):
+            raise RuntimeError(f"worker could not log in as user {self.user}")
+        self.new_scratch()
+
+    def new_scratch(self):
+        """ Deletes the scratch garden, if there is one, and creates an empty one. Not recorded. """
+        if self.garden != None:
+            self.client.request(None, "DELETE", f"/gardens/{self.garden}")
+        _, _, data = self.client.request(None, "POST", "/gardens", {'name': "Scratch", 'author': f"Bench{self.user}"})
+        self.garden = json.loads(data)['id']
+        self.flower_ids = []
+        self.comment_ids = []
+        self.scratch_rows = 0
+
+    def run(self):
+        try:
+            while time.monotonic() < self.deadline:
+                self.rng.choices(self.ops, self.weights)[0]()
+                if self.scratch_rows > SCRATCH_MAX_ROWS:
+                    self.new_scratch()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.client.close()
+
+    def random_garden(self):
+        return self.rng.choice(self.garden_ids)
+
+    def random_flower(self):
+        return {'color': self.rng.choice(COLORS), 'x': round(self.rng.uniform(0, 1000), 2), 'y': round(self.rng.uniform(0, 1000), 2)}
+
+    # BROWSE
+    def op_list_page(self):
+        after = self.rng.choice([0] + self.garden_ids)
+        self.client.request("GET /gardens?limit", "GET", f"/gardens?limit=50&after={after}")
+
+    def op_list_all(self):
+        self.client.request("GET /gardens", "GET", "/gardens", headers={'Accept-Encoding': "gzip"})
+
+    def op_garden(self):
+        id = self.random_garden()
+        _, headers, _ = self.client.request("GET /gardens/:id", "GET", f"/gardens/{id}", headers={'Accept-Encoding': "gzip"})
+        if headers != None and headers.getheader("ETag"):
+            self.etags[id] = headers.getheader("ETag")
+
+    def op_garden_revalidate(self):
+        if not self.etags:
+            return self.op_garden()
+        id = self.rng.choice(list(self.etags))
+        self.client.request("GET /gardens/:id (If-None-Match)", "GET", f"/gardens/{id}", headers={'Accept-Encoding': "gzip", 'If-None-Match': self.etags[id]})
+
+    def op_me(self):
+        self.client.request("GET /me", "GET", "/me")
+
+    def op_preflight(self):
+        self.client.request("OPTIONS /gardens", "OPTIONS", "/gardens", headers={'Origin': "http://bench.test"})
+
+    def op_metrics(self):
+        self.client.request("GET /metrics", "GET", "/metrics")
+
+    # PAINT
+    def op_add_flower(self):
+        status, _, _ = self.client.request("POST /flowers", "POST", "/flowers", {'gardenId': self.garden, **self.random_flower()})
+        if status == 201:
+            self.scratch_rows += 1
+
+    def op_add_flowers(self):
+        batch = [self.random_flower() for _ in range(BULK_SIZE)]
+        status, _, data = self.client.request("POST /gardens/:id/flowers", "POST", f"/gardens/{self.garden}/flowers", json.dumps(batch), {'Content-Type': "application/json"})
+        if status == 201:
+            self.flower_ids.extend(row['id'] for row in json.loads(data))
+            self.scratch_rows += BULK_SIZE
+
+    def op_delete_flower(self):
+        if not self.flower_ids:
+            return self.op_add_flowers()
+        status, _, _ = self.client.request("DELETE /flowers/:id", "DELETE", f"/flowers/{self.flower_ids.pop()}")
+        if status == 204:
+            self.scratch_rows -= 1
+
+    def op_own_garden(self):
+        """ Reads back the scratch garden, which also learns the ids of its flowers and comments. """
+        status, _, data = self.client.request("GET /gardens/:id (own)", "GET", f"/gardens/{self.garden}")
+        if status == 200:
+            garden = json.loads(data)
+            self.flower_ids = [flower['id'] for flower in garden['flowers']]
+            self.comment_ids = [comment['id'] for comment in garden['comments']]
+            self.scratch_rows = len(self.flower_ids) + len(self.comment_ids)
+
+    def op_rename_garden(self):
+        self.client.request("PUT /gardens/:id", "PUT", f"/gardens/{self.garden}", {'name': f"Scratch {self.rng.randrange(1000)}"})
+
+    def op_add_comment(self):
+        status, _, _ = self.client.request("POST /comments", "POST", "/comments", {'gardenId': self.garden, 'content': "Nice flowers"})
+        if status == 201:
+            self.scratch_rows += 1
+
+    def op_update_comment(self):
+        if not self.comment_ids:
+            return self.op_add_comment()
+        id = self.rng.choice(self.comment_ids)
+        self.client.request("PUT /comments/:id", "PUT", f"/comments/{id}", {'content': "Even nicer flowers"})
+
+    def op_delete_comment(self):
+        if not self.comment_ids:
+            return self.op_add_comment()
+        status, _, _ = self.client.request("DELETE /comments/:id", "DELETE", f"/comments/{self.comment_ids.pop()}")
+        if status == 204:
+            self.scratch_rows -= 1
+
+    def op_add_garden(self):
+        status, _, data = self.client.request("POST /gardens", "POST", "/gardens", {'name': "Extra", 'author': f"Bench{self.user}"})
+        if status == 201:
+            self.extra_gardens.append(json.loads(data)['id'])
+
+    def op_delete_garden(self):
+        if not self.extra_gardens:
+            return self.op_add_garden()
+        self.client.request("DELETE /gardens/:id", "DELETE", f"/gardens/{self.extra_gardens.pop()}")
+
+    # LOGIN
+    def op_login(self):
+        self.client.login(user_email(self.user), user_password(self.user), "POST /sessions")
+
+    def op_logout(self):
+        self.client.request("DELETE /sessions", "DELETE", "/sessions")
+        self.op_login()
+
+    def op_signup(self):
+        self.signups += 1
+        email = f"{SIGNUP_PREFIX}-{self.mix}-{self.name}-{self.signups}@bench.test"
+        self.client.request("POST /users", "POST", "/users", {'first_name': "New", 'last_name': "User", 'email': email, 'password': "bench-signup"})
+
+
+# mix -> (Worker.op_<name>, weight)
+MIXES = {
+    'browse': [('list_page', 30), ('list_all', 5), ('garden', 35), ('garden_revalidate', 10), ('me', 10), ('preflight', 8), ('metrics', 2)],
+    'paint': [('add_flower', 35), ('add_flowers', 15), ('delete_flower', 15), ('own_garden', 15), ('rename_garden', 5),
+        ('add_comment', 5), ('update_comment', 3), ('delete_comment', 3), ('add_garden', 2), ('delete_garden', 2)],
+    'login': [('login', 60), ('logout', 20), ('signup', 10), ('me', 10)],
+}
+
+
+def run_mix(port, mix, concurrency, garden_ids, users, seed_value, warmup, duration):
+    """ Runs one mix at one concurrency. The warmup is run with the same workers and thrown away. """
+    workers = []
+    for i in range(concurrency):
+        rng = random.Random(f"{seed_value}-{mix}-{concurrency}-{i}")
+        worker = Worker(port, mix, garden_ids, i % users, rng, 0)
+        worker.prepare()
+        workers.append(worker)
+
+    start = time.monotonic()
+    for worker in workers:
+        worker.deadline = start + warmup + duration
+        worker.start()
+    # Drop everything recorded during the warmup
+    time.sleep(warmup)
+    for worker in workers:
+        worker.recorder.latencies, worker.recorder.errors = {}, {}
+    measured = time.monotonic()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - measured
+
+    total = Recorder()
+    for worker in workers:
+        if worker.error != None:
+            raise worker.error
+        total.merge(worker.recorder)
+    everything = [value for values in total.latencies.values() for value in values]
+    return {
+        'mix': mix,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'total': summarize(everything, sum(total.errors.values()), elapsed),
+        'endpoints': {label: summarize(values, total.errors.get(label, 0), elapsed) for label, values in sorted(total.latencies.items())},
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, log):
+    """ Starts server.py on a free port with the benchmark's environment. Returns (process, port). """
+    port = free_port()
+    env = dict(os.environ)
+    env['GARDENS_BACKEND'] = args.backend
+    env['BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    if args.backend == "sqlite" and "GARDENS_SQLITE_PATH" not in os.environ:
+        env['GARDENS_SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix="gardens-bench-"), "gardens.db")
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), str(port)] + args.server_args
+    process = subprocess.Popen(command, env=env, stdout=log, stderr=log)
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() != None:
+            raise RuntimeError(f"server exited with {process.returncode}, see {log.name}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"server did not start within {START_TIMEOUT}s, see {log.name}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance, floor_ms):
+    """ Returns a line for every endpoint whose p95 grew or throughput fell by more than tolerance.
+    p95 changes smaller than floor_ms are ignored, they are noise for fast endpoints. """
+    old_runs = {(run['mix'], run['concurrency']): run for run in baseline['runs']}
+    problems = []
+    for run in results['runs']:
+        old_run = old_runs.get((run['mix'], run['concurrency']))
+        if old_run == None:
+            continue
+        for label, new in list(run['endpoints'].items()) + [("(all)", run['total'])]:
+            old = old_run['total'] if label == "(all)" else old_run['endpoints'].get(label)
+            if old == None or old['count'] == 0:
+                continue
+            where = f"{run['mix']} x{run['concurrency']} {label}"
+            if new['p95_ms'] > old['p95_ms'] * (1 + tolerance) and new['p95_ms'] - old['p95_ms'] > floor_ms:
+                problems.append(f"{where}: p95 {old['p95_ms']}ms -> {new['p95_ms']}ms")
+            if new['rps'] < old['rps'] * (1 - tolerance):
+                problems.append(f"{where}: throughput {old['rps']}/s -> {new['rps']}/s")
+            if new['errors'] > old['errors'] and new['errors'] > new['count'] * 0.001:
+                problems.append(f"{where}: errors {old['errors']} -> {new['errors']}")
+    return problems
+
+
+def print_run(run):
+    print(f"\n{run['mix']} x{run['concurrency']} ({run['duration']}s)")
+    print(f"  {'endpoint':<36} {'count':>7} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, row in list(run['endpoints'].items()) + [("(all)", run['total'])]:
+        print(f"  {label:<36} {row['count']:>7} {row['errors']:>5} {row['rps']:>9} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load test the gardens REST API.", formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--gardens", type=int, default=200)
+    parser.add_argument("--flowers", type=int, default=100, help="flowers per garden")
+    parser.add_argument("--comments", type=int, default=5, help="comments per garden")
+    parser.add_argument("--mixes", default="browse,paint,login")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated worker counts")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per mix and concurrency")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", default="memory", choices=["memory", "sqlite", "postgres"],
+        help="GARDENS_BACKEND for the server; postgres uses DATABASE_URL, which should be a scratch database")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the server")
+    parser.add_argument("--server-args", default="", help="extra arguments for server.py, like '--workers 4'")
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative change before it counts as a regression")
+    parser.add_argument("--floor-ms", type=float, default=1.0, help="ignore p95 changes smaller than this")
+    parser.add_argument("--compare", nargs=2, metavar=("RESULTS", "BASELINE"))
+    args = parser.parse_args(argv)
+    args.server_args = args.server_args.split()
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as new, open(args.compare[1]) as old:
+            problems = compare(json.load(new), json.load(old), args.tolerance, args.floor_ms)
+        for problem in problems:
+            print("REGRESSION", problem)
+        return 1 if problems else 0
+
+    mixes = [mix for mix in args.mixes.split(",") if mix]
+    for mix in mixes:
+        if mix not in MIXES:
+            print(f"Unknown mix {mix}, expected one of {', '.join(MIXES)}")
+            return 2
+    concurrencies = [int(n) for n in args.concurrency.split(",") if n]
+
+    results = {
+        'version': 1,
+        'config': {key: getattr(args, key) for key in ['users', 'gardens', 'flowers', 'comments', 'duration', 'warmup', 'seed', 'backend', 'bcrypt_rounds', 'env', 'server_args']},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(), 'commit': git_commit()},
+        'runs': [],
+    }
+
+    log = tempfile.NamedTemporaryFile(mode="w", prefix="gardens-bench-", suffix=".log", delete=False)
+    process, port = start_server(args, log)
+    try:
+        started = time.monotonic()
+        garden_ids = seed(port, args.users, args.gardens, args.flowers, args.comments, random.Random(args.seed))
+        print(f"Seeded {args.users} users, {len(garden_ids)} gardens in {time.monotonic() - started:.1f}s (server log: {log.name})")
+        for mix in mixes:
+            for concurrency in concurrencies:
+                run = run_mix(port, mix, concurrency, garden_ids, args.users, args.seed, args.warmup, args.duration)
+                results['runs'].append(run)
+                print_run(run)
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance, args.floor_ms)
+        for problem in problems:
+            print("REGRESSION", problem)
+        if problems:
+            return 1
+        print("No regressions against", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
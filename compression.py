@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import zlib
+
+# zlib window bits for each content coding we can produce
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Preferred first when the client accepts several equally
+PREFERENCE = ['gzip', 'deflate']
+
+
+def choose_encoding(accept_encoding):
+    """ Returns the best content coding the Accept-Encoding header allows, or None for identity. """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+
+    best = None
+    for name in PREFERENCE:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > 0 and (best == None or q > best[1]):
+            best = (name, q)
+    if best == None:
+        return None
+    return best[0]
+
+
+def compress(data, encoding, level):
+    """ Compresses a whole body. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compressor(encoding, level):
+    """ Returns a zlib compressobj for a streamed body. """
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
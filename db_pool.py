@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection could be checked out before the timeout. """
+    pass
+
+
+class Connection(psycopg2.extensions.connection):
+    """ A pooled connection. Remembers the statements prepared in its session, which live as long as it does. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """ A thread-safe pool of postgres connections shared by the whole process. """
+
+    def __init__(self, connect_args, minconn=1, maxconn=10, timeout=5.0, check_after=30.0):
+        self.connect_args = connect_args
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        # Connections idle for longer than this are pinged before being handed out
+        self.check_after = check_after
+
+        self.lock = threading.Condition(threading.Lock())
+        # (connection, time it was returned)
+        self.idle = []
+        self.in_use = set()
+        self.closed = False
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        for _ in range(self.minconn):
+            self.idle.append((self.connect(), time.monotonic()))
+
+    def connect(self):
+        """ Opens a new physical connection. """
+        con = psycopg2.connect(connection_factory=Connection, cursor_factory=psycopg2.extras.RealDictCursor, **self.connect_args)
+        con.autocommit = True
+        return con
+
+    def size(self):
+        return len(self.idle) + len(self.in_use)
+
+    def getconn(self):
+        """ Borrows a healthy connection, waiting up to self.timeout seconds for one to free up. """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            with self.lock:
+                while not self.idle and self.size() >= self.maxconn:
+                    if self.closed:
+                        raise psycopg2.InterfaceError("connection pool is closed")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("timed out waiting for a database connection")
+                    self.lock.wait(remaining)
+
+                if self.idle:
+                    con, returned = self.idle.pop()
+                else:
+                    # Reserve the slot so other threads don't overshoot maxconn while we connect
+                    con, returned = None, None
+                    self.in_use.add(None)
+
+            if con is None:
+                try:
+                    con = self.connect()
+                finally:
+                    with self.lock:
+                        self.in_use.discard(None)
+                        if con is not None:
+                            self.in_use.add(con)
+                        self.lock.notify()
+            else:
+                if not self.healthy(con, returned):
+                    self.discard(con)
+                    continue
+                with self.lock:
+                    self.in_use.add(con)
+
+            waited = time.monotonic() - start
+            with self.lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            return con
+
+    def healthy(self, con, returned):
+        """ Checks a connection that has been sitting idle is still usable. """
+        if con.closed:
+            return False
+        if time.monotonic() - returned < self.check_after:
+            return True
+        try:
+            with con.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, con):
+        """ Closes a connection without returning it to the pool. """
+        with self.lock:
+            self.discarded += 1
+            self.lock.notify()
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+    def putconn(self, con, broken=False):
+        """ Gives a connection back to the pool. Broken connections are closed instead. """
+        with self.lock:
+            self.in_use.discard(con)
+        if broken or con.closed or self.closed:
+            self.discard(con)
+            return
+
+        # Never hand out a connection stuck in the middle of a transaction
+        if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                self.discard(con)
+                return
+
+        with self.lock:
+            if len(self.idle) + len(self.in_use) >= self.maxconn:
+                close = True
+            else:
+                close = False
+                self.idle.append((con, time.monotonic()))
+            self.lock.notify()
+        if close:
+            con.close()
+
+    def closeall(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.lock.notify_all()
+        for con, _ in idle:
+            con.close()
+
+    def stats(self):
+        """ Returns a snapshot of the pool usage. """
+        with self.lock:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'in_use': len(self.in_use),
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+            }
@@ -1,3 +1,8 @@
+DROP TABLE IF EXISTS garden_tombstones CASCADE;
+DROP TABLE IF EXISTS garden_sync_horizon CASCADE;
+DROP TABLE IF EXISTS garden_documents CASCADE;
+DROP TABLE IF EXISTS sessions CASCADE;
+DROP TABLE IF EXISTS schema_migrations CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
 DROP TABLE IF EXISTS gardens CASCADE;
 DROP TABLE IF EXISTS flowers CASCADE;
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+# Postgres channel the write queries NOTIFY on, see migrations/0005_garden_events.sql
+CHANNEL = "garden_events"
+# Seconds a stream may go without a write before it gets a heartbeat comment
+HEARTBEAT = int(os.environ.get("EVENTS_HEARTBEAT", 15))
+# Bytes that may wait for a slow client before its stream is dropped. The client reconnects and refetches.
+MAX_BUFFER = 256 * 1024
+# Event streams one process holds at most
+MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", 10000))
+# Largest event payload, the postgres NOTIFY limit. Past it the data is left out, the same on every backend.
+MAX_PAYLOAD = 8000
+# Sent first on every stream: how long browsers wait before reconnecting, in milliseconds
+PREAMBLE = b"retry: 3000\n\n"
+
+
+def format_event(kind, payload):
+    """ One server-sent event. payload is single-line JSON text. """
+    return f"event: {kind}\ndata: {payload}\n\n".encode("utf-8")
+
+
+class Stream:
+    """ One subscriber's connection, owned by the hub once its response headers are sent. """
+
+    def __init__(self, sock, garden_id, chunked):
+        self.sock = sock
+        self.garden_id = garden_id
+        self.chunked = chunked
+        self.buffer = bytearray()
+        self.last_write = time.monotonic()
+        self.closed = False
+
+
+class EventHub:
+    """ Fans garden change events out to every subscribed connection.
+    One thread per process does all the writing with non-blocking sockets, so idle subscribers hold no request thread.
+    A subscriber that stops reading is dropped once MAX_BUFFER bytes are waiting for it. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # garden id -> set of streams
+        self.streams = {}
+        self.count = 0
+        # Sockets handed over by handlers, the server must not close them
+        self.detached = set()
+        # ("attach", stream) and ("event", garden id, data) for the writer thread
+        self.pending = queue.SimpleQueue()
+        self.pid = None
+        self.selector = None
+        self.waker = None
+        # Called with (type, garden id) for every event this process gets, see watch()
+        self.watchers = []
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def start(self, listen=None):
+        """ Starts the writer thread, and with listen the backend's listener, once per process. """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # A forked child inherits no threads, so anything left from the parent is stale
+            self.streams = {}
+            self.count = 0
+            self.selector = selectors.DefaultSelector()
+            wake_read, self.waker = socket.socketpair()
+            wake_read.setblocking(False)
+            self.selector.register(wake_read, selectors.EVENT_READ, None)
+            threading.Thread(target=self.run, name="event-hub", daemon=True).start()
+        if listen != None:
+            listen(self)
+
+    def watch(self, callback):
+        """ Calls callback(type, garden id) for every event published in or forwarded to this process once the hub started,
+        whether or not anyone subscribed to the garden, and callback(None, None) when events may have been missed. """
+        self.watchers.append(callback)
+
+    def full(self):
+        return self.count >= MAX_STREAMS
+
+    def attach(self, garden_id, sock, chunked):
+        """ Takes over a connection whose event stream headers were sent. """
+        with self.lock:
+            self.detached.add(sock)
+            self.count += 1
+        self.pending.put(("attach", Stream(sock, garden_id, chunked)))
+        self.wake()
+
+    def publish(self, payload):
+        """ Queues an event for every subscriber of its garden. payload is the JSON text of {type, garden_id, data}. """
+        # Nobody in this process subscribed yet
+        if self.pid != os.getpid():
+            return
+        try:
+            event = json.loads(payload)
+            garden_id = int(event['garden_id'])
+            kind = str(event['type'])
+        except (ValueError, KeyError, TypeError):
+            return
+        for watcher in self.watchers:
+            watcher(kind, garden_id)
+        with self.lock:
+            self.published += 1
+        self.pending.put(("event", garden_id, format_event(kind, payload)))
+        self.wake()
+
+    def listening(self, reconnected):
+        """ Called by a backend's listener each time it starts listening. Whatever was sent before it did was missed,
+        which subscribers only need to hear about after a reconnect, since nobody could subscribe before the first one. """
+        for watcher in self.watchers:
+            watcher(None, None)
+        if reconnected:
+            self.resync()
+
+    def resync(self):
+        """ Tells every subscriber that events may have been missed, so they refetch. """
+        if self.pid != os.getpid():
+            return
+        self.pending.put(("event", None, format_event("resync", "{}")))
+        self.wake()
+
+    def wake(self):
+        if self.waker != None:
+            try:
+                self.waker.send(b"\0")
+            except OSError:
+                pass
+
+    def run(self):
+        next_heartbeat = time.monotonic() + 1
+        while True:
+            for key, mask in self.selector.select(timeout=1):
+                stream = key.data
+                if stream == None:
+                    try:
+                        while key.fileobj.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    # Subscribers have nothing to say, readable almost always means they hung up
+                    try:
+                        hung_up = not stream.sock.recv(4096)
+                    except BlockingIOError:
+                        hung_up = False
+                    except OSError:
+                        hung_up = True
+                    if hung_up:
+                        self.close(stream)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(stream)
+
+            while True:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] == "attach":
+                    self.add(item[1])
+                else:
+                    self.deliver(item[1], item[2])
+
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                next_heartbeat = now + 1
+                for streams in list(self.streams.values()):
+                    for stream in list(streams):
+                        if now - stream.last_write >= HEARTBEAT:
+                            self.enqueue(stream, b": heartbeat\n\n")
+
+    def add(self, stream):
+        stream.sock.setblocking(False)
+        try:
+            self.selector.register(stream.sock, selectors.EVENT_READ, stream)
+        except (ValueError, OSError):
+            # Closed before the hub got to it
+            stream.closed = True
+            self.forget(stream)
+            return
+        self.streams.setdefault(stream.garden_id, set()).add(stream)
+        self.enqueue(stream, PREAMBLE)
+
+    def deliver(self, garden_id, data):
+        if garden_id == None:
+            targets = [stream for streams in self.streams.values() for stream in streams]
+        else:
+            targets = list(self.streams.get(garden_id, ()))
+        for stream in targets:
+            self.enqueue(stream, data)
+        self.delivered += len(targets)
+
+    def enqueue(self, stream, data):
+        if stream.closed:
+            return
+        if stream.chunked:
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        stream.buffer += data
+        if len(stream.buffer) > MAX_BUFFER:
+            self.dropped += 1
+            self.close(stream)
+            return
+        self.flush(stream)
+
+    def flush(self, stream):
+        if stream.closed:
+            return
+        try:
+            sent = stream.sock.send(stream.buffer)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close(stream)
+            return
+        if sent:
+            del stream.buffer[:sent]
+            stream.last_write = time.monotonic()
+        # Only wait for writability while something is left to send
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if stream.buffer else 0)
+        try:
+            self.selector.modify(stream.sock, events, stream)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def close(self, stream):
+        if stream.closed:
+            return
+        stream.closed = True
+        try:
+            self.selector.unregister(stream.sock)
+        except (KeyError, ValueError):
+            pass
+        streams = self.streams.get(stream.garden_id)
+        if streams != None:
+            streams.discard(stream)
+            if not streams:
+                del self.streams[stream.garden_id]
+        try:
+            stream.sock.close()
+        except OSError:
+            pass
+        self.forget(stream)
+
+    def forget(self, stream):
+        with self.lock:
+            self.detached.discard(stream.sock)
+            self.count -= 1
+
+    def stats(self):
+        return {
+            'streams': self.count,
+            'gardens': len(self.streams),
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+
+
+class DetachMixIn:
+    """ For servers: leaves connections handed to the event hub open when their handler returns. """
+
+    def shutdown_request(self, request):
+        if request in HUB.detached:
+            return
+        super().shutdown_request(request)
+
+
+def publish(kind, garden_id, data=None):
+    """ Publishes straight to this process's hub, for backends without a shared notification channel. """
+    if HUB.pid != os.getpid():
+        return
+    payload = json.dumps({'type': kind, 'garden_id': int(garden_id), 'data': data})
+    if len(payload) >= MAX_PAYLOAD:
+        payload = json.dumps({'type': kind, 'garden_id': int(garden_id), 'data': None})
+    held = getattr(HELD, "payloads", None)
+    if held != None:
+        held.append(payload)
+        return
+    HUB.publish(payload)
+
+
+@contextmanager
+def hold():
+    """ Holds back what this thread publishes until the block is done, and drops it if the block raises.
+    For the transactions of backends without NOTIFY, whose subscribers must not hear of writes that are rolled back. """
+    if getattr(HELD, "payloads", None) != None:
+        # Nested, the outer block decides
+        yield
+        return
+    HELD.payloads = []
+    try:
+        yield
+        payloads = HELD.payloads
+    finally:
+        HELD.payloads = None
+    for payload in payloads:
+        HUB.publish(payload)
+
+
+HUB = EventHub()
+# Per thread list of payloads held by hold()
+HELD = threading.local()
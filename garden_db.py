@@ -1,133 +1,580 @@
 #!/usr/bin/env python3
 
+import csv
+import io
+import json
 import os
+import select
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
 import urllib.parse
 
-class GardensDB:
-    """ The database API for the gardens web app. """
-    
-    def __init__(self):
-        urllib.parse.uses_netloc.append("postgres")
-        url = urllib.parse.urlparse(os.environ["DATABASE_URL"])
-
-        self.con = psycopg2.connect(
-            cursor_factory=psycopg2.extras.RealDictCursor,
-            database=url.path[1:],
-            user=url.username,
-            password=url.password,
-            host=url.hostname,
-            port=url.port
+from backend import GardensBackend, OK, NOT_FOUND, FORBIDDEN, flower_point, grid_size
+from db_pool import ConnectionPool
+from statements import StatementRegistry
+import events
+import metrics
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+def connect_args():
+    """ Builds psycopg2 connection arguments from DATABASE_URL. """
+    urllib.parse.uses_netloc.append("postgres")
+    url = urllib.parse.urlparse(os.environ["DATABASE_URL"])
+    return {
+        'database': url.path[1:],
+        'user': url.username,
+        'password': url.password,
+        'host': url.hostname,
+        'port': url.port,
+    }
+
+
+def get_pool():
+    """ Returns the process-wide connection pool, creating it on first use. """
+    global POOL
+    if POOL is None:
+        with POOL_LOCK:
+            if POOL is None:
+                POOL = ConnectionPool(
+                    connect_args(),
+                    minconn=int(os.environ.get("DB_POOL_MIN", 1)),
+                    maxconn=int(os.environ.get("DB_POOL_MAX", 10)),
+                    timeout=float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+                )
+    return POOL
+
+
+def close_pool():
+    """ Closes the process-wide pool. The next GardensDB opens a new one. Must be called before forking, since connections can't be shared between processes. """
+    global POOL
+    with POOL_LOCK:
+        if POOL is not None:
+            POOL.closeall()
+            POOL = None
+
+
+def pool_stats():
+    """ Returns the pool usage stats, or None if no pool has been created yet. """
+    if POOL is None:
+        return None
+    return POOL.stats()
+
+
+# Read queries by the GardensDB method that runs them. Also used by `migrate.py check`.
+# Columns are listed, so only what callers use is sent and added columns don't change prepared statements' results.
+QUERIES = {
+    # Only logging in looks users up by email, and only needs the password hash
+    'get_user': "SELECT id, password FROM users WHERE email = (%s)",
+    'get_user_by_id': "SELECT id, first_name, last_name, email FROM users WHERE id = (%s)",
+    'get_gardens': "SELECT id, name, author, author_id FROM gardens",
+    'get_gardens_page': "SELECT id, name, author, author_id FROM gardens WHERE id > %s ORDER BY id LIMIT %s",
+    'get_user_gardens': "SELECT id, name, author, author_id FROM gardens WHERE author_id = (%s)",
+    'get_one_garden': "SELECT id, name, author, author_id FROM gardens WHERE id = (%s)",
+    'get_garden_owner': "SELECT author_id FROM gardens WHERE id = %s",
+    # build_garden_document is defined in migrations/0004_garden_documents.sql. Cast to text so psycopg2 hands back the raw string.
+    'get_one_garden_json': "SELECT build_garden_document(%s)::text AS doc",
+    'get_garden_document': "SELECT doc::text AS doc FROM garden_documents WHERE garden_id = %s",
+    # build_garden_changes is defined in migrations/0006_row_versions.sql
+    'get_garden_changes': "SELECT build_garden_changes(%s, %s)::text AS doc",
+    'get_comments': "SELECT c.id, c.content, u.first_name AS author, c.author_id FROM comments c \
+        INNER JOIN users u ON u.id = c.author_id WHERE c.garden_id = (%s)",
+    'get_one_comment': "SELECT id, content, garden_id, author_id FROM comments WHERE id = %s",
+    'get_flowers': "SELECT id, color, x, y, garden_id FROM flowers WHERE garden_id = (%s)",
+    'get_one_flower': "SELECT id, color, x, y, garden_id FROM flowers WHERE id = %s",
+    # Both use flowers_garden_id_point_idx from migrations/0008_flower_viewport_index.sql. LIMIT NULL is no limit.
+    'get_flowers_in_box': "SELECT id, color, x, y, garden_id FROM flowers \
+        WHERE garden_id = %s AND point(x, y) <@ box(point(%s, %s), point(%s, %s)) ORDER BY id LIMIT %s",
+    # The lowest id flower of each cell of an n by n grid over the box. A box with no width or height is one cell wide.
+    # The parameters are typed once in b, so a prepared statement doesn't have to guess them from how they are used.
+    'get_flowers_in_box_sample': "SELECT id, color, x, y, garden_id FROM ( \
+            SELECT DISTINCT ON (cx, cy) id, color, x, y, garden_id FROM ( \
+                SELECT f.id, f.color, f.x, f.y, f.garden_id, \
+                    LEAST(floor((f.x - b.x0) * b.n / NULLIF(b.x1 - b.x0, 0)), b.n - 1) AS cx, \
+                    LEAST(floor((f.y - b.y0) * b.n / NULLIF(b.y1 - b.y0, 0)), b.n - 1) AS cy \
+                FROM flowers f, (SELECT %(x0)s::float8 AS x0, %(y0)s::float8 AS y0, %(x1)s::float8 AS x1, %(y1)s::float8 AS y1, \
+                    %(n)s::integer AS n) b \
+                WHERE f.garden_id = %(garden_id)s AND point(f.x, f.y) <@ box(point(b.x0, b.y0), point(b.x1, b.y1)) \
+            ) f ORDER BY cx, cy, id \
+        ) s ORDER BY id",
+}
+
+
+# Writes that check ownership in the same statement. target finds the row and its owner, changed only touches it if the owner matches.
+# Each returns whether the row was found, whether it was changed, and the garden it belongs to, all in one round trip.
+# A change also publishes a garden event (see migrations/0005_garden_events.sql), which listeners only get once it commits.
+OWNED_WRITES = {
+    'update_garden': """
+        WITH target AS (SELECT id, author_id FROM gardens WHERE id = %(id)s),
+        changed AS (
+            UPDATE gardens g SET name = %(name)s FROM target t
+            WHERE g.id = t.id AND t.author_id = %(owner)s RETURNING g.id, g.name
         )
-        self.con.autocommit = True
+        SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM changed) AS done, %(id)s::integer AS garden_id,
+            (SELECT notify_garden_event('garden_updated', id, json_build_object('name', name)) FROM changed) AS notified
+    """,
+    'delete_garden': """
+        WITH target AS (SELECT id, author_id FROM gardens WHERE id = %(id)s),
+        changed AS (
+            DELETE FROM gardens g USING target t
+            WHERE g.id = t.id AND t.author_id = %(owner)s RETURNING g.id
+        )
+        SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM changed) AS done, %(id)s::integer AS garden_id,
+            (SELECT notify_garden_event('garden_deleted', id, NULL) FROM changed) AS notified
+    """,
+    'update_comment': """
+        WITH target AS (SELECT id, author_id, garden_id FROM comments WHERE id = %(id)s),
+        changed AS (
+            UPDATE comments c SET content = %(content)s FROM target t
+            WHERE c.id = t.id AND t.author_id = %(owner)s RETURNING c.id, c.garden_id, c.content
+        )
+        SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM changed) AS done, (SELECT garden_id FROM target) AS garden_id,
+            (SELECT notify_garden_event('comment_updated', garden_id, json_build_object('id', id, 'content', content)) FROM changed) AS notified
+    """,
+    'delete_comment': """
+        WITH target AS (SELECT id, author_id, garden_id FROM comments WHERE id = %(id)s),
+        changed AS (
+            DELETE FROM comments c USING target t
+            WHERE c.id = t.id AND t.author_id = %(owner)s RETURNING c.id, c.garden_id
+        )
+        SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM changed) AS done, (SELECT garden_id FROM target) AS garden_id,
+            (SELECT notify_garden_event('comment_deleted', garden_id, json_build_object('id', id)) FROM changed) AS notified
+    """,
+    'delete_flower': """
+        WITH target AS (
+            SELECT f.id, f.garden_id, g.author_id FROM flowers f
+            INNER JOIN gardens g ON g.id = f.garden_id WHERE f.id = %(id)s
+        ),
+        changed AS (
+            DELETE FROM flowers f USING target t
+            WHERE f.id = t.id AND t.author_id = %(owner)s RETURNING f.id, f.garden_id
+        )
+        SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM changed) AS done, (SELECT garden_id FROM target) AS garden_id,
+            (SELECT notify_garden_event('flower_deleted', garden_id, json_build_object('id', id)) FROM changed) AS notified
+    """,
+}
+
+
+# The other single statement writes
+WRITES = {
+    'create_user': "INSERT INTO users (first_name, last_name, email, password) VALUES (%s, %s, %s, %s) RETURNING id",
+    'update_user_password': "UPDATE users SET password = %s WHERE id = %s",
+    # Nobody can be subscribed to a new garden, the event is for other processes' cached garden lists
+    'create_garden': "WITH created AS (INSERT INTO gardens (name, author, author_id) VALUES (%s, %s, %s) RETURNING id) \
+        SELECT id, notify_garden_event('garden_added', id, NULL) AS notified FROM created",
+    'create_comment': "WITH created AS (INSERT INTO comments (content, garden_id, author_id) VALUES (%s, %s, %s) RETURNING *) \
+        SELECT c.id, notify_garden_event('comment_added', c.garden_id, \
+            json_build_object('id', c.id, 'content', c.content, 'author', u.first_name, 'author_id', c.author_id)) AS notified \
+        FROM created c INNER JOIN users u ON u.id = c.author_id",
+    'create_flower': "WITH created AS (INSERT INTO flowers (color, x, y, garden_id) VALUES (%s, %s, %s, %s) RETURNING id, color, x, y, garden_id) \
+        SELECT id, notify_garden_event('flower_added', garden_id, row_to_json(created)) AS notified FROM created",
+    # One event for a whole bulk insert. Too large a batch is sent without data and subscribers refetch.
+    'notify_flowers_added': "SELECT notify_garden_event('flowers_added', %s, %s::json)",
+}
+
+# Everything above, prepared per connection. Bulk inserts and server-side cursors still send their SQL as text.
+STATEMENTS = StatementRegistry("gardens_")
+STATEMENTS.add_all(QUERIES)
+STATEMENTS.add_all(OWNED_WRITES)
+STATEMENTS.add_all(WRITES)
+
+# The lines of garden_export.py in one COPY, so the garden, its flowers and its comments come from one snapshot.
+# As CSV with a delimiter and quote that JSON text never holds unescaped, so the lines come out as they are instead of with doubled backslashes.
+EXPORT_GARDEN = """COPY (
+    SELECT line FROM (
+        SELECT 0 AS part, g.id, json_build_object('type', 'garden', 'id', g.id, 'name', g.name, 'author', g.author, 'author_id', g.author_id)::text AS line
+        FROM gardens g WHERE g.id = %(id)s
+        UNION ALL
+        SELECT 1, f.id, json_build_object('type', 'flower', 'id', f.id, 'color', f.color, 'x', f.x, 'y', f.y)::text
+        FROM flowers f WHERE f.garden_id = %(id)s
+        UNION ALL
+        SELECT 2, c.id, json_build_object('type', 'comment', 'id', c.id, 'content', c.content, 'author', u.first_name, 'author_id', c.author_id)::text
+        FROM comments c INNER JOIN users u ON u.id = c.author_id WHERE c.garden_id = %(id)s
+    ) lines ORDER BY part, id
+) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\x01', QUOTE E'\\x02')"""
+IMPORT_FLOWERS = "COPY flowers (garden_id, color, x, y) FROM STDIN WITH (FORMAT csv)"
+IMPORT_COMMENTS = "COPY comments (garden_id, author_id, content) FROM STDIN WITH (FORMAT csv)"
+
+
+class GardensDB(GardensBackend):
+    """ The postgres backend of the gardens web app. Connections are borrowed from the shared pool per call. """
+
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
+        # Connection every call uses while in batch()
+        self.pinned = None
+
+    @classmethod
+    def close_shared(cls):
+        close_pool()
+
+    @classmethod
+    def shared_stats(cls):
+        return pool_stats()
 
-        self.cursor = self.con.cursor()
+    @classmethod
+    def listen(cls, hub):
+        """ Starts the thread that forwards garden events NOTIFYed by every server process to hub. """
+        EventListener(hub).start()
 
-    def __del__(self):
-        self.con.close()
+    @contextmanager
+    def connection(self):
+        """ Borrows a pooled connection. It goes back to the pool afterwards, or is closed if it broke. """
+        if self.pinned != None:
+            yield self.pinned
+            return
+        con = self.pool.getconn()
+        broken = False
+        try:
+            yield con
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.pool.putconn(con, broken)
+
+    @contextmanager
+    def cursor(self):
+        """ Borrows a pooled connection and yields a fresh cursor on it. """
+        with self.connection() as con, con.cursor() as cursor:
+            yield cursor
+
+    @contextmanager
+    def transaction(self):
+        """ Borrows a pooled connection with autocommit off. Commits on success, rolls back on error. """
+        with self.connection() as con:
+            if not con.autocommit:
+                # Part of a batch transaction, which commits or rolls back as a whole
+                yield con
+                return
+            con.autocommit = False
+            try:
+                yield con
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+            finally:
+                con.autocommit = True
+
+    @contextmanager
+    def batch(self, transaction=False):
+        """ Borrows one pooled connection for every call made in the block. With transaction it is one transaction too. """
+        with self.connection() as con:
+            self.pinned = con
+            try:
+                if transaction:
+                    with self.transaction():
+                        yield self
+                else:
+                    yield self
+            finally:
+                self.pinned = None
+
+    def owned_write(self, name, params):
+        """ Runs one of OWNED_WRITES. Returns (OK, NOT_FOUND or FORBIDDEN, garden id of the target). """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, name, params)
+            row = cursor.fetchone()
+        if not row['found']:
+            return NOT_FOUND, None
+        if not row['done']:
+            return FORBIDDEN, row['garden_id']
+        return OK, row['garden_id']
 
     def create_tables(self):
-        """ Create the tables in the database for initial use. Will NOT drop old tables. """
-        with open("schema.sql", "r") as f:
-            self.cursor.execute(f.read())
+        """ Bring the database up to the latest schema by applying any pending migrations. Will NOT drop old tables. """
+        import migrate
+        migrate.migrate(self)
 
     def reset(self):
         """ Reset the tables in the database. Will drop old tables and recreate them. Deletes ALL data. """
-        with open("delete-tables.sql", "r") as f:
-            self.cursor.execute(f.read())
-        with open("schema.sql", "r") as f:
-            self.cursor.execute(f.read())
+        with open("delete-tables.sql", "r") as f, self.cursor() as cursor:
+            cursor.execute(f.read())
+        self.create_tables()
 
     # USERS
     def create_user(self, first_name, last_name, email, password):
         """ Creates a user and stores the hashed password. """
-        self.cursor.execute("INSERT INTO users (first_name, last_name, email, password) VALUES (%s, %s, %s, %s) RETURNING id", [first_name, last_name, email, password])
-        rid = self.cursor.fetchone()
-        return rid
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'create_user', [first_name, last_name, email, password])
+            return cursor.fetchone()
     
     def get_user(self, email):
-        """ Returns the user's info. """
-        self.cursor.execute("SELECT * FROM users WHERE email = (%s)", [email])
-        return self.cursor.fetchone()
+        """ Returns the id and password hash of the user with email, for logging in. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_user', [email])
+            return cursor.fetchone()
 
     def get_user_by_id(self, uid):
-        """ Returns the user's info. """
-        self.cursor.execute("SELECT * FROM users WHERE id = (%s)", [uid])
-        return self.cursor.fetchone()
+        """ Returns the user's info, without the password hash. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_user_by_id', [uid])
+            return cursor.fetchone()
+
+    def update_user_password(self, uid, password):
+        """ Replaces the user's hashed password. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'update_user_password', [password, uid])
 
     # GARDENS
     def create_garden(self, name, author, userid):
         """ Creates a garden and returns the id of the created garden. """
         data = [name, author, userid]
-        self.cursor.execute("INSERT INTO gardens (name, author, author_id) VALUES (%s, %s, %s) RETURNING id", data)
-        rid = self.cursor.fetchone()
-        return rid
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'create_garden', data)
+            return {'id': cursor.fetchone()['id']}
 
     def get_gardens(self):
         """ Returns dict of garden info. """
-        self.cursor.execute("SELECT * FROM gardens")
-        return self.cursor.fetchall()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_gardens')
+            return cursor.fetchall()
+
+    def get_gardens_page(self, limit, after=None):
+        """ Returns up to limit gardens with id > after, in id order, and the cursor for the next page (None on the last page). """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_gardens_page', [after or 0, limit + 1])
+            rows = cursor.fetchall()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1]['id']
+        return rows, None
 
+    def iter_gardens(self, batch_size=500):
+        """ Yields lists of at most batch_size gardens through a server-side cursor, so the full table is never held in memory. """
+        with self.transaction() as con, con.cursor(name="iter_gardens") as cursor:
+            cursor.execute(QUERIES['get_gardens'] + " ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
 
     def get_user_gardens(self, userid):
         """ Returns all gardens created by a user. """
-        self.cursor.execute("SELECT * FROM gardens WHERE author_id = (%s)", [userid])
-        return self.cursor.fetchall()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_user_gardens', [userid])
+            return cursor.fetchall()
 
     def get_one_garden(self, id):
         """ Returns dict of specific garden info, including comments and flowers. """
-        self.cursor.execute("SELECT * FROM gardens WHERE id = (%s)", [id])
-        data = self.cursor.fetchone()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_one_garden', [id])
+            data = cursor.fetchone()
         if data != None:
             data['comments'] = self.get_comments(id)
             data['flowers'] = self.get_flowers(id)
         return data
 
-    def update_garden(self, id, name):
-        self.cursor.execute("UPDATE gardens SET name = %s WHERE id = %s", [name, id])
+    def get_one_garden_json(self, id, materialized=False):
+        """ Returns the same document as get_one_garden, but built by postgres in one query as JSON text.
+        With materialized it is read from the trigger-maintained garden_documents table, falling back to building it. """
+        with self.cursor() as cursor:
+            if materialized:
+                STATEMENTS.execute(cursor, 'get_garden_document', [id])
+                row = cursor.fetchone()
+                if row != None:
+                    return row['doc']
+            STATEMENTS.execute(cursor, 'get_one_garden_json', [id])
+            row = cursor.fetchone()
+        if row == None:
+            return None
+        return row['doc']
+
+    def get_garden_changes(self, id, since):
+        """ Returns the garden's flowers and comments written since a version, and the ids of those deleted, as JSON text, or None. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_garden_changes', [id, since])
+            row = cursor.fetchone()
+        if row == None:
+            return None
+        return row['doc']
 
-    def delete_garden(self, id):
-        self.cursor.execute("DELETE FROM gardens WHERE id = %s", [id])
+    def get_garden_owner(self, id):
+        """ Returns the author_id of a garden, or None if it doesn't exist. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_garden_owner', [id])
+            row = cursor.fetchone()
+        if row == None:
+            return None
+        return row['author_id']
+
+    def update_garden(self, id, name, owner):
+        """ Renames the garden if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        return self.owned_write('update_garden', {'id': id, 'name': name, 'owner': owner})[0]
+
+    def delete_garden(self, id, owner):
+        """ Deletes the garden if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        return self.owned_write('delete_garden', {'id': id, 'owner': owner})[0]
         
     # COMMENTS
     def create_comment(self, garden_id, comment, user_id):
         data = [comment, garden_id, user_id]
-        self.cursor.execute("INSERT INTO comments (content, garden_id, author_id) VALUES (%s, %s, %s) RETURNING id", data)
-        rid = self.cursor.fetchone()
-        return rid
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'create_comment', data)
+            return {'id': cursor.fetchone()['id']}
 
     def get_comments(self, garden_id):
         """ Returns all comments from the garden with {id = garden_id} """
-        self.cursor.execute("SELECT c.id, c.content, u.first_name AS author, c.author_id FROM comments c \
-            INNER JOIN users u ON u.id = c.author_id WHERE c.garden_id = (%s)", [garden_id])
-        return self.cursor.fetchall()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_comments', [garden_id])
+            return cursor.fetchall()
 
     def get_one_comment(self, id):
-        self.cursor.execute("SELECT * FROM comments WHERE id = %s", [id])
-        return self.cursor.fetchone()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_one_comment', [id])
+            return cursor.fetchone()
 
-    def update_comment(self, id, content):
-        self.cursor.execute("UPDATE comments SET content = %s WHERE id = %s", [content, id])
+    def update_comment(self, id, content, owner):
+        """ Changes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        return self.owned_write('update_comment', {'id': id, 'content': content, 'owner': owner})
 
-    def delete_comment(self, id):
-        self.cursor.execute("DELETE FROM comments WHERE id = (%s)", [id])
+    def delete_comment(self, id, owner):
+        """ Deletes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        return self.owned_write('delete_comment', {'id': id, 'owner': owner})
 
     # FLOWERS
     def create_flower(self, garden_id, color, x, y):
-        data = [color, x, y, garden_id]
-        self.cursor.execute("INSERT INTO flowers (color, x, y, garden_id) VALUES (%s, %s, %s, %s) RETURNING id", data)
-        rid = self.cursor.fetchone()
-        return rid
+        data = [color, *flower_point(x, y), garden_id]
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'create_flower', data)
+            return {'id': cursor.fetchone()['id']}
+
+    def create_flowers(self, garden_id, flowers):
+        """ Inserts (color, x, y) flowers into a garden in one transaction. Returns the created ids in order. """
+        if not flowers:
+            return []
+        flowers = [(color, *flower_point(x, y)) for color, x, y in flowers]
+        rows = [(color, x, y, garden_id) for color, x, y in flowers]
+        with self.transaction() as con, con.cursor() as cursor:
+            result = psycopg2.extras.execute_values(cursor, "INSERT INTO flowers (color, x, y, garden_id) VALUES %s RETURNING id", rows, page_size=1000, fetch=True)
+            ids = [row['id'] for row in result]
+            created = [{'id': id, 'color': color, 'x': x, 'y': y, 'garden_id': garden_id} for id, (color, x, y) in zip(ids, flowers)]
+            STATEMENTS.execute(cursor, 'notify_flowers_added', [garden_id, json.dumps(created)])
+        return ids
 
     def get_flowers(self, garden_id):
         """ Returns all flowers from the garden with {id = garden_id} """
-        self.cursor.execute("SELECT * FROM flowers WHERE garden_id = (%s)", [garden_id])
-        return self.cursor.fetchall()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_flowers', [garden_id])
+            return cursor.fetchall()
+
+    def get_flowers_in_box(self, garden_id, x0, y0, x1, y1, limit=None):
+        """ Returns the garden's flowers inside the box in id order, and whether they were sampled down to about limit. """
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_flowers_in_box', [garden_id, x0, y0, x1, y1, limit + 1 if limit else None])
+            rows = cursor.fetchall()
+            if not limit or len(rows) <= limit:
+                return rows, False
+            STATEMENTS.execute(cursor, 'get_flowers_in_box_sample',
+                {'garden_id': garden_id, 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1, 'n': grid_size(limit)})
+            return cursor.fetchall(), True
 
     def get_one_flower(self, id):
-        self.cursor.execute("SELECT * FROM flowers WHERE id = %s", [id])
-        return self.cursor.fetchone()
+        with self.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'get_one_flower', [id])
+            return cursor.fetchone()
+
+    def delete_flower(self, id, owner):
+        """ Deletes the flower if owner wrote its garden. Returns (OK, NOT_FOUND or FORBIDDEN, the flower's garden id). """
+        return self.owned_write('delete_flower', {'id': id, 'owner': owner})
+
+    # EXPORT
+    def export_garden(self, id, write):
+        """ Streams the garden's lines out of COPY ... TO STDOUT, handing each one to write as it arrives. """
+        with self.cursor() as cursor:
+            cursor.copy_expert(cursor.mogrify(EXPORT_GARDEN, {'id': id}).decode("utf-8"), CopyOut(write))
+
+    def import_garden(self, garden, userid):
+        """ Creates the garden, then streams its flowers and its comments into COPY ... FROM STDIN, all in one transaction.
+        The garden_documents triggers are per statement, so each COPY rebuilds the document once. """
+        with self.transaction() as con, con.cursor() as cursor:
+            STATEMENTS.execute(cursor, 'create_garden', [garden.name, garden.author, userid])
+            id = cursor.fetchone()['id']
+            flowers = CopyIn((id, color, x, y) for color, x, y in garden.flowers())
+            comments = CopyIn((id, userid, content) for content in garden.comments())
+            for sql, rows in ((IMPORT_FLOWERS, flowers), (IMPORT_COMMENTS, comments)):
+                cursor.copy_expert(sql, rows)
+                if rows.error != None:
+                    raise rows.error
+        return {'id': id, 'flowers': flowers.count, 'comments': comments.count}
+
+
+class CopyOut:
+    """ The file copy_expert writes COPY ... TO STDOUT into, passing the data on to write. """
+
+    def __init__(self, write):
+        self.write = write
+
+
+class CopyIn:
+    """ The file copy_expert reads COPY ... FROM STDIN from: CSV lines made from an iterator of tuples, a few kilobytes at a time.
+    An error raised by the iterator ends the data early and is kept in error, for the caller to raise once COPY returns,
+    since psycopg2 would replace it with its own. """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self.error = None
+
+    def read(self, size=8192):
+        out = io.StringIO()
+        # Quoted strings, so an empty one isn't read as NULL
+        writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        try:
+            while out.tell() < size:
+                row = next(self.rows, None)
+                if row == None:
+                    break
+                writer.writerow(row)
+                self.count += 1
+        except Exception as error:
+            self.error = error
+            return ""
+        return out.getvalue()
+
+    readline = read
+
+
+class EventListener(threading.Thread):
+    """ Holds one connection outside the pool that LISTENs for garden events and hands them to the hub. Reconnects when it drops. """
+
+    def __init__(self, hub):
+        super().__init__(name="event-listener", daemon=True)
+        self.hub = hub
+
+    def run(self):
+        delay = 1
+        connected_before = False
+        while True:
+            con = None
+            try:
+                con = psycopg2.connect(**connect_args())
+                con.autocommit = True
+                with con.cursor() as cursor:
+                    cursor.execute(f"LISTEN {events.CHANNEL}")
+                # Anything sent while disconnected was missed
+                self.hub.listening(connected_before)
+                connected_before = True
+                delay = 1
+                while True:
+                    if select.select([con], [], [], 5) == ([], [], []):
+                        continue
+                    con.poll()
+                    while con.notifies:
+                        self.hub.publish(con.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError):
+                if con != None:
+                    con.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
 
-    def delete_flower(self, id):
-        self.cursor.execute("DELETE FROM flowers WHERE id = (%s)", [id])
+# Record query counts, durations and rows for every GardensDB method
+metrics.instrument(GardensDB, metrics.REGISTRY, "gardens_db", skip={'connection', 'cursor', 'transaction', 'batch', 'owned_write', 'close_shared', 'shared_stats', 'listen'})
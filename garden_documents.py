@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+""" Manages the materialized garden_documents table (see migrations/0004_garden_documents.sql).
+
+Usage:
+    garden_documents.py enable          turn on the maintenance triggers and backfill every document
+    garden_documents.py disable         turn off the maintenance triggers
+    garden_documents.py rebuild [id...] rebuild the given gardens' documents, or all of them
+    garden_documents.py check           compare every document against the live tables
+"""
+
+import sys
+
+# (table, trigger) pairs that keep garden_documents current
+TRIGGERS = [
+    ('flowers', 'flowers_documents_insert'),
+    ('flowers', 'flowers_documents_update'),
+    ('flowers', 'flowers_documents_delete'),
+    ('comments', 'comments_documents_insert'),
+    ('comments', 'comments_documents_update'),
+    ('comments', 'comments_documents_delete'),
+    ('gardens', 'gardens_documents_change'),
+    ('users', 'users_documents_rename'),
+]
+
+# Gardens handled per statement when rebuilding or checking everything
+BATCH_SIZE = 500
+
+
+def set_triggers(db, enabled):
+    action = "ENABLE" if enabled else "DISABLE"
+    with db.cursor() as cursor:
+        for table, trigger in TRIGGERS:
+            cursor.execute(f"ALTER TABLE {table} {action} TRIGGER {trigger}")
+
+
+def rebuild(db, ids=None):
+    """ Rebuilds the documents of the given gardens, or of every garden in batches. Returns how many were rebuilt. """
+    with db.cursor() as cursor:
+        if ids:
+            cursor.execute("SELECT refresh_garden_document(id) FROM gardens WHERE id = ANY(%s)", [list(ids)])
+            return cursor.rowcount
+
+        count = 0
+        after = 0
+        while True:
+            cursor.execute("SELECT id FROM gardens WHERE id > %s ORDER BY id LIMIT %s", [after, BATCH_SIZE])
+            batch = [row['id'] for row in cursor.fetchall()]
+            if not batch:
+                return count
+            cursor.execute("SELECT refresh_garden_document(id) FROM unnest(%s::integer[]) AS id", [batch])
+            count += len(batch)
+            after = batch[-1]
+
+
+def check(db):
+    """ Returns (garden id, problem) for every garden whose document is missing or differs from the live tables. """
+    problems = []
+    with db.cursor() as cursor:
+        after = 0
+        while True:
+            cursor.execute("SELECT id FROM gardens WHERE id > %s ORDER BY id LIMIT %s", [after, BATCH_SIZE])
+            batch = [row['id'] for row in cursor.fetchall()]
+            if not batch:
+                return problems
+            cursor.execute("SELECT g.id, d.garden_id IS NULL AS missing FROM gardens g \
+                LEFT JOIN garden_documents d ON d.garden_id = g.id \
+                WHERE g.id = ANY(%s) AND (d.garden_id IS NULL OR d.doc::jsonb <> build_garden_document(g.id)::jsonb)", [batch])
+            for row in cursor.fetchall():
+                problems.append((row['id'], "missing" if row['missing'] else "stale"))
+            after = batch[-1]
+
+
+def main(args):
+    from garden_db import GardensDB
+
+    command = args[0] if args else None
+    db = GardensDB()
+    if command == "enable":
+        # Triggers first, so changes made during the backfill aren't missed
+        set_triggers(db, True)
+        print(f"Rebuilt {rebuild(db)} garden document(s)")
+    elif command == "disable":
+        set_triggers(db, False)
+    elif command == "rebuild":
+        print(f"Rebuilt {rebuild(db, [int(id) for id in args[1:]])} garden document(s)")
+    elif command == "check":
+        problems = check(db)
+        for id, problem in problems:
+            print(f"garden {id}: {problem}")
+        if problems:
+            return 1
+        print("All garden documents match")
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import json
+import math
+
+# Longest line an import may have, longer ones are refused instead of being buffered
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class BadImport(ValueError):
+    """ The body of an import isn't a garden export. Nothing of it is kept. """
+
+
+# An export is NDJSON, one object per line: the garden, then its flowers, then its comments, each in id order.
+# {"type": "garden", "id", "name", "author", "author_id"}
+# {"type": "flower", "id", "color", "x", "y"}
+# {"type": "comment", "id", "content", "author", "author_id"}
+# Postgres builds the same lines in garden_db.EXPORT_GARDEN.
+
+def export_line(kind, row, columns):
+    return (json.dumps({'type': kind, **{column: row[column] for column in columns}}) + "\n").encode("utf-8")
+
+
+def garden_line(garden):
+    return export_line('garden', garden, ('id', 'name', 'author', 'author_id'))
+
+
+def flower_line(flower):
+    return export_line('flower', flower, ('id', 'color', 'x', 'y'))
+
+
+def comment_line(comment):
+    return export_line('comment', comment, ('id', 'content', 'author', 'author_id'))
+
+
+class GardenImport:
+    """ Reads an export from an iterator of lines, one line at a time. The garden line is read straight away,
+    then flowers() and comments() must be read in that order. Raises BadImport at the first line that doesn't fit.
+    Ids in the export are ignored, the importing backend hands out new ones. """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.number = 0
+        # A line flowers() read past, for comments()
+        self.ahead = None
+        kind, garden = self.next() or (None, None)
+        if kind != 'garden':
+            raise BadImport("The first line must be the garden")
+        self.name = self.text(garden, 'name')
+        self.author = self.text(garden, 'author')
+
+    def next(self):
+        """ Returns the type and object of the next line that isn't blank, or None at the end. """
+        if self.ahead != None:
+            line, self.ahead = self.ahead, None
+            return line
+        for raw in self.lines:
+            self.number += 1
+            if len(raw) > MAX_LINE_BYTES:
+                raise BadImport(f"Line {self.number} is longer than {MAX_LINE_BYTES} bytes")
+            if not raw.strip():
+                continue
+            try:
+                item = json.loads(raw)
+            except ValueError:
+                raise BadImport(f"Line {self.number} is not JSON") from None
+            if not isinstance(item, dict):
+                raise BadImport(f"Line {self.number} is not an object")
+            return item.get('type'), item
+        return None
+
+    def flowers(self):
+        """ Yields (color, x, y) for each flower line. """
+        while True:
+            line = self.next()
+            if line == None:
+                return
+            kind, flower = line
+            if kind != 'flower':
+                self.ahead = line
+                return
+            yield self.text(flower, 'color'), self.number_of(flower, 'x'), self.number_of(flower, 'y')
+
+    def comments(self):
+        """ Yields the content of each comment line. Anything else after the flowers is an error. """
+        for kind, comment in iter(self.next, None):
+            if kind != 'comment':
+                raise BadImport(f"Line {self.number} is not a comment, the garden comes first, then its flowers, then its comments")
+            yield self.text(comment, 'content')
+
+    def text(self, item, key):
+        value = item.get(key)
+        # Postgres text can't hold NUL
+        if not isinstance(value, str) or "\0" in value:
+            raise BadImport(f"Line {self.number} needs {key} as a string")
+        return value
+
+    def number_of(self, item, key):
+        value = item.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise BadImport(f"Line {self.number} needs {key} as a number")
+        return float(value)
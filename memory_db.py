@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+import bisect
+import copy
+import itertools
+import json
+import math
+import threading
+from contextlib import contextmanager
+
+from backend import GardensBackend, IntegrityError, OK, NOT_FOUND, FORBIDDEN, flower_point, grid_size
+from garden_export import garden_line, flower_line, comment_line
+import events
+import metrics
+
+# Side of the square cells flowers are indexed by for viewport queries, in canvas units
+CELL_SIZE = 64.0
+# Rows exports copy and imports insert per turn of the lock
+EXPORT_PAGE_SIZE = 1000
+
+
+class MemoryTables:
+    """ Rows of every table plus the secondary indexes the queries need, all guarded by one lock. """
+
+    def __init__(self):
+        # Reentrant, so a batch transaction can hold it across the calls it makes
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        # table -> {id: row}
+        self.rows = {'users': {}, 'gardens': {}, 'flowers': {}, 'comments': {}}
+        # table -> last id handed out, like a SERIAL sequence
+        self.sequences = {table: 0 for table in self.rows}
+        self.users_by_email = {}
+        # parent id -> set of child ids
+        self.gardens_by_author = {}
+        self.flowers_by_garden = {}
+        self.comments_by_garden = {}
+        # Sorted garden ids, for keyset pagination
+        self.garden_ids = []
+        # Last row version handed out, every flower and comment write takes the next one
+        self.version = 0
+        # table -> {id: version of the row's last write}
+        self.versions = {'flowers': {}, 'comments': {}}
+        # garden id -> [(version, table, id)] of its deleted flowers and comments, oldest first
+        self.tombstones = {}
+        # garden id -> {(column, row): set of flower ids}, a grid of CELL_SIZE cells over the canvas
+        self.flower_cells = {}
+
+    def snapshot(self):
+        """ Returns a deep copy of every table and index, for restore(). """
+        return copy.deepcopy({key: value for key, value in vars(self).items() if key != 'lock'})
+
+    def restore(self, state):
+        vars(self).update(state)
+
+    def insert(self, table, row):
+        """ Stores row under the next id of table and returns the id. """
+        self.sequences[table] += 1
+        id = self.sequences[table]
+        # id first, in the same column order as postgres
+        self.rows[table][id] = {'id': id, **row}
+        return id
+
+    def require(self, table, id):
+        """ Raises IntegrityError unless table has a row with id, like the foreign keys of the SQL backends. """
+        if id not in self.rows[table]:
+            raise IntegrityError(f"No row {id} in {table}")
+
+    @staticmethod
+    def cell(x, y):
+        return (math.floor(x / CELL_SIZE), math.floor(y / CELL_SIZE))
+
+    def place_flower(self, flower):
+        self.flower_cells.setdefault(flower['garden_id'], {}).setdefault(self.cell(flower['x'], flower['y']), set()).add(flower['id'])
+
+    def remove_flower(self, flower):
+        cells = self.flower_cells[flower['garden_id']]
+        key = self.cell(flower['x'], flower['y'])
+        cells[key].discard(flower['id'])
+        if not cells[key]:
+            del cells[key]
+
+    def stamp(self, table, id):
+        """ Gives a written flower or comment the next version. """
+        self.version += 1
+        self.versions[table][id] = self.version
+
+    def drop_garden(self, id):
+        """ Removes a garden with its flowers, comments and indexes, leaving no tombstones. """
+        garden = self.rows['gardens'].pop(id)
+        self.gardens_by_author[garden['author_id']].discard(id)
+        del self.garden_ids[bisect.bisect_left(self.garden_ids, id)]
+        for flower_id in self.flowers_by_garden.pop(id, ()):
+            del self.rows['flowers'][flower_id]
+            del self.versions['flowers'][flower_id]
+        for comment_id in self.comments_by_garden.pop(id, ()):
+            del self.rows['comments'][comment_id]
+            del self.versions['comments'][comment_id]
+        self.tombstones.pop(id, None)
+        self.flower_cells.pop(id, None)
+
+    def bury(self, table, id, garden_id):
+        """ Leaves a tombstone for a deleted flower or comment. """
+        self.version += 1
+        del self.versions[table][id]
+        self.tombstones.setdefault(garden_id, []).append((self.version, table, id))
+
+
+# Shared by every MemoryGardensDB in the process, so data outlives a request
+TABLES = MemoryTables()
+
+
+class MemoryGardensDB(GardensBackend):
+    """ Keeps everything in process memory. Nothing is persisted and nothing is shared between worker processes, so it suits tests and single-process development.
+    Ids are stored as ints and coordinates as floats, converting like postgres does for form values. """
+
+    def __init__(self, tables=None):
+        self.tables = tables or TABLES
+
+    def create_tables(self):
+        """ Create the tables for initial use. Will NOT drop old tables. """
+        pass
+
+    def reset(self):
+        """ Deletes ALL data. """
+        with self.tables.lock:
+            self.tables.clear()
+
+    @contextmanager
+    def batch(self, transaction=False):
+        """ With transaction the lock is held for the whole block, so nothing else sees its writes before they are all done.
+        If the block raises the tables are put back as they were before it, and its events are dropped. Copying them makes this O(data). """
+        if not transaction:
+            yield self
+            return
+        t = self.tables
+        with t.lock:
+            state = t.snapshot()
+            try:
+                with events.hold():
+                    yield self
+            except BaseException:
+                t.restore(state)
+                raise
+
+    # USERS
+    def create_user(self, first_name, last_name, email, password):
+        """ Creates a user and stores the hashed password. """
+        t = self.tables
+        with t.lock:
+            # Unique like users_email_key
+            if email in t.users_by_email:
+                raise IntegrityError(f"A user with email {email} already exists")
+            id = t.insert('users', {'first_name': first_name, 'last_name': last_name, 'email': email, 'password': password})
+            t.users_by_email[email] = id
+            return {'id': id}
+
+    def get_user(self, email):
+        """ Returns the id and password hash of the user with email, for logging in. """
+        t = self.tables
+        with t.lock:
+            user = t.rows['users'].get(t.users_by_email.get(email))
+            return {'id': user['id'], 'password': user['password']} if user != None else None
+
+    def get_user_by_id(self, uid):
+        """ Returns the user's info, without the password hash. """
+        with self.tables.lock:
+            user = self.tables.rows['users'].get(uid)
+            return {key: user[key] for key in ('id', 'first_name', 'last_name', 'email')} if user != None else None
+
+    def update_user_password(self, uid, password):
+        """ Replaces the user's hashed password. """
+        with self.tables.lock:
+            user = self.tables.rows['users'].get(uid)
+            if user != None:
+                user['password'] = password
+
+    # GARDENS
+    def create_garden(self, name, author, userid):
+        """ Creates a garden and returns the id of the created garden. """
+        t = self.tables
+        userid = int(userid)
+        with t.lock:
+            t.require('users', userid)
+            id = t.insert('gardens', {'name': name, 'author': author, 'author_id': userid})
+            t.gardens_by_author.setdefault(userid, set()).add(id)
+            # Ids only grow, so appending keeps the list sorted
+            t.garden_ids.append(id)
+            return {'id': id}
+
+    def get_gardens(self):
+        """ Returns dict of garden info. """
+        with self.tables.lock:
+            return [self.copy('gardens', id) for id in self.tables.garden_ids]
+
+    def get_gardens_page(self, limit, after=None):
+        """ Returns up to limit gardens with id > after, in id order, and the cursor for the next page (None on the last page). """
+        t = self.tables
+        with t.lock:
+            start = bisect.bisect_right(t.garden_ids, after or 0)
+            ids = t.garden_ids[start:start + limit + 1]
+            rows = [self.copy('gardens', id) for id in ids[:limit]]
+        if len(ids) > limit:
+            return rows, rows[-1]['id']
+        return rows, None
+
+    def iter_gardens(self, batch_size=500):
+        """ Yields lists of at most batch_size gardens, one page at a time so the lock isn't held while the caller writes. """
+        after = None
+        while True:
+            rows, after = self.get_gardens_page(batch_size, after)
+            if rows:
+                yield rows
+            if after == None:
+                break
+
+    def get_user_gardens(self, userid):
+        """ Returns all gardens created by a user. """
+        t = self.tables
+        with t.lock:
+            return [self.copy('gardens', id) for id in sorted(t.gardens_by_author.get(userid, ()))]
+
+    def get_one_garden(self, id):
+        """ Returns dict of specific garden info, including comments and flowers. """
+        with self.tables.lock:
+            data = self.copy('gardens', id)
+            if data != None:
+                data['comments'] = self.comments_of(id)
+                data['flowers'] = self.flowers_of(id)
+        return data
+
+    def get_one_garden_json(self, id, materialized=False):
+        """ Returns get_one_garden serialized as JSON text, or None. There is nothing to materialize in memory. """
+        data = self.get_one_garden(id)
+        if data == None:
+            return None
+        return json.dumps(data)
+
+    def get_garden_changes(self, id, since):
+        """ Returns the garden's flowers and comments written since a version, and the ids of those deleted, as JSON text, or None. """
+        t = self.tables
+        with t.lock:
+            data = self.copy('gardens', id)
+            if data == None:
+                return None
+            deleted = {'comments': [], 'flowers': []}
+            if since > 0:
+                for version, table, row_id in reversed(t.tombstones.get(id, ())):
+                    if version < since:
+                        break
+                    deleted[table].append(row_id)
+            data['version'] = t.version + 1
+            data['full'] = since == 0
+            data['comments'] = self.comments_of(id, since)
+            data['flowers'] = self.flowers_of(id, since)
+            data['deleted'] = {table: sorted(ids) for table, ids in deleted.items()}
+        return json.dumps(data)
+
+    def get_garden_owner(self, id):
+        """ Returns the author_id of a garden, or None if it doesn't exist. """
+        with self.tables.lock:
+            garden = self.tables.rows['gardens'].get(id)
+            return garden['author_id'] if garden != None else None
+
+    def update_garden(self, id, name, owner):
+        """ Renames the garden if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        with self.tables.lock:
+            garden = self.tables.rows['gardens'].get(id)
+            result = self.check_owner(garden, garden and garden['author_id'], owner)
+            if result == OK:
+                garden['name'] = name
+        if result == OK:
+            events.publish('garden_updated', id, {'name': name})
+        return result
+
+    def delete_garden(self, id, owner):
+        """ Deletes the garden, its flowers and its comments if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        t = self.tables
+        with t.lock:
+            garden = t.rows['gardens'].get(id)
+            result = self.check_owner(garden, garden and garden['author_id'], owner)
+            if result == OK:
+                t.drop_garden(id)
+        if result == OK:
+            events.publish('garden_deleted', id)
+        return result
+
+    # COMMENTS
+    def create_comment(self, garden_id, comment, user_id):
+        t = self.tables
+        garden_id = int(garden_id)
+        with t.lock:
+            t.require('gardens', garden_id)
+            t.require('users', int(user_id))
+            id = t.insert('comments', {'content': comment, 'garden_id': garden_id, 'author_id': int(user_id)})
+            t.comments_by_garden.setdefault(garden_id, set()).add(id)
+            t.stamp('comments', id)
+            author = t.rows['users'][int(user_id)]
+        events.publish('comment_added', garden_id, {'id': id, 'content': comment, 'author': author['first_name'], 'author_id': int(user_id)})
+        return {'id': id}
+
+    def get_comments(self, garden_id):
+        """ Returns all comments from the garden with {id = garden_id} """
+        with self.tables.lock:
+            return self.comments_of(garden_id)
+
+    def get_one_comment(self, id):
+        with self.tables.lock:
+            return self.copy('comments', id)
+
+    def update_comment(self, id, content, owner):
+        """ Changes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        with self.tables.lock:
+            comment = self.tables.rows['comments'].get(id)
+            result = self.check_owner(comment, comment and comment['author_id'], owner)
+            if result == OK:
+                comment['content'] = content
+                self.tables.stamp('comments', id)
+        if result == OK:
+            events.publish('comment_updated', comment['garden_id'], {'id': id, 'content': content})
+        return result, comment and comment['garden_id']
+
+    def delete_comment(self, id, owner):
+        """ Deletes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        t = self.tables
+        with t.lock:
+            comment = t.rows['comments'].get(id)
+            result = self.check_owner(comment, comment and comment['author_id'], owner)
+            if result == OK:
+                del t.rows['comments'][id]
+                t.comments_by_garden[comment['garden_id']].discard(id)
+                t.bury('comments', id, comment['garden_id'])
+        if result == OK:
+            events.publish('comment_deleted', comment['garden_id'], {'id': id})
+        return result, comment and comment['garden_id']
+
+    # FLOWERS
+    def create_flower(self, garden_id, color, x, y):
+        flower = self.insert_flowers(garden_id, [(color, x, y)])[0]
+        events.publish('flower_added', flower['garden_id'], flower)
+        return {'id': flower['id']}
+
+    def create_flowers(self, garden_id, flowers):
+        """ Inserts (color, x, y) flowers into a garden all at once. Returns the created ids in order. """
+        if not flowers:
+            return []
+        created = self.insert_flowers(garden_id, flowers)
+        events.publish('flowers_added', garden_id, created)
+        return [flower['id'] for flower in created]
+
+    def insert_flowers(self, garden_id, flowers):
+        """ Returns copies of the inserted rows. """
+        t = self.tables
+        garden_id = int(garden_id)
+        # Checked before anything is stored, a flower without a grid cell must not be left half inserted
+        points = [flower_point(x, y) for color, x, y in flowers]
+        with t.lock:
+            t.require('gardens', garden_id)
+            ids = [t.insert('flowers', {'color': color, 'x': x, 'y': y, 'garden_id': garden_id}) for (color, _, _), (x, y) in zip(flowers, points)]
+            t.flowers_by_garden.setdefault(garden_id, set()).update(ids)
+            for id in ids:
+                t.stamp('flowers', id)
+                t.place_flower(t.rows['flowers'][id])
+            return [self.copy('flowers', id) for id in ids]
+
+    def get_flowers(self, garden_id):
+        """ Returns all flowers from the garden with {id = garden_id} """
+        with self.tables.lock:
+            return self.flowers_of(garden_id)
+
+    def get_flowers_in_box(self, garden_id, x0, y0, x1, y1, limit=None):
+        """ Returns the garden's flowers inside the box in id order, and whether they were sampled down to about limit.
+        Only the grid cells the box overlaps are visited. """
+        t = self.tables
+        with t.lock:
+            cells = t.flower_cells.get(garden_id, {})
+            (c0, r0), (c1, r1) = t.cell(x0, y0), t.cell(x1, y1)
+            if (c1 - c0 + 1) * (r1 - r0 + 1) <= len(cells):
+                candidates = [cells.get((c, r), ()) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)]
+            else:
+                # The box spans more cells than the garden has flowers in, going through those is cheaper
+                candidates = [ids for (c, r), ids in cells.items() if c0 <= c <= c1 and r0 <= r <= r1]
+            flowers = []
+            for ids in candidates:
+                for id in ids:
+                    flower = t.rows['flowers'][id]
+                    if x0 <= flower['x'] <= x1 and y0 <= flower['y'] <= y1:
+                        flowers.append(dict(flower))
+        flowers.sort(key=lambda flower: flower['id'])
+        if not limit or len(flowers) <= limit:
+            return flowers, False
+        return sample_grid(flowers, x0, y0, x1, y1, grid_size(limit)), True
+
+    def get_one_flower(self, id):
+        with self.tables.lock:
+            return self.copy('flowers', id)
+
+    def delete_flower(self, id, owner):
+        """ Deletes the flower if owner wrote its garden. Returns (OK, NOT_FOUND or FORBIDDEN, the flower's garden id). """
+        t = self.tables
+        with t.lock:
+            flower = t.rows['flowers'].get(id)
+            garden_id = flower and flower['garden_id']
+            result = self.check_owner(flower, self.garden_author(garden_id), owner)
+            if result == OK:
+                del t.rows['flowers'][id]
+                t.flowers_by_garden[garden_id].discard(id)
+                t.remove_flower(flower)
+                t.bury('flowers', id, garden_id)
+        if result == OK:
+            events.publish('flower_deleted', garden_id, {'id': id})
+        return result, garden_id
+
+    # EXPORT
+    def export_garden(self, id, write):
+        """ Copies a page of rows at a time under the lock and writes them after letting go of it, so a slow client holds nothing up.
+        Rows deleted while the export runs are left out. """
+        t = self.tables
+        with t.lock:
+            garden = self.copy('gardens', id)
+            if garden == None:
+                return
+            flower_ids = sorted(t.flowers_by_garden.get(id, ()))
+            comment_ids = sorted(t.comments_by_garden.get(id, ()))
+        write(garden_line(garden))
+        for start in range(0, len(flower_ids), EXPORT_PAGE_SIZE):
+            with t.lock:
+                flowers = [self.copy('flowers', flower_id) for flower_id in flower_ids[start:start + EXPORT_PAGE_SIZE]]
+            write(b"".join(flower_line(flower) for flower in flowers if flower != None))
+        for start in range(0, len(comment_ids), EXPORT_PAGE_SIZE):
+            with t.lock:
+                comments = [self.comment_of(comment_id) for comment_id in comment_ids[start:start + EXPORT_PAGE_SIZE]]
+            write(b"".join(comment_line(comment) for comment in comments if comment != None))
+
+    def import_garden(self, garden, userid):
+        """ Inserts a page of rows at a time, so the lock isn't held while the body is read. Other requests can see the garden
+        before it is complete. If the export turns out broken the garden is dropped again, without events. """
+        t = self.tables
+        userid = int(userid)
+        id = self.create_garden(garden.name, garden.author, userid)['id']
+        flowers = comments = 0
+        try:
+            for page in pages(garden.flowers(), EXPORT_PAGE_SIZE):
+                flowers += len(self.insert_flowers(id, page))
+            for page in pages(garden.comments(), EXPORT_PAGE_SIZE):
+                with t.lock:
+                    for content in page:
+                        comment_id = t.insert('comments', {'content': content, 'garden_id': id, 'author_id': userid})
+                        t.comments_by_garden.setdefault(id, set()).add(comment_id)
+                        t.stamp('comments', comment_id)
+                comments += len(page)
+        except BaseException:
+            with t.lock:
+                t.drop_garden(id)
+            raise
+        return {'id': id, 'flowers': flowers, 'comments': comments}
+
+    # Helpers below expect the lock to be held
+    def copy(self, table, id):
+        """ Returns a copy of a row, so callers can't change the stored one. """
+        row = self.tables.rows[table].get(id)
+        return dict(row) if row != None else None
+
+    def garden_author(self, garden_id):
+        garden = self.tables.rows['gardens'].get(garden_id)
+        return garden['author_id'] if garden != None else None
+
+    def comments_of(self, garden_id, since=0):
+        t = self.tables
+        comments = []
+        for id in sorted(t.comments_by_garden.get(garden_id, ())):
+            if since and t.versions['comments'][id] < since:
+                continue
+            comment = self.comment_of(id)
+            if comment != None:
+                comments.append(comment)
+        return comments
+
+    def comment_of(self, id):
+        """ Returns the comment with its author's first name, like get_comments, or None if it or its author is gone. """
+        t = self.tables
+        comment = t.rows['comments'].get(id)
+        author = comment and t.rows['users'].get(comment['author_id'])
+        if author == None:
+            return None
+        return {'id': id, 'content': comment['content'], 'author': author['first_name'], 'author_id': comment['author_id']}
+
+    def flowers_of(self, garden_id, since=0):
+        t = self.tables
+        return [self.copy('flowers', id) for id in sorted(t.flowers_by_garden.get(garden_id, ())) if not since or t.versions['flowers'][id] >= since]
+
+    @staticmethod
+    def check_owner(row, author_id, owner):
+        if row == None:
+            return NOT_FOUND
+        if author_id != owner:
+            return FORBIDDEN
+        return OK
+
+
+def grid_cell(value, low, high, n):
+    """ Column or row of value in a grid of n cells from low to high. A grid with no width is one cell. """
+    if high == low:
+        return None
+    return min(math.floor((value - low) * n / (high - low)), n - 1)
+
+
+def sample_grid(flowers, x0, y0, x1, y1, n):
+    """ Keeps the first flower of each cell of an n by n grid over the box, like postgres' get_flowers_in_box_sample. """
+    seen = set()
+    kept = []
+    for flower in flowers:
+        cell = (grid_cell(flower['x'], x0, x1, n), grid_cell(flower['y'], y0, y1, n))
+        if cell not in seen:
+            seen.add(cell)
+            kept.append(flower)
+    return kept
+
+
+def pages(rows, size):
+    """ Yields lists of at most size items from the iterator rows. """
+    rows = iter(rows)
+    while True:
+        page = list(itertools.islice(rows, size))
+        if not page:
+            return
+        yield page
+
+
+# Record call counts, durations and rows for every backend method, under the same names as postgres
+metrics.instrument(MemoryGardensDB, metrics.REGISTRY, "gardens_db", skip={'batch', 'insert_flowers', 'copy', 'garden_author', 'comments_of', 'comment_of', 'flowers_of', 'check_owner'})
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import functools
+import inspect
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Shards kept before the ones of exited threads are folded in, grown to twice the live ones after each fold
+MIN_PRUNE_SHARDS = 64
+
+
+class Shard:
+    """ Counters and histograms written by a single thread, so recording never takes a lock. """
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., sum, count]
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            mine = self.histograms.get(key)
+            if mine == None:
+                self.histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    mine[i] += value
+
+
+class Registry:
+    """ Collects metrics and renders them in the Prometheus text format.
+    Each thread records into its own shard; shards are only summed when rendering. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (thread, shard) for every thread that recorded something
+        self.shards = []
+        # Totals of threads that have exited
+        self.retired = Shard()
+        # Shard count at which new shards prune the exited threads' ones
+        self.prune_at = MIN_PRUNE_SHARDS
+        # name -> (type, help)
+        self.descriptions = {}
+        # name -> (help, function returning {labels: value})
+        self.gauges = {}
+
+    def describe(self, name, kind, help):
+        self.descriptions[name] = (kind, help)
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard == None:
+            shard = Shard()
+            self.local.shard = shard
+            with self.lock:
+                # With a thread per connection, threads come and go between scrapes
+                if len(self.shards) >= self.prune_at:
+                    self.prune()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def prune(self):
+        """ Folds the shards of exited threads into the retired totals. Expects the lock to be held. """
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+        self.shards = alive
+        self.prune_at = max(MIN_PRUNE_SHARDS, 2 * len(alive))
+
+    def inc(self, name, labels=(), value=1):
+        """ Adds to a counter. labels is a tuple of (label, value) pairs. """
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """ Records one value in a histogram. """
+        histograms = self.shard().histograms
+        key = (name, labels)
+        values = histograms.get(key)
+        if values == None:
+            values = [0] * (len(BUCKETS) + 2)
+            histograms[key] = values
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                values[i] += 1
+                break
+        values[-2] += value
+        values[-1] += 1
+
+    def gauge(self, name, help, fn):
+        """ Registers a gauge read when rendering. fn returns {labels: value}. """
+        self.gauges[name] = (help, fn)
+
+    def collect(self):
+        """ Sums every shard. Shards of exited threads are folded into the retired totals. """
+        total = Shard()
+        with self.lock:
+            self.prune()
+            total.merge(self.retired)
+            for _, shard in self.shards:
+                total.merge(shard)
+        return total
+
+    def render(self):
+        total = self.collect()
+        lines = []
+        seen = set()
+
+        def header(name, default_kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, help = self.descriptions.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(total.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), values in sorted(total.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, values):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+
+        for name, (help, fn) in sorted(self.gauges.items()):
+            try:
+                values = fn()
+            except Exception:
+                # A broken gauge shouldn't take the whole endpoint down
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values.items():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def count_rows(result):
+    if result == None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def instrument(cls, registry, prefix, skip=()):
+    """ Wraps every public method of cls to record call counts, durations and rows returned, labelled by method name. """
+    registry.describe(f"{prefix}_queries_total", "counter", "Database method calls")
+    registry.describe(f"{prefix}_query_seconds", "histogram", "Database method duration")
+    registry.describe(f"{prefix}_rows_total", "counter", "Rows returned by database methods")
+    registry.describe(f"{prefix}_errors_total", "counter", "Database method calls that raised")
+
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or name in skip or not callable(method):
+            continue
+        if inspect.isgeneratorfunction(method):
+            setattr(cls, name, timed_generator(method, registry, prefix, name))
+        else:
+            setattr(cls, name, timed(method, registry, prefix, name))
+    return cls
+
+
+def timed(method, registry, prefix, name):
+    labels = (("method", name),)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            registry.inc(f"{prefix}_errors_total", labels)
+            raise
+        finally:
+            registry.observe(f"{prefix}_query_seconds", labels, time.perf_counter() - start)
+            registry.inc(f"{prefix}_queries_total", labels)
+        registry.inc(f"{prefix}_rows_total", labels, count_rows(result))
+        return result
+    return wrapper
+
+
+def timed_generator(method, registry, prefix, name):
+    """ Like timed, for methods that yield batches of rows. Time spent by the caller between batches is not counted. """
+    labels = (("method", name),)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        registry.inc(f"{prefix}_queries_total", labels)
+        elapsed = 0.0
+        generator = method(*args, **kwargs)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    rows = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                registry.inc(f"{prefix}_rows_total", labels, count_rows(rows))
+                yield rows
+        finally:
+            generator.close()
+            registry.observe(f"{prefix}_query_seconds", labels, elapsed)
+    return wrapper
+
+
+REGISTRY = Registry()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+""" Versioned schema migrations for the gardens database.
+
+Usage:
+    migrate.py [up]              apply pending migrations
+    migrate.py status            list applied and pending migrations
+    migrate.py check [min_rows]  EXPLAIN every GardensDB read query and fail on seq scans of large tables
+"""
+
+import os
+import re
+import sys
+import json
+import time
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Migrations starting with this line run outside a transaction, one statement at a time.
+# Needed for CREATE INDEX CONCURRENTLY.
+NO_TRANSACTION = "-- migrate: no-transaction"
+
+# Arbitrary key so concurrently starting processes don't apply the same migration twice
+LOCK_ID = 7400113
+# Seconds between attempts to take the migration lock
+LOCK_POLL_SECONDS = 0.5
+
+# CREATE [UNIQUE] INDEX CONCURRENTLY IF NOT EXISTS name ON table [USING method] (columns)
+CONCURRENT_INDEX = re.compile(
+    r"^CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+ON\s+(\w+)\s*(?:USING\s+\w+\s*)?\((.*)\)$",
+    re.IGNORECASE | re.DOTALL)
+
+# Tables with fewer (estimated) rows than this may be seq scanned by `check`
+CHECK_MIN_ROWS = 10000
+
+# Queries that intentionally read the whole table
+ALLOW_SEQ_SCAN = {'get_gardens'}
+
+# Parameters used when explaining queries that aren't just looked up by integer id
+SAMPLE_PARAMS = {
+    'get_user': ['nobody@example.com'],
+    'get_gardens_page': [0, 50],
+    'get_flowers_in_box': [1, 0, 0, 100, 100, 1000],
+    'get_flowers_in_box_sample': {'garden_id': 1, 'x0': 0, 'y0': 0, 'x1': 100, 'y1': 100, 'n': 30},
+}
+
+
+class MigrationError(Exception):
+    """ A migration can't be applied as the data stands. Nothing is recorded, fix the cause and run it again. """
+
+
+def load_migrations():
+    """ Returns (version, name, sql) for every migration file in order. Files are named NNNN_description.sql """
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r"^(\d+)_(.+)\.sql$", filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), "r") as f:
+            migrations.append((int(match.group(1)), match.group(2), f.read()))
+    return migrations
+
+
+def split_statements(sql):
+    """ Splits a migration into single statements. Only used for no-transaction migrations, which must stay simple. """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [s.strip() for s in "\n".join(lines).split(";") if s.strip()]
+
+
+def applied_versions(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations ( \
+        version INTEGER PRIMARY KEY, \
+        name TEXT NOT NULL, \
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row['version'] for row in cursor.fetchall()}
+
+
+def apply(cursor, version, name, sql):
+    """ Applies one migration and records its version. """
+    if sql.lstrip().startswith(NO_TRANSACTION):
+        # Every statement here must be idempotent (IF NOT EXISTS), since a failure part way can't be rolled back
+        for statement in split_statements(sql):
+            match = CONCURRENT_INDEX.match(statement)
+            if match:
+                build_index(cursor, statement, *match.groups())
+            else:
+                cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", [version, name])
+    else:
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", [version, name])
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+
+def index_valid(cursor, name):
+    """ Returns whether the index is usable, or None if it doesn't exist. """
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [name])
+    row = cursor.fetchone()
+    return row['indisvalid'] if row != None else None
+
+
+def build_index(cursor, statement, unique, name, table, columns):
+    """ Runs a CREATE INDEX CONCURRENTLY IF NOT EXISTS so that a failed build can't pass for a finished one.
+    A failed build leaves an INVALID index behind, which IF NOT EXISTS would skip on the next run. It is dropped and built again. """
+    valid = index_valid(cursor, name)
+    if valid:
+        return
+    if valid == False:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    if unique:
+        cursor.execute(f"SELECT {columns}, count(*) AS copies FROM {table} GROUP BY {columns} HAVING count(*) > 1 LIMIT 5")
+        duplicates = cursor.fetchall()
+        if duplicates:
+            raise MigrationError(f"Can't build unique index {name}, {table} has duplicate ({columns}): "
+                + ", ".join(str({key: value for key, value in row.items() if key != 'copies'}) for row in duplicates))
+    try:
+        cursor.execute(statement)
+    except Exception:
+        # Duplicates written while it was being built, or a cancelled build
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        raise
+    if not index_valid(cursor, name):
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        raise MigrationError(f"Index {name} was left invalid, run the migration again")
+
+
+def lock(cursor):
+    """ Takes the migration lock by polling. A process blocked inside pg_advisory_lock would hold a snapshot for as long as it waits,
+    and CREATE INDEX CONCURRENTLY waits for every older snapshot to go away, so the build would wait on the waiter forever.
+    Between attempts the waiter is idle and holds no snapshot. """
+    while True:
+        cursor.execute("SELECT pg_try_advisory_lock(%s) AS locked", [LOCK_ID])
+        if cursor.fetchone()['locked']:
+            return
+        time.sleep(LOCK_POLL_SECONDS)
+
+
+def migrate(db, verbose=False):
+    """ Applies every pending migration in version order. Returns the list of versions applied. """
+    done = []
+    with db.cursor() as cursor:
+        lock(cursor)
+        try:
+            applied = applied_versions(cursor)
+            for version, name, sql in load_migrations():
+                if version in applied:
+                    continue
+                if verbose:
+                    print(f"Applying {version:04d}_{name}")
+                apply(cursor, version, name, sql)
+                done.append(version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [LOCK_ID])
+    return done
+
+
+def status(db):
+    with db.cursor() as cursor:
+        applied = applied_versions(cursor)
+    for version, name, _ in load_migrations():
+        state = "applied" if version in applied else "pending"
+        print(f"{version:04d}_{name}: {state}")
+
+
+def seq_scans(plan):
+    """ Yields the relation name of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan. """
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+def check(db, min_rows=CHECK_MIN_ROWS):
+    """ EXPLAINs every GardensDB read query. Returns a list of (query name, table) for seq scans of large tables. """
+    from garden_db import QUERIES
+
+    failures = []
+    with db.cursor() as cursor:
+        cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+        sizes = {row['relname']: row['reltuples'] for row in cursor.fetchall()}
+
+        for name, sql in QUERIES.items():
+            if name in ALLOW_SEQ_SCAN:
+                continue
+            params = SAMPLE_PARAMS.get(name, [1] * sql.count("%s"))
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()["QUERY PLAN"]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            for table in seq_scans(plan[0]["Plan"]):
+                if sizes.get(table, 0) >= min_rows:
+                    failures.append((name, table))
+    return failures
+
+
+def main(args):
+    from garden_db import GardensDB
+
+    command = args[0] if args else "up"
+    db = GardensDB()
+    if command == "up":
+        try:
+            applied = migrate(db, verbose=True)
+        except MigrationError as error:
+            print(error)
+            return 1
+        print(f"Applied {len(applied)} migration(s)")
+    elif command == "status":
+        status(db)
+    elif command == "check":
+        min_rows = int(args[1]) if len(args) > 1 else CHECK_MIN_ROWS
+        failures = check(db, min_rows)
+        for name, table in failures:
+            print(f"{name}: sequential scan on {table}")
+        if failures:
+            return 1
+        print("No sequential scans on large tables")
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+-- Indexes for the foreign keys and lookups on the request hot path.
+-- Built CONCURRENTLY so they can be added to a live database without blocking writes.
+-- migrate.py refuses the unique index while users has duplicate emails, and rebuilds any index a failed build left invalid.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS gardens_author_id_idx ON gardens (author_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flowers_garden_id_idx ON flowers (garden_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_garden_id_idx ON comments (garden_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_author_id_idx ON comments (author_id);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_key ON users (email);
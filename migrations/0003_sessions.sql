@@ -0,0 +1,9 @@
+-- Sessions shared by every server process. UNLOGGED because losing them on a crash only logs people out.
+CREATE UNLOGGED TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS sessions_last_seen_idx ON sessions (last_seen);
@@ -0,0 +1,124 @@
+-- Builds a full garden (including comments and flowers) as one JSON document. NULL if the garden doesn't exist.
+CREATE OR REPLACE FUNCTION build_garden_document(gid INTEGER) RETURNS json AS $$
+    SELECT json_build_object(
+        'id', g.id,
+        'name', g.name,
+        'author', g.author,
+        'author_id', g.author_id,
+        'comments', COALESCE((
+            SELECT json_agg(json_build_object('id', c.id, 'content', c.content, 'author', u.first_name, 'author_id', c.author_id) ORDER BY c.id)
+            FROM comments c INNER JOIN users u ON u.id = c.author_id
+            WHERE c.garden_id = g.id
+        ), '[]'::json),
+        'flowers', COALESCE((
+            SELECT json_agg(json_build_object('id', f.id, 'color', f.color, 'x', f.x, 'y', f.y, 'garden_id', f.garden_id) ORDER BY f.id)
+            FROM flowers f
+            WHERE f.garden_id = g.id
+        ), '[]'::json)
+    )
+    FROM gardens g
+    WHERE g.id = gid
+$$ LANGUAGE sql STABLE;
+
+-- Prebuilt garden documents, kept current by the triggers below once they are enabled (see garden_documents.py).
+CREATE TABLE IF NOT EXISTS garden_documents (
+    garden_id INTEGER PRIMARY KEY,
+    doc JSON NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    CONSTRAINT fk_garden_documents_gardens
+        FOREIGN KEY (garden_id)
+        REFERENCES gardens(id)
+        ON DELETE CASCADE
+);
+
+CREATE OR REPLACE FUNCTION refresh_garden_document(gid INTEGER) RETURNS void AS $$
+BEGIN
+    -- Serialize refreshes of one garden. Each statement below takes a new snapshot, so the rebuild sees every committed change.
+    PERFORM 1 FROM garden_documents WHERE garden_id = gid FOR UPDATE;
+    IF NOT EXISTS (SELECT 1 FROM gardens WHERE id = gid) THEN
+        DELETE FROM garden_documents WHERE garden_id = gid;
+        RETURN;
+    END IF;
+    INSERT INTO garden_documents (garden_id, doc) VALUES (gid, build_garden_document(gid))
+    ON CONFLICT (garden_id) DO UPDATE
+    SET doc = EXCLUDED.doc, version = garden_documents.version + 1, updated_at = now();
+END
+$$ LANGUAGE plpgsql;
+
+-- Statement level triggers for flowers and comments, so a bulk insert rebuilds each garden once instead of once per row.
+CREATE OR REPLACE FUNCTION garden_documents_inserted() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_garden_document(gid) FROM (SELECT DISTINCT garden_id AS gid FROM new_rows) changed;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION garden_documents_updated() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_garden_document(gid) FROM (
+        SELECT garden_id AS gid FROM new_rows UNION SELECT garden_id FROM old_rows
+    ) changed;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION garden_documents_deleted() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_garden_document(gid) FROM (SELECT DISTINCT garden_id AS gid FROM old_rows) changed;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION garden_documents_garden_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_garden_document(NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Comments show their author's first name
+CREATE OR REPLACE FUNCTION garden_documents_user_renamed() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_garden_document(gid) FROM (SELECT DISTINCT garden_id AS gid FROM comments WHERE author_id = NEW.id) changed;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS flowers_documents_insert ON flowers;
+CREATE TRIGGER flowers_documents_insert AFTER INSERT ON flowers
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_inserted();
+DROP TRIGGER IF EXISTS flowers_documents_update ON flowers;
+CREATE TRIGGER flowers_documents_update AFTER UPDATE ON flowers
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_updated();
+DROP TRIGGER IF EXISTS flowers_documents_delete ON flowers;
+CREATE TRIGGER flowers_documents_delete AFTER DELETE ON flowers
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_deleted();
+
+DROP TRIGGER IF EXISTS comments_documents_insert ON comments;
+CREATE TRIGGER comments_documents_insert AFTER INSERT ON comments
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_inserted();
+DROP TRIGGER IF EXISTS comments_documents_update ON comments;
+CREATE TRIGGER comments_documents_update AFTER UPDATE ON comments
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_updated();
+DROP TRIGGER IF EXISTS comments_documents_delete ON comments;
+CREATE TRIGGER comments_documents_delete AFTER DELETE ON comments
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE garden_documents_deleted();
+
+DROP TRIGGER IF EXISTS gardens_documents_change ON gardens;
+CREATE TRIGGER gardens_documents_change AFTER INSERT OR UPDATE ON gardens
+    FOR EACH ROW EXECUTE PROCEDURE garden_documents_garden_changed();
+
+DROP TRIGGER IF EXISTS users_documents_rename ON users;
+CREATE TRIGGER users_documents_rename AFTER UPDATE OF first_name ON users
+    FOR EACH ROW WHEN (OLD.first_name IS DISTINCT FROM NEW.first_name) EXECUTE PROCEDURE garden_documents_user_renamed();
+
+-- Off until `garden_documents.py enable` backfills the table
+ALTER TABLE flowers DISABLE TRIGGER flowers_documents_insert;
+ALTER TABLE flowers DISABLE TRIGGER flowers_documents_update;
+ALTER TABLE flowers DISABLE TRIGGER flowers_documents_delete;
+ALTER TABLE comments DISABLE TRIGGER comments_documents_insert;
+ALTER TABLE comments DISABLE TRIGGER comments_documents_update;
+ALTER TABLE comments DISABLE TRIGGER comments_documents_delete;
+ALTER TABLE gardens DISABLE TRIGGER gardens_documents_change;
+ALTER TABLE users DISABLE TRIGGER users_documents_rename;
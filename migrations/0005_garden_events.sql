@@ -0,0 +1,12 @@
+-- Publishes a garden change to the server processes LISTENing on garden_events (see events.py).
+-- NOTIFY payloads must stay under 8000 bytes. Past that the data is left out and subscribers refetch the garden.
+CREATE OR REPLACE FUNCTION notify_garden_event(kind TEXT, gid INTEGER, data JSON) RETURNS void AS $$
+DECLARE
+    payload TEXT := json_build_object('type', kind, 'garden_id', gid, 'data', data)::text;
+BEGIN
+    IF octet_length(payload) >= 8000 THEN
+        payload := json_build_object('type', kind, 'garden_id', gid, 'data', NULL)::text;
+    END IF;
+    PERFORM pg_notify('garden_events', payload);
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,116 @@
+-- Row versions and tombstones for GET /gardens/<id>?since=<version>.
+-- A row's version is the id of the transaction that last wrote it. A reader's next `since` is the oldest transaction still
+-- running when it read (txid_snapshot_xmin), so rows committed later by older transactions are never skipped, only sent twice.
+
+-- Constant default first so existing rows aren't rewritten, they count as written before any sync
+ALTER TABLE flowers ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE flowers ALTER COLUMN version SET DEFAULT txid_current();
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE comments ALTER COLUMN version SET DEFAULT txid_current();
+
+-- Flowers and comments deleted from gardens that still exist. Removed along with their garden.
+CREATE TABLE IF NOT EXISTS garden_tombstones (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    garden_id INTEGER NOT NULL,
+    version BIGINT NOT NULL DEFAULT txid_current(),
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, id),
+    CONSTRAINT fk_garden_tombstones_gardens
+        FOREIGN KEY (garden_id)
+        REFERENCES gardens(id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS garden_tombstones_garden_id_version_idx ON garden_tombstones (garden_id, version);
+
+-- Tombstones older than this version were pruned. A sync from before it gets the whole garden instead.
+CREATE TABLE IF NOT EXISTS garden_sync_horizon (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL
+);
+INSERT INTO garden_sync_horizon (version) VALUES (0) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION set_row_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_garden_tombstones() RETURNS trigger AS $$
+BEGIN
+    -- Rows deleted along with their garden need none, the client gets a 404 for the whole garden
+    INSERT INTO garden_tombstones (kind, id, garden_id)
+    SELECT TG_TABLE_NAME, o.id, o.garden_id FROM old_rows o
+    WHERE EXISTS (SELECT 1 FROM gardens g WHERE g.id = o.garden_id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS flowers_version_update ON flowers;
+CREATE TRIGGER flowers_version_update BEFORE UPDATE ON flowers
+    FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+DROP TRIGGER IF EXISTS comments_version_update ON comments;
+CREATE TRIGGER comments_version_update BEFORE UPDATE ON comments
+    FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+
+DROP TRIGGER IF EXISTS flowers_tombstones_delete ON flowers;
+CREATE TRIGGER flowers_tombstones_delete AFTER DELETE ON flowers
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE record_garden_tombstones();
+DROP TRIGGER IF EXISTS comments_tombstones_delete ON comments;
+CREATE TRIGGER comments_tombstones_delete AFTER DELETE ON comments
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE record_garden_tombstones();
+
+-- Deletes tombstones older than keep and moves the horizon past them. Returns how many were deleted.
+-- Run it periodically, e.g. SELECT prune_garden_tombstones('30 days').
+CREATE OR REPLACE FUNCTION prune_garden_tombstones(keep INTERVAL) RETURNS bigint AS $$
+DECLARE
+    pruned BIGINT;
+    newest BIGINT;
+BEGIN
+    WITH deleted AS (DELETE FROM garden_tombstones WHERE deleted_at < now() - keep RETURNING version)
+    SELECT count(*), max(version) INTO pruned, newest FROM deleted;
+    IF newest IS NOT NULL THEN
+        UPDATE garden_sync_horizon SET version = greatest(version, newest + 1);
+    END IF;
+    RETURN pruned;
+END
+$$ LANGUAGE plpgsql;
+
+-- The flowers and comments of a garden written at or after version since, and the ids of those deleted, as one JSON document.
+-- With since 0, or from before the horizon, it has every flower and comment and "full" is true. NULL if the garden doesn't exist.
+CREATE OR REPLACE FUNCTION build_garden_changes(gid INTEGER, since BIGINT) RETURNS json AS $$
+    SELECT json_build_object(
+        'id', g.id,
+        'name', g.name,
+        'author', g.author,
+        'author_id', g.author_id,
+        'version', txid_snapshot_xmin(txid_current_snapshot()),
+        'full', s.since = 0,
+        'comments', COALESCE((
+            SELECT json_agg(json_build_object('id', c.id, 'content', c.content, 'author', u.first_name, 'author_id', c.author_id) ORDER BY c.id)
+            FROM comments c INNER JOIN users u ON u.id = c.author_id
+            WHERE c.garden_id = g.id AND c.version >= s.since
+        ), '[]'::json),
+        'flowers', COALESCE((
+            SELECT json_agg(json_build_object('id', f.id, 'color', f.color, 'x', f.x, 'y', f.y, 'garden_id', f.garden_id) ORDER BY f.id)
+            FROM flowers f
+            WHERE f.garden_id = g.id AND f.version >= s.since
+        ), '[]'::json),
+        'deleted', json_build_object(
+            'comments', COALESCE((
+                SELECT json_agg(t.id ORDER BY t.id) FROM garden_tombstones t
+                WHERE t.garden_id = g.id AND t.kind = 'comments' AND t.version >= s.since AND s.since > 0
+            ), '[]'::json),
+            'flowers', COALESCE((
+                SELECT json_agg(t.id ORDER BY t.id) FROM garden_tombstones t
+                WHERE t.garden_id = g.id AND t.kind = 'flowers' AND t.version >= s.since AND s.since > 0
+            ), '[]'::json)
+        )
+    )
+    FROM gardens g, (
+        SELECT CASE WHEN since < COALESCE((SELECT version FROM garden_sync_horizon), 0) THEN 0 ELSE since END AS since
+    ) s
+    WHERE g.id = gid
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- Lets a delta sync read only a garden's changed rows instead of filtering all of them.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flowers_garden_id_version_idx ON flowers (garden_id, version);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_garden_id_version_idx ON comments (garden_id, version);
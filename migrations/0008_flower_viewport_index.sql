@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- Spatial index for viewport queries, the flowers of one garden inside a box.
+-- btree_gist lets the garden id share a GiST index with the point, so other gardens' flowers in the same box are never visited.
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flowers_garden_id_point_idx ON flowers USING gist (garden_id, point(x, y));
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from passlib.hash import bcrypt
+
+
+class HasherBusy(Exception):
+    """ Raised when too many password operations are already queued. """
+    pass
+
+
+def hash_password(password, rounds):
+    return bcrypt.using(rounds=rounds).hash(password)
+
+
+def verify_password(password, hashed, rounds):
+    """ Returns (matches, new hash). The new hash is only set when the password matched but was hashed with a different cost. """
+    handler = bcrypt.using(rounds=rounds)
+    if not handler.verify(password, hashed):
+        return False, None
+    if handler.needs_update(hashed):
+        return True, handler.hash(password)
+    return True, None
+
+
+class PasswordHasher:
+    """ Runs bcrypt in a pool of processes so it doesn't hold the GIL on request threads.
+    At most queue_limit operations may be pending at once, past that calls fail fast with HasherBusy.
+    Operations still count while running after their caller timed out. """
+
+    def __init__(self, rounds=12, workers=None, queue_limit=None, timeout=30.0):
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_limit = queue_limit or self.workers * 4
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def get_executor(self):
+        """ Starts the process pool on first use, and again in a forked worker, which can't use its parent's pool. """
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.queue_limit:
+                self.rejected += 1
+                raise HasherBusy()
+            self.pending += 1
+        start = time.monotonic()
+        try:
+            future = self.get_executor().submit(fn, *args)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+        # The slot is given back when the job is done, not when the caller stops waiting, since a timed out job still holds a process
+        future.add_done_callback(lambda future: self.finished(future, start))
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # Drops the job if it hasn't started yet, a running one frees its slot once it finishes
+            future.cancel()
+            raise HasherBusy()
+
+    def finished(self, future, start):
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.pending -= 1
+            if not future.cancelled():
+                self.completed += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+
+    def close(self):
+        """ Stops the process pool. Its processes would otherwise outlive the server, holding on to its listening socket. """
+        with self.lock:
+            executor = self.executor if self.pid == os.getpid() else None
+            self.executor = None
+        if executor != None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def hash(self, password):
+        """ Returns the bcrypt hash of password at the configured cost. """
+        return self.run(hash_password, password, self.rounds)
+
+    def verify(self, password, hashed):
+        """ Returns (matches, new hash). A new hash is returned when the stored one uses a different cost and should be replaced. """
+        matches, new_hash = self.run(verify_password, password, hashed, self.rounds)
+        if new_hash != None:
+            with self.lock:
+                self.rehashed += 1
+        return matches, new_hash
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rounds': self.rounds,
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'rehashed': self.rehashed,
+                'latency_total': self.latency_total,
+                'latency_max': self.latency_max,
+                'latency_avg': self.latency_total / self.completed if self.completed else 0.0,
+            }
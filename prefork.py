@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class PreforkMaster:
+    """ Runs an already bound server in several forked worker processes sharing its listening socket.
+
+    The master only supervises:
+    * workers that die are respawned
+    * SIGHUP replaces the workers one at a time (rolling restart)
+    * SIGTERM/SIGINT drains every worker and exits
+    """
+
+    # Seconds a worker gets to finish its in-flight requests before it is killed
+    GRACE_PERIOD = 30
+    # How often the master checks on its workers
+    POLL_INTERVAL = 0.5
+    # Workers dying faster than this after starting are respawned with a delay, to avoid spinning
+    MIN_LIFETIME = 1.0
+
+    def __init__(self, server, workers, before_fork=None, after_fork=None, before_exit=None):
+        self.server = server
+        self.workers = workers
+        # Called in the master before each fork, e.g. to close connections the child must not share
+        self.before_fork = before_fork
+        # Called in each worker right after it starts
+        self.after_fork = after_fork
+        # Called in each worker once it stopped serving, e.g. to stop its own child processes
+        self.before_exit = before_exit
+        # pid -> start time
+        self.children = {}
+        self.stopping = False
+        self.reload = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reload:
+                self.reload = False
+                self.rolling_restart()
+            self.reap()
+            time.sleep(self.POLL_INTERVAL)
+
+        self.stop_all()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload = True
+
+    def spawn(self):
+        """ Forks a new worker. """
+        if self.before_fork:
+            self.before_fork()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.worker()
+            except BaseException:
+                code = 1
+                import traceback
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        print(f"Started worker {pid}")
+        return pid
+
+    def worker(self):
+        """ Body of a worker process. Serves until SIGTERM, then finishes in-flight requests. """
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # shutdown() waits for serve_forever to return, so it can't run in the signal handler on the serving thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=self.server.shutdown).start())
+        if self.after_fork:
+            self.after_fork()
+        self.server.serve_forever()
+        # Joins the request threads that are still running
+        self.server.server_close()
+        if self.before_exit:
+            self.before_exit()
+
+    def reap(self):
+        """ Collects exited workers and replaces them. """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started == None or self.stopping:
+                continue
+            print(f"Worker {pid} exited with status {status}, respawning")
+            if time.monotonic() - started < self.MIN_LIFETIME:
+                time.sleep(self.MIN_LIFETIME)
+            self.spawn()
+
+    def wait(self, pid, timeout):
+        """ Waits for one worker to exit, killing it after timeout seconds. """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if done == pid:
+                break
+            time.sleep(0.1)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.pop(pid, None)
+
+    def rolling_restart(self):
+        """ Starts a replacement for each worker before draining the old one, so there is always capacity. """
+        print("Rolling restart")
+        for pid in list(self.children):
+            self.spawn()
+            os.kill(pid, signal.SIGTERM)
+            self.wait(pid, self.GRACE_PERIOD)
+
+    def stop_all(self):
+        """ Drains every worker and waits for them to exit. """
+        print("Stopping workers")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.GRACE_PERIOD
+        for pid in list(self.children):
+            self.wait(pid, max(0, deadline - time.monotonic()))
+        self.server.server_close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from compression import compress
+
+
+class CacheEntry:
+    """ A serialized response body and its strong ETag. Compressed variants are kept next to it once made. """
+
+    def __init__(self, body, headers=None):
+        self.body = body
+        # Extra response headers that belong with the body, like a Link to the next page
+        self.headers = headers or {}
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.stored_at = time.monotonic()
+        # encoding -> compressed body
+        self.variants = {}
+        self.cached = False
+
+    def variant_etag(self, encoding):
+        """ Every representation needs its own strong ETag. """
+        if encoding == None:
+            return self.etag
+        return self.etag[:-1] + "-" + encoding + '"'
+
+    def size(self):
+        return len(self.body) + sum(len(data) for data in self.variants.values())
+
+
+class ResponseCache:
+    """ LRU cache of serialized response bodies, bounded by their total size in bytes.
+    Keys are tuples starting with the resource name, so a whole resource can be invalidated at once.
+    Entries older than ttl seconds are dropped, which bounds staleness when writes happen in another process. """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=30.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        # Bumped on every invalidation, so a read that raced a write doesn't store what it read
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def token(self):
+        """ Take before reading from the database, then pass to put. """
+        return self.generation
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and time.monotonic() - entry.stored_at > self.ttl:
+                self.drop(key)
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, token, headers=None):
+        """ Stores body under key unless something was invalidated since token was taken. Returns the entry either way. """
+        entry = CacheEntry(body, headers)
+        if len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            if token != self.generation:
+                return entry
+            self.drop(key)
+            self.entries[key] = entry
+            entry.cached = True
+            self.size += len(body)
+            self.evict()
+        return entry
+
+    def compressed(self, entry, encoding, level):
+        """ Returns the entry's body compressed with encoding. Only compressed the first time, the result is kept with the entry. """
+        data = entry.variants.get(encoding)
+        if data != None:
+            return data
+        data = compress(entry.body, encoding, level)
+        with self.lock:
+            if encoding not in entry.variants:
+                entry.variants[encoding] = data
+                if entry.cached:
+                    self.size += len(data)
+                    self.evict()
+        return data
+
+    def evict(self):
+        """ Drops least recently used entries until the cache fits. Lock must be held. """
+        while self.size > self.max_bytes:
+            old_key = next(iter(self.entries))
+            self.drop(old_key)
+            self.evictions += 1
+
+    def drop(self, key):
+        """ Removes one entry. Lock must be held. """
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            entry.cached = False
+            self.size -= entry.size()
+
+    def invalidate(self, *keys):
+        """ Removes the entries for keys. A key of length one removes every entry of that resource. """
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if len(key) == 1:
+                    for cached in [k for k in self.entries if k[0] == key[0]]:
+                        self.drop(cached)
+                else:
+                    self.drop(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,25 +1,196 @@
 #! /usr/bin/python3
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPMessage
 from http.cookies import SimpleCookie
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlencode, urlsplit
 import json
+import math
+import os
+import re
+import signal
 import sys
-from passlib.hash import bcrypt
+import threading
+import time
+import traceback
 from http import cookies
 
 # Fix hanging
 from socketserver import ThreadingMixIn
 
-from garden_db import GardensDB
-from session_store import SessionStore
-
-STORE = SessionStore()
+from backend import backend_class, open_db, close_db, db_stats, OK, NOT_FOUND
+from events import HUB, DetachMixIn
+from metrics import REGISTRY
+from password_hasher import PasswordHasher, HasherBusy
+from prefork import PreforkMaster
+from async_server import AsyncHTTPServer
+from worker_pool import WorkerPoolMixIn
+from response_cache import ResponseCache
+from compression import choose_encoding, compress, compressor
+from garden_export import BadImport, GardenImport, MAX_LINE_BYTES
+import zlib
+from session_store import MemorySessionStore, PostgresSessionStore, SQLiteSessionStore
+
+
+def make_session_store():
+    """ Picks the session backend from SESSION_BACKEND (memory, postgres or sqlite). """
+    backend = os.environ.get("SESSION_BACKEND", "memory")
+    options = {
+        'idle_ttl': int(os.environ.get("SESSION_IDLE_TTL", 24 * 3600)),
+        'max_age': int(os.environ.get("SESSION_MAX_AGE", 30 * 24 * 3600)),
+        'max_sessions': int(os.environ.get("SESSION_MAX", 100000)),
+    }
+    if backend == "postgres":
+        from garden_db import GardensDB
+        return PostgresSessionStore(GardensDB, **options)
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.environ.get("SESSION_SQLITE_PATH", "sessions.db"), **options)
+    return MemorySessionStore(**options)
+
+
+STORE = make_session_store()
+
+# Serialized GET /gardens and GET /gardens/<id> responses
+CACHE = ResponseCache(
+    max_bytes=int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 30)),
+)
+# Largest streamed collection that is still collected into the cache
+STREAM_CACHE_LIMIT = 4 * 1024 * 1024
+
+
+def forget_changed(kind, garden_id):
+    """ Drops the cached responses a write changed, whichever process made it. With no kind events were missed, so drops them all. """
+    if kind == None:
+        CACHE.invalidate(("garden",), ("gardens",))
+    elif kind.startswith("garden_"):
+        CACHE.invalidate(("garden", garden_id), ("gardens",))
+    else:
+        CACHE.invalidate(("garden", garden_id))
+
+
+HUB.watch(forget_changed)
+
+HASHER = PasswordHasher(
+    rounds=int(os.environ.get("BCRYPT_ROUNDS", 12)),
+    workers=int(os.environ.get("HASH_WORKERS", 0)) or None,
+    queue_limit=int(os.environ.get("HASH_QUEUE_LIMIT", 0)) or None,
+)
+
+REGISTRY.describe("http_requests_total", "counter", "HTTP requests by method, route and status")
+REGISTRY.describe("http_request_seconds", "histogram", "HTTP request duration by method and route")
+REGISTRY.describe("http_batch_requests_total", "counter", "Sub-requests of POST /batch by method, route and status")
+REGISTRY.gauge("threads_active", "Threads alive in this process", lambda: {(): threading.active_count()})
+REGISTRY.gauge("sessions", "Sessions in the session store", lambda: {(): len(STORE)})
+REGISTRY.gauge("db_pool", "Database connection pool usage",
+    lambda: {(("stat", key),): value for key, value in (db_stats() or {}).items()})
+REGISTRY.gauge("response_cache", "Response cache usage",
+    lambda: {(("stat", key),): value for key, value in CACHE.stats().items()})
+REGISTRY.gauge("password_hasher", "Password hashing pool usage",
+    lambda: {(("stat", key),): value for key, value in HASHER.stats().items()})
+REGISTRY.gauge("event_streams", "Server-sent event streams held by this process",
+    lambda: {(("stat", key),): value for key, value in HUB.stats().items()})
+
+# Build garden detail documents in a single postgres query instead of three
+GARDEN_JSON_IN_DB = os.environ.get("GARDEN_JSON_IN_DB", "1") != "0"
+# Read garden detail documents from the trigger-maintained garden_documents table
+GARDEN_DOCUMENTS = os.environ.get("GARDEN_DOCUMENTS", "0") == "1"
+
+# Largest page GET /gardens?limit= will return
+MAX_PAGE_SIZE = 1000
+# Rows fetched and written per chunk when streaming a whole collection
+STREAM_BATCH_SIZE = 500
+# Largest number of flowers POST /gardens/<id>/flowers accepts at once
+MAX_BULK_FLOWERS = 10000
+# Largest limit GET /gardens/<id>/flowers?bbox= accepts
+MAX_VIEWPORT_LIMIT = 10000
+# Export lines collected into each chunk of GET /gardens/<id>/export, instead of one chunk (and compressor flush) per row
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Request threads per process of the async engine when --threads isn't given
+ASYNC_THREADS = 32
+# Largest number of sub-requests POST /batch accepts at once
+MAX_BATCH_REQUESTS = 50
+# Threads per process running the independent sub-requests of batches concurrently
+BATCH_EXECUTOR = ThreadPoolExecutor(int(os.environ.get("BATCH_THREADS", 4)), thread_name_prefix="batch")
+# Methods a sub-request may use
+BATCH_METHODS = {"GET", "POST", "PUT", "DELETE"}
+# {n.key} in a sub-request's path or body stands for key of the JSON body sent back to sub-request n
+BATCH_REFERENCE = re.compile(r"\{(\d+)\.(\w+)\}")
+
+# JSON bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+# zlib level 1 (fastest) to 9 (smallest)
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+# Path parts that make up metrics route labels, anything else is counted as unmatched
+ROUTE_COLLECTIONS = {"gardens", "flowers", "comments", "users", "sessions", "me", "metrics", "batch"}
+ROUTE_SUB_COLLECTIONS = {"flowers", "events", "export"}
+# Actions on a whole collection, /<collection>/<action>
+ROUTE_ACTIONS = {"import"}
+
+# Requests served on one keep-alive connection before it is closed
+MAX_REQUESTS_PER_CONNECTION = int(os.environ.get("MAX_REQUESTS_PER_CONNECTION", 1000))
+# Unread request bodies up to this size are skipped to keep the connection open, larger ones close it
+MAX_DRAIN_BYTES = 64 * 1024
+# Largest request body read whole, larger ones get a 413 before any of it is read
+MAX_BODY_BYTES = int(os.environ.get("SERVER_MAX_BODY", 8 * 1024 * 1024))
+# Largest body of POST /gardens/import, which is read a line at a time
+MAX_IMPORT_BYTES = int(os.environ.get("SERVER_MAX_IMPORT", 1024 * 1024 * 1024))
 
 
 class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
     """ The HTTP request handler for the gardens app. """
 
+    # Persistent connections, every response has a Content-Length or is chunked
+    protocol_version = "HTTP/1.1"
+    # Seconds an idle keep-alive connection is kept open
+    timeout = int(os.environ.get("KEEP_ALIVE_TIMEOUT", 15))
+    # Headers and body are separate writes. With Nagle the body waits for the client's delayed ACK, about 40ms per response.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # A pooled server keeps idle connections for less time, each one holds a worker thread
+        self.timeout = getattr(self.server, "idle_timeout", None) or self.timeout
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        """ Handles one request on the connection. Responses are buffered by response() and sent here with their Content-Length. """
+        self.pending = None
+        self.body_read = False
+        self.command = None
+        self.route = None
+        self.status_code = None
+        start = time.perf_counter()
+        super().handle_one_request()
+        if self.pending != None:
+            self.finish_response()
+        if self.command:
+            labels = (("method", self.command), ("route", self.route or "unmatched"), ("status", str(self.status_code)))
+            REGISTRY.inc("http_requests_total", labels)
+            REGISTRY.observe("http_request_seconds", labels[:2], time.perf_counter() - start)
+        if not self.close_connection:
+            self.drain_body()
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def parse_request(self):
+        """ Also refuses a body longer than body_limit() with 413, before any of it is read. """
+        if not super().parse_request():
+            return False
+        if self.body_too_large():
+            self.too_large()
+            return False
+        return True
+
+    def handle_expect_100(self):
+        # A body parse_request refuses isn't asked for
+        return self.body_too_large() or super().handle_expect_100()
+
     # HTTP METHODS
 
     def do_OPTIONS(self):
@@ -30,18 +201,32 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         # For multiple domains, echo back the self.headers['Origin']
         self.send_header("Access-Control-Allow-Origin", self.headers["Origin"])
         self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Accept, Content-Type, Origin")
+        self.send_header("Access-Control-Allow-Headers", "Accept, Content-Type, Origin, If-None-Match")
+        # Let browsers reuse the preflight result instead of repeating it
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.send_header("Content-Length", "0")
+        self.send_connection_header()
         self.send_cookie()
         self.end_headers()
 
     def do_GET(self):
         """ Handle GET requests. """
         self.load_session()
-        coll, id, valid = self.parse_path()
+        coll, id, sub, valid = self.parse_path()
         if not valid:
             self.response(404)
             return
 
+        if sub:
+            if coll == "gardens" and id and sub == "events":
+                self.garden_events(id)
+            elif coll == "gardens" and id and sub == "flowers":
+                self.get_garden_flowers(id)
+            elif coll == "gardens" and id and sub == "export":
+                self.export_garden(id)
+            else:
+                self.response(404)
+            return
         if coll == "gardens":
             if id:
                 self.get_one_garden(id)
@@ -49,14 +234,28 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
                 self.get_gardens()
         elif coll == "me" and not id:
             self.get_user_data()
+        elif coll == "metrics" and not id:
+            self.get_metrics()
         else:
             self.response(404)
 
     def do_POST(self):
         """ Handle POST requests. """
         self.load_session()
-        coll, id, valid = self.parse_path()
-        if not valid or id:
+        coll, id, sub, valid = self.parse_path()
+        if not valid:
+            self.response(404)
+            return
+
+        if sub:
+            if coll == "gardens" and id and sub == "flowers":
+                self.add_flowers(id)
+            elif coll == "gardens" and not id and sub == "import":
+                self.import_garden()
+            else:
+                self.response(404)
+            return
+        if id:
             self.response(404)
             return
 
@@ -70,29 +269,31 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
             self.add_user()
         elif coll == "sessions":
             self.create_session()
+        elif coll == "batch":
+            self.batch()
         else:
             self.response(404)
 
     def do_PUT(self):
         """ Handle PUT requests. """
         self.load_session()
-        coll, id, valid = self.parse_path()
-        if not valid:
+        coll, id, sub, valid = self.parse_path()
+        if not valid or sub:
             self.response(404)
             return
 
         if coll == "gardens" and id:
             self.update_garden(id)
         elif coll == "comments" and id:
-            self.delete_comment(id)
+            self.update_comment(id)
         else:
             self.response(404)
 
     def do_DELETE(self):
         """ Handle DELETE requests. """
         self.load_session()
-        coll, id, valid = self.parse_path()
-        if not valid:
+        coll, id, sub, valid = self.parse_path()
+        if not valid or sub:
             self.response(404)
             return
 
@@ -111,53 +312,279 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
     # HELPER METHODS
 
     def parse_path(self):
-        """ Gets the resource collection and id from the request path. If it is not valid then valid will be False. """
-        bad = (0, 0, False)
+        """ Gets the resource collection, id and sub-collection (/<collection>/<id>/<sub>) from the request path. If it is not valid then valid will be False. Query parameters are stored in self.query. """
+        bad = (0, 0, None, False)
 
-        if not self.path.startswith("/"):
+        url = urlsplit(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path
+        if not path.startswith("/"):
             return bad
         # Skip first /
-        parts = self.path[1:].split("/")
+        parts = path[1:].split("/")
         # Throw away anything with too many parameters
-        if len(parts) > 2:
+        if len(parts) > 3:
             return bad
 
         collection = parts[0]
         id = None
+        if len(parts) == 2 and parts[1] in ROUTE_ACTIONS:
+            if collection in ROUTE_COLLECTIONS:
+                self.route = path
+            return (collection, None, parts[1], True)
         if len(parts) > 1:
             # Make sure type is int
             try:
                 id = int(parts[1])
             except:
                 return bad
-        return (collection, id, True)
-
+        sub = None
+        if len(parts) > 2:
+            sub = parts[2]
+        # Route label for metrics, with ids replaced so there is one series per route. Unknown paths share one label.
+        if collection in ROUTE_COLLECTIONS and (sub == None or sub in ROUTE_SUB_COLLECTIONS):
+            self.route = "/" + "/".join([collection] + [":id" for _ in parts[1:2]] + parts[2:3])
+        return (collection, id, sub, True)
+
+
+    def body_limit(self):
+        """ Largest body the request may have. Imports read theirs a line at a time, every other route reads it whole. """
+        coll, id, sub, valid = self.parse_path()
+        if self.command == "POST" and coll == "gardens" and id == None and sub == "import":
+            return MAX_IMPORT_BYTES
+        return MAX_BODY_BYTES
+
+    def body_too_large(self):
+        try:
+            return int(self.headers['Content-Length'] or 0) > self.body_limit()
+        except ValueError:
+            return False
+
+    def too_large(self):
+        """ Sends 413 without reading the body, which closes the connection. Sessions aren't loaded for it. """
+        self.close_connection = True
+        body = bytes(json.dumps({'message': f"Request bodies are limited to {self.body_limit()} bytes"}), "utf-8")
+        self.send_response(413)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", self.headers["Origin"])
+        self.send_header("Access-Control-Allow-Credentials", "true")
+        self.send_connection_header()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """ Reads the whole request body. """
+        self.body_read = True
+        length = int(self.headers['Content-Length'] or 0)
+        return self.rfile.read(length)
+
+    def body_lines(self):
+        """ Yields the request body a line at a time, for bodies too large to read whole. Lines longer than MAX_LINE_BYTES come in pieces.
+        If it isn't read to the end the connection closes after the response. """
+        self.body_read = True
+        remaining = int(self.headers['Content-Length'] or 0)
+        try:
+            while remaining > 0:
+                line = self.rfile.readline(min(remaining, MAX_LINE_BYTES + 1))
+                if not line:
+                    raise ConnectionError("Request body ended early")
+                remaining -= len(line)
+                yield line
+        finally:
+            if remaining > 0:
+                self.close_connection = True
+
+    def drain_body(self):
+        """ Skips a request body the handler didn't read, so the next request on the connection starts at the right place. """
+        if self.body_read:
+            return
+        if "Transfer-Encoding" in self.headers:
+            self.close_connection = True
+            return
+        length = int(self.headers['Content-Length'] or 0)
+        if length > MAX_DRAIN_BYTES:
+            self.close_connection = True
+        elif length > 0:
+            self.rfile.read(length)
 
     def decode(self):
         """ Parses the request for URL search parameters and returns them in dict format. """
-        length = self.headers['Content-Length']
-        body = parse_qs(self.rfile.read(int(length)).decode("utf-8"))
+        body = parse_qs(self.read_body().decode("utf-8"))
         for key in body:
             body[key] = body[key][0]
         return body
 
-    def response(self, status_code, body=False):
-        """ Sends a response with the specified status code with cors headers. Allows for json body. Also sends the cookie. """
+    def send_connection_header(self):
+        """ Closes the connection once it has served its share of requests, or when other connections are waiting for a worker. """
+        self.requests_served += 1
+        if self.requests_served >= MAX_REQUESTS_PER_CONNECTION:
+            self.close_connection = True
+        if getattr(self.server, "backlogged", None) and self.server.backlogged():
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+
+    def response(self, status_code, body=False, headers=None, stream=False):
+        """ Sends a response with the specified status code with cors headers. Allows for json body, or another compressible body
+        when headers has its Content-Type. Also sends the cookie.
+        The body written with write() is buffered and sent with a Content-Length once the handler returns.
+        With stream the body is sent with write_chunk/end_chunks, using chunked transfer encoding when the client allows it. """
         self.send_response(status_code)
-        if body:
+        if body and "Content-Type" not in (headers or {}):
             self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
         self.send_cookie()
         self.send_header("Access-Control-Allow-Origin", self.headers["Origin"])
         self.send_header("Access-Control-Allow-Credentials", "true")
+        self.json_body = body
+
+        if not stream:
+            self.pending_status = status_code
+            self.pending = []
+            # Set when the body written is already in its final content coding
+            self.encoded = False
+            return
+
+        self.stream_compressor = None
+        if body:
+            self.send_header("Vary", "Accept-Encoding")
+            encoding = choose_encoding(self.headers["Accept-Encoding"])
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+                self.stream_compressor = compressor(encoding, COMPRESS_LEVEL)
+        self.chunked = self.request_version >= "HTTP/1.1"
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            # Without chunking the end of the body is the end of the connection
+            self.close_connection = True
+        self.send_connection_header()
         self.end_headers()
 
+    def write(self, data):
+        """ Adds to the body of the current response. """
+        self.pending.append(data)
+
+    def finish_response(self):
+        """ Sends the buffered response headers and body. JSON bodies are compressed when they are large enough and the client accepts it. """
+        body = b"".join(self.pending)
+        self.pending = None
+        # 204 and 304 responses never have a body
+        if self.pending_status not in (204, 304):
+            if self.json_body:
+                self.send_header("Vary", "Accept-Encoding")
+            if self.json_body and not self.encoded and len(body) >= COMPRESS_MIN_BYTES:
+                encoding = choose_encoding(self.headers["Accept-Encoding"])
+                if encoding:
+                    body = compress(body, encoding, COMPRESS_LEVEL)
+                    self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+        self.send_connection_header()
+        self.end_headers()
+        if body and self.pending_status not in (204, 304):
+            self.wfile.write(body)
+        self.wfile.flush()
+
+    def write_chunk(self, data):
+        """ Writes part of a streamed response body. """
+        if self.stream_compressor != None:
+            # Sync flush so the client can decode each part as it arrives
+            data = self.stream_compressor.compress(data) + self.stream_compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.send_chunk(data)
+
+    def send_chunk(self, data):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def end_chunks(self):
+        """ Finishes a streamed response body. """
+        if self.stream_compressor != None:
+            self.send_chunk(self.stream_compressor.flush())
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def bad_request(self, message):
+        self.response(400, True)
+        self.write(bytes(json.dumps({'message': message}), "utf-8"))
+
+    def send_cached(self, entry):
+        """ Sends a cached body with its ETag, or 304 if the client already has it.
+        Compressed bodies are kept in the cache entry, so each one is only compressed once. """
+        encoding = None
+        if len(entry.body) >= COMPRESS_MIN_BYTES:
+            encoding = choose_encoding(self.headers["Accept-Encoding"])
+        etag = entry.variant_etag(encoding)
+        headers = dict(entry.headers, ETag=etag)
+        headers["Cache-Control"] = "no-cache"
+        if self.not_modified(etag):
+            self.response(304, False, headers)
+            return
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        self.response(200, True, headers)
+        self.encoded = True
+        if encoding:
+            self.write(CACHE.compressed(entry, encoding, COMPRESS_LEVEL))
+        else:
+            self.write(entry.body)
+
+    def not_modified(self, etag):
+        """ Checks the If-None-Match header against etag. """
+        match = self.headers["If-None-Match"]
+        if match == None:
+            return False
+        tags = [tag.strip() for tag in match.split(",")]
+        return "*" in tags or etag in tags
+
+    def invalidate_garden(self, garden_id, listing=False):
+        """ Drops the cached garden document, and the cached garden lists too if the garden's own row changed. """
+        keys = [("garden", int(garden_id))]
+        if listing:
+            keys.append(("gardens",))
+        self.invalidate(*keys)
+
+    def invalidate(self, *keys):
+        CACHE.invalidate(*keys)
+
+    def caching(self):
+        """ Whether this request may read and fill the response cache. Before the first read a process starts listening for
+        garden events, so writes made by other processes drop what they changed (see forget_changed). """
+        if not CACHE.enabled():
+            return False
+        HUB.start(backend_class().listen)
+        return True
+
+    def db(self):
+        """ Returns the storage handle for this request. """
+        return open_db()
+
+    def busy(self, retry_after=1):
+        """ Sends 503 when the server is too loaded to take the request. """
+        self.response(503, True, {"Retry-After": str(retry_after)})
+        self.write(bytes(json.dumps({'message': "Server busy, try again later"}), "utf-8"))
+
+    def write_result(self, result):
+        """ Responds to an ownership-checked write: 204 when done, 404 when missing, 403 when owned by someone else. """
+        if result == OK:
+            self.response(204)
+        elif result == NOT_FOUND:
+            self.response(404)
+        else:
+            self.no_auth(403)
+
     def no_auth(self, status_code):
         """ Generic messages for no authentication/authorization. """
         self.response(status_code, True)
         if status_code == 401:
-            self.wfile.write(bytes(json.dumps({'message': "Not authenticated"}), "utf-8"))
+            self.write(bytes(json.dumps({'message': "Not authenticated"}), "utf-8"))
         elif status_code == 403:
-            self.wfile.write(bytes(json.dumps({'message': "Can only modify owned resources"}), "utf-8"))
+            self.write(bytes(json.dumps({'message': "Can only modify owned resources"}), "utf-8"))
 
 
 
@@ -171,6 +598,9 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
             self.cookie = SimpleCookie()
 
     def send_cookie(self):
+        # Sessions are created lazily, so the cookie is only set once something was stored
+        if self.session_data.stored:
+            self.cookie['sessionId'] = self.session_data.id
         for morsel in self.cookie.values():
             self.send_header("Set-Cookie", morsel.OutputString())
 
@@ -179,7 +609,7 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
 
     def create_session(self):
         """ Attempts to login and authenticate. """
-        DB = GardensDB()
+        DB = self.db()
         body = self.decode()
         reqEmail = body['email']
         reqPassword = body['password']
@@ -187,7 +617,15 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         # check password
         user = DB.get_user(reqEmail)
         if user != None:
-            if bcrypt.verify(reqPassword, user['password']):
+            try:
+                matches, new_hash = HASHER.verify(reqPassword, user['password'])
+            except HasherBusy:
+                self.busy()
+                return
+            if matches:
+                # The bcrypt cost changed since this password was stored
+                if new_hash != None:
+                    DB.update_user_password(user['id'], new_hash)
                 self.session_data['uid'] = user['id']
                 self.response(201, True)
             else:
@@ -198,19 +636,16 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
 
     def load_session(self):
         self.get_cookie()
+        data = None
         if 'sessionId' in self.cookie:
-            session_id = self.cookie['sessionId'].value
-            data = STORE.get_session(session_id)
+            data = STORE.get_session(self.cookie['sessionId'].value)
             if data == None:
-                session_id = STORE.create_session()
-                data = STORE.get_session(session_id)
-                self.cookie['sessionId'] = session_id
-            self.session_data = data
-        else:
-            session_id = STORE.create_session()
-            data = STORE.get_session(session_id)
-            self.cookie['sessionId'] = session_id
-            self.session_data = data
+                # Expired or unknown, don't echo it back
+                del self.cookie['sessionId']
+        if data == None:
+            # Only stored once something is written to it
+            data = STORE.new_session()
+        self.session_data = data
 
     def delete_session(self):
         """ Log the user out. """
@@ -222,7 +657,7 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
     # USERS
     def add_user(self):
         """ Creates a new user with a unique email. """
-        DB = GardensDB()
+        DB = self.db()
         body = self.decode()
         first_name = body['first_name']
         last_name = body['last_name']
@@ -233,17 +668,21 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         user = DB.get_user(email)
         if user != None:
             self.response(422, True)
-            self.wfile.write(bytes(json.dumps({'message': "No duplicate email"}), "utf-8"))
+            self.write(bytes(json.dumps({'message': "No duplicate email"}), "utf-8"))
             return
 
         # hash password
-        hashed = bcrypt.hash(password)
+        try:
+            hashed = HASHER.hash(password)
+        except HasherBusy:
+            self.busy()
+            return
         DB.create_user(first_name, last_name, email, hashed)
         self.response(201, True)
 
     def get_user_data(self):
         """ Gets user data if logged in. """
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
@@ -252,14 +691,14 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         user = DB.get_user_by_id(user_id)
         gardens = DB.get_user_gardens(user_id)
         self.response(200, True)
-        self.wfile.write(bytes(json.dumps({'first_name': user['first_name'], 'last_name': user['last_name'], 'id': user['id'],'gardens': gardens}), "utf-8"))
+        self.write(bytes(json.dumps({'first_name': user['first_name'], 'last_name': user['last_name'], 'id': user['id'],'gardens': gardens}), "utf-8"))
 
 
     # GARDENS
 
     def add_garden(self):
         """ Creates a new garden with name and author. """
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
@@ -268,67 +707,222 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         name = body['name']
         author = body['author']
         created_id = DB.create_garden(name, author, uid)
+        self.invalidate(("gardens",))
         self.response(201, True)
-        self.wfile.write(bytes(json.dumps(created_id), "utf-8"))
+        self.write(bytes(json.dumps(created_id), "utf-8"))
 
     def get_gardens(self):
-        """ Sends a list of all garden depth 0 information. """
-        DB = GardensDB()
-        data = DB.get_gardens()
-        self.response(200, True)
-        self.wfile.write(bytes(json.dumps(data), "utf-8"))
+        """ Sends a list of garden depth 0 information.
+        With ?limit=&after= sends one page in id order, with a Link header to the next page.
+        Without a limit the whole collection is streamed in batches. """
+        DB = self.db()
+        key = ("gardens", self.query.get('limit'), self.query.get('after'))
+        entry = CACHE.get(key) if self.caching() else None
+        if entry != None:
+            self.send_cached(entry)
+            return
+
+        token = CACHE.token()
+        if 'limit' not in self.query:
+            self.stream_gardens(DB, key, token)
+            return
+
+        try:
+            limit = int(self.query['limit'])
+            after = int(self.query.get('after', 0))
+        except ValueError:
+            self.bad_request("limit and after must be integers")
+            return
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            self.bad_request(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+            return
+
+        data, next_after = DB.get_gardens_page(limit, after)
+        headers = {}
+        if next_after != None:
+            headers["Link"] = f'</gardens?limit={limit}&after={next_after}>; rel="next"'
+        body = bytes(json.dumps(data), "utf-8")
+        if self.caching():
+            self.send_cached(CACHE.put(key, body, token, headers))
+            return
+        self.response(200, True, headers)
+        self.write(body)
+
+    def stream_gardens(self, DB, key, token):
+        """ Streams every garden as one JSON array without holding the whole table in memory.
+        If the whole response turns out to be small it is cached. """
+        self.response(200, True, stream=True)
+        self.write_chunk(b"[")
+        first = True
+        # Collected for the cache until it grows past STREAM_CACHE_LIMIT
+        parts = [b"["] if self.caching() else None
+        size = 1
+        batches = DB.iter_gardens(STREAM_BATCH_SIZE)
+        try:
+            for rows in batches:
+                encoded = ", ".join(json.dumps(row) for row in rows)
+                if not first:
+                    encoded = ", " + encoded
+                first = False
+                chunk = encoded.encode("utf-8")
+                self.write_chunk(chunk)
+                if parts != None:
+                    size += len(chunk)
+                    if size <= STREAM_CACHE_LIMIT:
+                        parts.append(chunk)
+                    else:
+                        parts = None
+        finally:
+            # Hand the connection back even if the client went away mid-stream
+            batches.close()
+        self.write_chunk(b"]")
+        self.end_chunks()
+        if parts != None:
+            CACHE.put(key, b"".join(parts) + b"]", token)
 
     def get_one_garden(self, id):
-        DB = GardensDB()
-        garden = DB.get_one_garden(id)
-        if garden != None:
-            self.response(200, True)
-            self.wfile.write(bytes(json.dumps(garden), "utf-8"))
-        else:
+        if 'since' in self.query:
+            self.get_garden_changes(id)
+            return
+        key = ("garden", id)
+        entry = CACHE.get(key) if self.caching() else None
+        if entry == None:
+            token = CACHE.token()
+            body = self.garden_document(id)
+            if body == None:
+                self.response(404)
+                return
+            if not self.caching():
+                self.response(200, True)
+                self.write(body)
+                return
+            entry = CACHE.put(key, body, token)
+        self.send_cached(entry)
+
+    def get_garden_changes(self, id):
+        """ Sends only the flowers and comments written since the version a client last saw, and the ids of those deleted.
+        The response's version is the since for the next request. Not cached, since differs between clients. """
+        try:
+            since = int(self.query['since'])
+        except ValueError:
+            self.bad_request("since must be an integer")
+            return
+        if since < 0:
+            self.bad_request("since must not be negative")
+            return
+
+        doc = self.db().get_garden_changes(id, since)
+        if doc == None:
             self.response(404)
+            return
+        self.response(200, True, {"Cache-Control": "no-store"})
+        self.write(doc.encode("utf-8"))
+
+    def garden_events(self, id):
+        """ Streams changes to a garden as server-sent events. Once the headers are sent the connection is handed to the event hub,
+        so a waiting subscriber holds no request thread. Clients reconnect and refetch the garden after a resync event or a drop. """
+        DB = self.db()
+        if DB.get_garden_owner(id) == None:
+            self.response(404)
+            return
+        HUB.start(backend_class().listen)
+        if HUB.full():
+            self.busy(5)
+            return
+
+        # The stream only ends with the connection
+        self.close_connection = True
+        self.response(200, False, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, stream=True)
+        self.wfile.flush()
+        HUB.attach(id, self.connection, self.chunked)
+
+    def garden_document(self, id):
+        """ Returns the serialized garden with its comments and flowers, or None if it doesn't exist. """
+        DB = self.db()
+        if GARDEN_JSON_IN_DB:
+            # Postgres builds the whole document, so the bytes go straight out
+            doc = DB.get_one_garden_json(id, GARDEN_DOCUMENTS)
+            if doc == None:
+                return None
+            return doc.encode("utf-8")
+
+        garden = DB.get_one_garden(id)
+        if garden == None:
+            return None
+        return bytes(json.dumps(garden), "utf-8")
 
     def update_garden(self, id):
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
 
-        garden = DB.get_one_garden(id)
-        if garden != None:
-            # If they are not the owner of this garden
-            if self.session_data['uid'] != garden['author_id']:
-                self.no_auth(403)
-                return
-            body = self.decode()
-            name = body['name']
-            DB.update_garden(id, name)
-            self.response(204)
-        else:
-            self.response(404)
+        body = self.decode()
+        name = body['name']
+        result = DB.update_garden(id, name, self.session_data['uid'])
+        if result == OK:
+            self.invalidate_garden(id, listing=True)
+        self.write_result(result)
 
     def delete_garden(self, id):
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
-    
-        garden = DB.get_one_garden(id)
-        if garden != None:
-            # If they are not the owner of this garden
-            if self.session_data['uid'] != garden['author_id']:
-                self.no_auth(403)
-                return
-            DB.delete_garden(id)
-            self.response(204)
-        else:
+
+        result = DB.delete_garden(id, self.session_data['uid'])
+        if result == OK:
+            self.invalidate_garden(id, listing=True)
+        self.write_result(result)
+
+    def export_garden(self, id):
+        """ Streams the garden, its flowers and its comments as NDJSON (see garden_export.py), for POST /gardens/import.
+        The backend hands over rows as it reads them, so memory use doesn't grow with the garden. """
+        DB = self.db()
+        if DB.get_garden_owner(id) == None:
             self.response(404)
+            return
+
+        headers = {"Content-Type": "application/x-ndjson", "Content-Disposition": f'attachment; filename="garden-{id}.ndjson"'}
+        self.response(200, True, headers, stream=True)
+        buffer = bytearray()
+
+        def write(data):
+            buffer.extend(data)
+            if len(buffer) >= EXPORT_CHUNK_BYTES:
+                self.write_chunk(bytes(buffer))
+                buffer.clear()
+
+        DB.export_garden(id, write)
+        self.write_chunk(bytes(buffer))
+        self.end_chunks()
+
+    def import_garden(self):
+        """ Creates a garden owned by the session's user from the body of GET /gardens/<id>/export, in one transaction.
+        The body is read a line at a time as the rows are inserted. Sends the new garden's id and how many flowers and comments it got. """
+        DB = self.db()
+        if 'uid' not in self.session_data:
+            self.no_auth(401)
+            return
+
+        lines = self.body_lines()
+        try:
+            created = DB.import_garden(GardenImport(lines), self.session_data['uid'])
+        except BadImport as error:
+            self.bad_request(str(error))
+            return
+        finally:
+            lines.close()
+        self.invalidate(("gardens",))
+        self.response(201, True)
+        self.write(bytes(json.dumps(created), "utf-8"))
 
 
     # COMMENTS
 
     def add_comment(self):
         """ Adds a comment to a particular garden. """
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
@@ -338,50 +932,39 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         content = body['content']
         user_id = self.session_data['uid']
         DB.create_comment(garden_id, content, user_id)
+        self.invalidate_garden(garden_id)
         self.response(201)
 
     def update_comment(self, id):
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
 
-        comment = DB.get_one_comment(id)
-        if comment != None:
-            # If they did not write the comment
-            if self.session_data['uid'] != comment['author_id']:
-                self.no_auth(403)
-                return
-            body = self.decode()
-            content = body['content']
-            DB.update_comment(id, content)
-            self.response(204)
-        else:
-            self.response(404)
+        body = self.decode()
+        content = body['content']
+        result, garden_id = DB.update_comment(id, content, self.session_data['uid'])
+        if result == OK:
+            self.invalidate_garden(garden_id)
+        self.write_result(result)
 
     def delete_comment(self, id):
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
 
-        comment = DB.get_one_comment(id)
-        if comment != None:
-            # If they did not write the comment
-            if self.session_data['uid'] != comment['author_id']:
-                self.no_auth(403)
-                return
-            DB.delete_comment(id)
-            self.response(204)
-        else:
-            self.response(404)
+        result, garden_id = DB.delete_comment(id, self.session_data['uid'])
+        if result == OK:
+            self.invalidate_garden(garden_id)
+        self.write_result(result)
 
 
     # FLOWERS
 
     def add_flower(self):
         """ Adds a flower to a particular garden. """
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
@@ -389,49 +972,454 @@ class GardensHTTPRequestHandler(BaseHTTPRequestHandler):
         body = self.decode()
         garden_id = body['gardenId']
         color = body['color']
-        x = body['x']
-        y = body['y']
+        try:
+            x = float(body['x'])
+            y = float(body['y'])
+        except ValueError:
+            self.bad_request("x and y must be numbers")
+            return
+        # float() takes "nan" and "inf" too, which have no place on the canvas
+        if not (math.isfinite(x) and math.isfinite(y)):
+            self.bad_request("x and y must be finite numbers")
+            return
         DB.create_flower(garden_id, color, x, y)
+        self.invalidate_garden(garden_id)
         self.response(201)
 
+    def get_garden_flowers(self, id):
+        """ Sends the garden's flowers. With ?bbox=x0,y0,x1,y1 only those inside the box, for the part of the canvas on screen.
+        With &limit=n a box holding more than n flowers is thinned to one per grid cell, and X-Flowers-Sampled is 1. """
+        DB = self.db()
+        box = None
+        limit = None
+        try:
+            if 'bbox' in self.query:
+                box = [float(value) for value in self.query['bbox'].split(",")]
+            if 'limit' in self.query:
+                limit = int(self.query['limit'])
+        except ValueError:
+            self.bad_request("bbox must be x0,y0,x1,y1 and limit an integer")
+            return
+        if box != None and (len(box) != 4 or not all(math.isfinite(value) for value in box)):
+            self.bad_request("bbox must be x0,y0,x1,y1")
+            return
+        if limit != None and (box == None or limit < 1 or limit > MAX_VIEWPORT_LIMIT):
+            self.bad_request(f"limit must be between 1 and {MAX_VIEWPORT_LIMIT} and needs a bbox")
+            return
+
+        if DB.get_garden_owner(id) == None:
+            self.response(404)
+            return
+        if box == None:
+            flowers, sampled = DB.get_flowers(id), False
+        else:
+            x0, y0, x1, y1 = box
+            flowers, sampled = DB.get_flowers_in_box(id, min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1), limit)
+        self.response(200, True, {"X-Flowers-Sampled": "1" if sampled else "0", "Access-Control-Expose-Headers": "X-Flowers-Sampled"})
+        self.write(bytes(json.dumps(flowers), "utf-8"))
+
+    def add_flowers(self, garden_id):
+        """ Adds many flowers to a garden in one transaction. The body is a JSON array (or NDJSON lines) of {color, x, y}. Sends the created ids. """
+        DB = self.db()
+        if 'uid' not in self.session_data:
+            self.no_auth(401)
+            return
+
+        owner = DB.get_garden_owner(garden_id)
+        if owner == None:
+            self.response(404)
+            return
+        # If they are not the owner of this garden
+        if self.session_data['uid'] != owner:
+            self.no_auth(403)
+            return
+
+        raw = self.read_body().decode("utf-8")
+        try:
+            if "ndjson" in (self.headers['Content-Type'] or ""):
+                items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+            else:
+                items = json.loads(raw)
+            flowers = [(str(item['color']), float(item['x']), float(item['y'])) for item in items]
+            # json.loads takes NaN and Infinity, which have no place on the canvas
+            if not all(math.isfinite(x) and math.isfinite(y) for color, x, y in flowers):
+                raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            self.bad_request("Expected a list of flowers with color, x and y")
+            return
+        if len(flowers) > MAX_BULK_FLOWERS:
+            self.bad_request(f"At most {MAX_BULK_FLOWERS} flowers per request")
+            return
+
+        ids = DB.create_flowers(garden_id, flowers)
+        self.invalidate_garden(garden_id)
+        self.response(201, True)
+        self.write(bytes(json.dumps([{'id': id} for id in ids]), "utf-8"))
+
     def delete_flower(self, id):
-        DB = GardensDB()
+        DB = self.db()
         if 'uid' not in self.session_data:
             self.no_auth(401)
             return
 
-        flower = DB.get_one_flower(id)
-        if flower != None:
-            # If they are not the owner of this garden
-            garden = DB.get_one_garden(flower['garden_id'])
-            if self.session_data['uid'] != garden['author_id']:
-                self.no_auth(403)
-                return
-            DB.delete_flower(id)
-            self.response(204)
+        # Only the owner of the garden may delete its flowers
+        result, garden_id = DB.delete_flower(id, self.session_data['uid'])
+        if result == OK:
+            self.invalidate_garden(garden_id)
+        self.write_result(result)
+
+    # METRICS
+
+    def get_metrics(self):
+        """ Sends every metric in the Prometheus text format. """
+        self.response(200, False, {"Content-Type": "text/plain; version=0.0.4"})
+        self.write(REGISTRY.render().encode("utf-8"))
+
+    # BATCH
+
+    def batch(self):
+        """ Runs several API requests through the same handlers and sends their responses back as one JSON array, in order.
+        The body is a list of {method, path, body, headers, after}, or {"requests": [...], "transaction": true}.
+        A sub-request runs once the ones listed in its after, and the ones it references with {n.key}, are done.
+        Sub-requests that don't depend on each other run concurrently. """
+        try:
+            batch = json.loads(self.read_body().decode("utf-8"))
+            if isinstance(batch, list):
+                batch = {'requests': batch}
+            transaction = batch.get('transaction', False) is True
+            items = list(batch['requests'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.bad_request("Expected a list of requests, or {\"requests\": [...], \"transaction\": true}")
+            return
+        if not items or len(items) > MAX_BATCH_REQUESTS:
+            self.bad_request(f"A batch has 1 to {MAX_BATCH_REQUESTS} requests")
+            return
+        try:
+            subs = [SubRequest(index, item) for index, item in enumerate(items)]
+        except ValueError as error:
+            self.bad_request(str(error))
+            return
+
+        # Logging in or out changes what later requests may do, so they wait for it and it waits for the earlier ones
+        barrier = None
+        for sub in subs:
+            if barrier != None:
+                sub.waits.add(barrier)
+            if sub.changes_session():
+                sub.waits.update(range(sub.index))
+                barrier = sub.index
+
+        if transaction:
+            results, committed = self.run_transaction(subs)
         else:
-            self.response(404)
+            results, committed = self.run_concurrently(subs), True
+        self.response(200 if committed else 409, True, {"Cache-Control": "no-store"})
+        self.write(b"[" + b", ".join(result.encode() for result in results) + b"]")
+
+    def run_transaction(self, subs):
+        """ Runs the sub-requests in order on one connection, in one transaction. The first to fail rolls all of them back,
+        and the ones after it are not run. Returns the responses and whether the transaction committed. """
+        results = []
+        try:
+            with self.db().batch(transaction=True) as DB:
+                for sub in subs:
+                    result = BatchItem(self, sub, transaction=True)
+                    result.run(DB, results)
+                    results.append(result)
+                    if result.status_code >= 400:
+                        raise RolledBack()
+        except RolledBack:
+            failed = len(results) - 1
+            for sub in subs[len(results):]:
+                result = BatchItem(self, sub)
+                result.fail(f"Not run, request {failed} failed and the transaction was rolled back")
+                results.append(result)
+            return results, False
+        # Only now can other requests see the writes, so entries cached in between are dropped too
+        for result in results:
+            self.invalidate(*result.invalidated)
+        return results, True
+
+    def run_concurrently(self, subs):
+        """ Runs each sub-request once its dependencies are done. Those ready together run at once on BATCH_EXECUTOR,
+        each on its own connection, and this thread runs the first of them. """
+        results = [None] * len(subs)
+
+        def run(sub):
+            result = BatchItem(self, sub)
+            with self.db().batch() as DB:
+                result.run(DB, results)
+            return result
+
+        waiting = list(range(len(subs)))
+        while waiting:
+            # Dependencies are always earlier requests, so the first waiting one is ready
+            ready = [i for i in waiting if all(results[n] != None for n in subs[i].dependencies | subs[i].waits)]
+            waiting = [i for i in waiting if i not in ready]
+            futures = [BATCH_EXECUTOR.submit(run, subs[i]) for i in ready[1:]]
+            results[ready[0]] = run(subs[ready[0]])
+            for i, future in zip(ready[1:], futures):
+                results[i] = future.result()
+        return results
+
+
+class RolledBack(Exception):
+    """ Raised in a batch transaction to roll it back. """
+    pass
+
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+class SubRequest:
+    """ One entry of a POST /batch body. Raises ValueError if it isn't valid. """
+
+    def __init__(self, index, item):
+        try:
+            self.method = str(item['method']).upper()
+            self.path = item['path']
+            self.body = item.get('body')
+            self.headers = {str(key): str(value) for key, value in (item.get('headers') or {}).items()}
+            after = {int(n) for n in item.get('after', [])}
+        except (KeyError, TypeError, AttributeError, ValueError):
+            raise ValueError(f"Request {index} needs a method and a path, and after must be a list of request numbers")
+        if self.method not in BATCH_METHODS:
+            raise ValueError(f"Request {index}: method must be GET, POST, PUT or DELETE")
+        if not isinstance(self.path, str) or not self.path.startswith("/"):
+            raise ValueError(f"Request {index}: path must start with /")
+        self.index = index
+        # Requests whose results this one needs. If one of them fails this one isn't run.
+        self.dependencies = after | {int(n) for n, _ in BATCH_REFERENCE.findall(self.path + json.dumps(self.body))}
+        if any(n < 0 or n >= index for n in self.dependencies):
+            raise ValueError(f"Request {index} can only depend on earlier requests")
+        # Requests this one only has to run after
+        self.waits = set()
+
+    def changes_session(self):
+        return self.method in ("POST", "DELETE") and urlsplit(self.path).path == "/sessions"
+
+
+class BatchItem(GardensHTTPRequestHandler):
+    """ Runs one sub-request of a batch through the usual handler methods and keeps its response instead of sending it.
+    It shares the session of the batch request and never touches its connection. """
+
+    def __init__(self, parent, sub, transaction=False):
+        # Not BaseRequestHandler.__init__, which would start serving a socket
+        self.sub = sub
+        self.transaction = transaction
+        self.client_address = parent.client_address
+        self.request_version = parent.request_version
+        self.session_data = parent.session_data
+        self.cookie = parent.cookie
+        self.command = sub.method
+        self.path = sub.path
+        self.headers = HTTPMessage()
+        self.route = None
+        self.DB = None
+        self.body = b""
+        self.body_read = False
+        self.close_connection = False
+        self.status_code = None
+        self.response_headers = {}
+        self.json_body = False
+        self.pending = []
+        self.parsed = None
+        # Cache keys to drop once the batch transaction commits
+        self.invalidated = []
+
+    def run(self, DB, results):
+        """ Fills in the references to earlier responses in results, then handles the sub-request with DB. """
+        self.DB = DB
+        failed = [n for n in sorted(self.sub.dependencies) if results[n].status_code >= 400]
+        if failed:
+            self.fail(f"Not run, request {failed[0]} failed")
+            return
+        try:
+            self.path = resolve(self.sub.path, results)
+            self.set_body(resolve(self.sub.body, results))
+        except LookupError as error:
+            self.fail(str(error))
+            return
+        try:
+            getattr(self, "do_" + self.command)()
+        except Exception:
+            # Answered like the server would, the rest of the batch goes on
+            self.log_error("%s %s in a batch raised", self.command, self.path)
+            traceback.print_exc()
+            self.response(500, True)
+            self.write(bytes(json.dumps({'message': "Internal server error"}), "utf-8"))
+        REGISTRY.inc("http_batch_requests_total", (("method", self.command), ("route", self.route or "unmatched"), ("status", str(self.status_code))))
+
+    def set_body(self, body):
+        """ Objects are sent as form fields, like browsers send them to the single routes. Lists are sent as JSON, strings as they are. """
+        for key, value in self.sub.headers.items():
+            self.headers[key] = value
+        content_type = None
+        if isinstance(body, dict):
+            self.body = urlencode(body).encode("utf-8")
+            content_type = "application/x-www-form-urlencoded"
+        elif isinstance(body, str):
+            self.body = body.encode("utf-8")
+        elif body != None:
+            self.body = json.dumps(body).encode("utf-8")
+            content_type = "application/json"
+        if content_type and "Content-Type" not in self.headers:
+            self.headers["Content-Type"] = content_type
+
+    def fail(self, message):
+        self.response(424, True)
+        self.write(bytes(json.dumps({'message': message}), "utf-8"))
+
+    def field(self, key):
+        """ Returns key of the JSON response body, or item key if the body is a list. """
+        if self.parsed == None and self.json_body and self.pending:
+            self.parsed = json.loads(b"".join(self.pending))
+        try:
+            value = self.parsed[int(key)] if isinstance(self.parsed, list) else self.parsed[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            value = None
+        if value == None or isinstance(value, (dict, list)):
+            raise LookupError(f"Request {self.sub.index} sent back no {key}")
+        return value
+
+    def encode(self):
+        """ Returns the response as JSON {status, headers, body}, without headers or body if there are none. JSON bodies are spliced in as they are. """
+        parts = [b'{"status": %d' % self.status_code]
+        if self.response_headers:
+            parts.append(b', "headers": ' + json.dumps(self.response_headers).encode("utf-8"))
+        body = b"".join(self.pending)
+        if body and self.status_code not in (204, 304):
+            if not self.json_body:
+                body = json.dumps(body.decode("utf-8")).encode("utf-8")
+            parts.append(b', "body": ' + body)
+        return b"".join(parts) + b"}"
+
+    def load_session(self):
+        pass
+
+    def read_body(self):
+        self.body_read = True
+        return self.body
 
+    def send_cookie(self):
+        pass
+
+    def db(self):
+        return self.DB
+
+    def caching(self):
+        # Inside a transaction the cache may hold what it is changing, or end up holding what is rolled back
+        return not self.transaction and super().caching()
+
+    def invalidate(self, *keys):
+        if self.transaction:
+            self.invalidated.extend(keys)
+        else:
+            CACHE.invalidate(*keys)
+
+    def response(self, status_code, body=False, headers=None, stream=False):
+        """ Keeps the status and headers. Streamed bodies are collected whole and never compressed. """
+        self.status_code = status_code
+        self.json_body = body
+        self.response_headers = {key: value for key, value in (headers or {}).items() if not key.startswith("Access-Control-")}
+        self.pending = []
+        self.encoded = False
+        self.stream_compressor = None
+        self.chunked = False
+
+    def send_chunk(self, data):
+        self.pending.append(data)
+
+    def garden_events(self, id):
+        self.bad_request("Event streams can't be part of a batch")
+
+    def export_garden(self, id):
+        self.bad_request("Exports can't be part of a batch")
+
+    def import_garden(self):
+        self.bad_request("Imports can't be part of a batch")
+
+    def batch(self):
+        self.bad_request("Batches can't be nested")
+
+
+def resolve(value, results):
+    """ Replaces the {n.key} references in value, and in the strings it holds, with fields of earlier responses. """
+    if isinstance(value, str):
+        return BATCH_REFERENCE.sub(lambda match: str(results[int(match.group(1))].field(match.group(2))), value)
+    if isinstance(value, list):
+        return [resolve(item, results) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve(item, results) for key, item in value.items()}
+    return value
+
+
+class ThreadedHTTPServer(DetachMixIn, ThreadingMixIn, HTTPServer):
+
+    pass
+
+class PooledHTTPServer(DetachMixIn, WorkerPoolMixIn, HTTPServer):
+    """ Fixed worker threads with a bounded accept queue, see worker_pool.py. """
     pass
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the gardens server.")
+    parser.add_argument("port", nargs="?", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        help="number of pre-forked worker processes sharing the listening socket")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("SERVER_THREADS", 0)),
+        help="serve on a fixed pool of this many threads per process instead of a thread per connection")
+    parser.add_argument("--engine", choices=["threads", "async"], default=os.environ.get("SERVER_ENGINE", "threads"),
+        help="threads: a blocking thread per connection (or --threads). async: an event loop holds the connections and requests run on --threads threads (default 32)")
+    return parser.parse_args()
+
+
 def run():
     """ Run server. """
-
-    db = GardensDB()
+    args = parse_args()
+    if args.engine == "async" and args.threads <= 0:
+        args.threads = ASYNC_THREADS
+    if args.threads > 0:
+        # One database connection per worker thread unless set otherwise, so no thread waits on the pool
+        os.environ.setdefault("DB_POOL_MAX", str(args.threads))
+
+    db = open_db()
     db.create_tables()
     db = None
 
-    port = 8080
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
-
-    listen = ("0.0.0.0", port)
-    server = ThreadedHTTPServer(listen, GardensHTTPRequestHandler)
+    listen = ("0.0.0.0", args.port)
+    if args.engine == "async":
+        server = AsyncHTTPServer(listen, GardensHTTPRequestHandler,
+            workers=args.threads,
+            queue_size=int(os.environ.get("SERVER_QUEUE", args.threads * 4)),
+            retry_after=int(os.environ.get("SERVER_RETRY_AFTER", 1)))
+    elif args.threads > 0:
+        server = PooledHTTPServer(listen, GardensHTTPRequestHandler,
+            workers=args.threads,
+            queue_size=int(os.environ.get("SERVER_QUEUE", args.threads * 4)),
+            per_ip_limit=int(os.environ.get("SERVER_PER_IP", 0)),
+            retry_after=int(os.environ.get("SERVER_RETRY_AFTER", 1)),
+            idle_timeout=float(os.environ.get("SERVER_IDLE_TIMEOUT", 2)))
+    else:
+        server = ThreadedHTTPServer(listen, GardensHTTPRequestHandler)
+    if args.threads > 0:
+        REGISTRY.gauge("worker_pool", "Request worker pool usage",
+            lambda: {(("stat", key),): value for key, value in server.stats().items()})
 
     print(f"Server is listening on", "http://{}:{}...".format(*listen))
-    server.serve_forever()
-
-
-run()
\ No newline at end of file
+    if args.workers > 1:
+        if isinstance(STORE, MemorySessionStore):
+            print("Warning: in-memory sessions are not shared between workers, set SESSION_BACKEND")
+        if os.environ.get("GARDENS_BACKEND") == "memory":
+            print("Warning: the in-memory backend is not shared between workers, every worker sees its own data")
+        # Each worker opens its own connection pool after forking
+        PreforkMaster(server, args.workers, before_fork=close_db, before_exit=HASHER.close).run()
+    else:
+        # Drain like a pre-forked worker, shutdown() waits for serve_forever so it can't run on the serving thread
+        stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        server.serve_forever()
+        server.server_close()
+        HASHER.close()
+
+
+if __name__ == "__main__":
+    run()
\ No newline at end of file
@@ -1,24 +1,383 @@
 from os import urandom
 from base64 import b64encode
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
 
-class SessionStore():
-	""" Stores session data. """
 
-	def __init__(self):
-		self.sessions = {}
+class Session(dict):
+	""" Session data. Only stored once something is written to it, so requests that never log in don't fill the store.
+	Every write is saved through to the store. """
+
+	def __init__(self, store, session_id, data=None, stored=False):
+		super().__init__(data or {})
+		self.store = store
+		self.id = session_id
+		self.stored = stored
+
+	def __setitem__(self, key, value):
+		super().__setitem__(key, value)
+		self.store.save(self)
+
+	def __delitem__(self, key):
+		super().__delitem__(key)
+		if self.stored:
+			self.store.save(self)
+
+
+class SessionStore():
+	""" Interface for session backends. """
 
 	def generate_session_id(self):
 		r = urandom(32)
 		return b64encode(r).decode("utf-8")
 
+	def new_session(self):
+		""" Returns a new session that is not stored until something is written to it. """
+		return Session(self, self.generate_session_id())
+
 	def create_session(self):
-		sessionId = self.generate_session_id()
-		self.sessions[sessionId] = {}
-		return sessionId
+		""" Creates and stores an empty session. Returns its id. """
+		session = self.new_session()
+		self.save(session)
+		return session.id
+
+	def get_session(self, session_id):
+		""" Returns the live session with this id, or None. """
+		raise NotImplementedError
+
+	def save(self, session):
+		""" Stores the session and its current data. """
+		raise NotImplementedError
+
+	def delete_session(self, session_id):
+		raise NotImplementedError
+
+	def sweep(self):
+		""" Drops every expired session. """
+		raise NotImplementedError
+
+	def stats(self):
+		return {'sessions': len(self)}
+
+	def __len__(self):
+		raise NotImplementedError
+
+
+class SessionShard():
+	""" One lock and LRU ordered dict of sessions. Entries are session_id -> [session, created, last_seen]. """
+
+	def __init__(self, capacity):
+		self.lock = threading.Lock()
+		self.sessions = OrderedDict()
+		self.capacity = capacity
+		self.evicted = 0
+		self.expired = 0
+
+
+class MemorySessionStore(SessionStore):
+	""" Stores session data in this process. Sessions expire after idle_ttl seconds without use or max_age seconds after creation.
+	At most max_sessions are kept, evicting the least recently used. Sessions are split over lock-striped shards.
+	clock returns the current time in seconds, tests pass their own. """
+
+	def __init__(self, idle_ttl=24 * 3600, max_age=30 * 24 * 3600, max_sessions=100000, shards=16, clock=time.monotonic):
+		self.idle_ttl = idle_ttl
+		self.max_age = max_age
+		self.clock = clock
+		self.shards = [SessionShard(max(1, max_sessions // shards)) for _ in range(shards)]
+
+	def shard(self, session_id):
+		return self.shards[hash(session_id) % len(self.shards)]
+
+	def is_expired(self, entry, now):
+		_, created, last_seen = entry
+		return now - last_seen > self.idle_ttl or now - created > self.max_age
+
+	def save(self, session):
+		shard = self.shard(session.id)
+		now = self.clock()
+		with shard.lock:
+			entry = shard.sessions.get(session.id)
+			if entry != None:
+				# The data lives in the session object itself, only the order needs updating
+				entry[2] = now
+				shard.sessions.move_to_end(session.id)
+				return
+			shard.sessions[session.id] = [session, now, now]
+			session.stored = True
+			self.sweep_shard(shard, now)
+			while len(shard.sessions) > shard.capacity:
+				shard.sessions.popitem(last=False)
+				shard.evicted += 1
+
+	def get_session(self, session_id):
+		shard = self.shard(session_id)
+		now = self.clock()
+		with shard.lock:
+			entry = shard.sessions.get(session_id)
+			if entry == None:
+				return None
+			if self.is_expired(entry, now):
+				del shard.sessions[session_id]
+				shard.expired += 1
+				return None
+			# Sliding expiry and LRU order
+			entry[2] = now
+			shard.sessions.move_to_end(session_id)
+			return entry[0]
+
+	def delete_session(self, session_id):
+		shard = self.shard(session_id)
+		with shard.lock:
+			entry = shard.sessions.pop(session_id, None)
+		if entry != None:
+			entry[0].stored = False
+
+	def sweep_shard(self, shard, now, limit=8):
+		""" Drops expired sessions from the least recently used end. Called on every save so cleanup is amortized. Lock must be held. """
+		for _ in range(limit):
+			if not shard.sessions:
+				return
+			session_id, entry = next(iter(shard.sessions.items()))
+			if not self.is_expired(entry, now):
+				return
+			del shard.sessions[session_id]
+			shard.expired += 1
+
+	def sweep(self):
+		""" Drops every expired session. """
+		now = self.clock()
+		for shard in self.shards:
+			with shard.lock:
+				for session_id in [sid for sid, entry in shard.sessions.items() if self.is_expired(entry, now)]:
+					del shard.sessions[session_id]
+					shard.expired += 1
+
+	def stats(self):
+		return {
+			'backend': 'memory',
+			'sessions': len(self),
+			'evicted': sum(shard.evicted for shard in self.shards),
+			'expired': sum(shard.expired for shard in self.shards),
+		}
+
+	def __len__(self):
+		return sum(len(shard.sessions) for shard in self.shards)
+
+
+class CachedSessionStore(SessionStore):
+	""" Base for backends shared between processes. Keeps a small per-process read cache so load_session rarely goes to the backend,
+	and batches last seen updates instead of writing on every request. Subclasses implement the load/write/touch/remove methods. """
+
+	def __init__(self, idle_ttl=24 * 3600, max_age=30 * 24 * 3600, max_sessions=100000, cache_size=10000, cache_ttl=2.0, touch_interval=30.0):
+		self.idle_ttl = idle_ttl
+		self.max_age = max_age
+		self.max_sessions = max_sessions
+		self.cache_size = cache_size
+		# Other processes' logouts show up here after at most cache_ttl seconds
+		self.cache_ttl = cache_ttl
+		self.touch_interval = touch_interval
+
+		self.lock = threading.Lock()
+		# session_id -> (session, fetched_at)
+		self.cache = OrderedDict()
+		self.touched = set()
+		self.last_flush = time.monotonic()
+		self.hits = 0
+		self.misses = 0
 
 	def get_session(self, session_id):
-		if session_id in self.sessions:
-			return self.sessions[session_id]
-		return None
+		now = time.monotonic()
+		with self.lock:
+			entry = self.cache.get(session_id)
+			if entry != None and now - entry[1] < self.cache_ttl:
+				self.cache.move_to_end(session_id)
+				self.touched.add(session_id)
+				self.hits += 1
+				session = entry[0]
+			else:
+				session = None
+				self.misses += 1
+		if session == None:
+			data = self.load(session_id)
+			if data == None:
+				with self.lock:
+					self.cache.pop(session_id, None)
+				return None
+			session = Session(self, session_id, data, stored=True)
+			self.remember(session)
+		self.maybe_flush(now)
+		return session
+
+	def save(self, session):
+		self.write(session.id, json.dumps(dict(session)))
+		session.stored = True
+		self.remember(session)
+
+	def delete_session(self, session_id):
+		with self.lock:
+			entry = self.cache.pop(session_id, None)
+			self.touched.discard(session_id)
+		if entry != None:
+			entry[0].stored = False
+		self.remove(session_id)
+
+	def remember(self, session):
+		with self.lock:
+			self.cache[session.id] = (session, time.monotonic())
+			self.cache.move_to_end(session.id)
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+
+	def maybe_flush(self, now):
+		""" Writes the batched last seen times once touch_interval has passed. Also sweeps expired sessions. """
+		with self.lock:
+			if now - self.last_flush < self.touch_interval:
+				return
+			self.last_flush = now
+			touched, self.touched = self.touched, set()
+		if touched:
+			self.touch(list(touched))
+		self.sweep()
+
+	def stats(self):
+		return {
+			'sessions': len(self),
+			'cached': len(self.cache),
+			'cache_hits': self.hits,
+			'cache_misses': self.misses,
+		}
+
+	def load(self, session_id):
+		""" Returns the data dict of a live session, or None. """
+		raise NotImplementedError
+
+	def write(self, session_id, data):
+		""" Inserts or replaces the session with JSON data. """
+		raise NotImplementedError
+
+	def touch(self, session_ids):
+		""" Marks the sessions as seen now. """
+		raise NotImplementedError
+
+	def remove(self, session_id):
+		raise NotImplementedError
+
+
+class PostgresSessionStore(CachedSessionStore):
+	""" Stores sessions in the UNLOGGED sessions table, shared by every process using the database.
+	db_factory returns a GardensDB, so each process uses its own connection pool. """
+
+	def __init__(self, db_factory, **kwargs):
+		super().__init__(**kwargs)
+		self.db_factory = db_factory
+
+	def load(self, session_id):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("SELECT data FROM sessions WHERE id = %s \
+				AND last_seen > now() - make_interval(secs => %s) AND created_at > now() - make_interval(secs => %s)",
+				[session_id, self.idle_ttl, self.max_age])
+			row = cursor.fetchone()
+		if row == None:
+			return None
+		return row['data']
+
+	def write(self, session_id, data):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("INSERT INTO sessions (id, data) VALUES (%s, %s) \
+				ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, last_seen = now()", [session_id, data])
+
+	def touch(self, session_ids):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("UPDATE sessions SET last_seen = now() WHERE id = ANY(%s)", [session_ids])
+
+	def remove(self, session_id):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("DELETE FROM sessions WHERE id = %s", [session_id])
+
+	def sweep(self):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("DELETE FROM sessions WHERE last_seen < now() - make_interval(secs => %s) \
+				OR created_at < now() - make_interval(secs => %s)", [self.idle_ttl, self.max_age])
+			# Evict the least recently used past the cap
+			cursor.execute("DELETE FROM sessions WHERE id IN \
+				(SELECT id FROM sessions ORDER BY last_seen DESC OFFSET %s)", [self.max_sessions])
+
+	def stats(self):
+		stats = super().stats()
+		stats['backend'] = 'postgres'
+		return stats
+
+	def __len__(self):
+		with self.db_factory().cursor() as cursor:
+			cursor.execute("SELECT count(*) AS count FROM sessions")
+			return cursor.fetchone()['count']
+
+
+class SQLiteSessionStore(CachedSessionStore):
+	""" Stores sessions in a local SQLite file, shared by every process on the same host. """
+
+	def __init__(self, path, **kwargs):
+		super().__init__(**kwargs)
+		self.path = path
+		self.local = threading.local()
+		# Not kept open, so the store can be created before forking workers
+		con = sqlite3.connect(self.path, timeout=5.0)
+		with con:
+			con.execute("CREATE TABLE IF NOT EXISTS sessions ( \
+				id TEXT PRIMARY KEY, \
+				data TEXT NOT NULL, \
+				created_at REAL NOT NULL, \
+				last_seen REAL NOT NULL)")
+			con.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen_idx ON sessions (last_seen)")
+		con.close()
+
+	def connection(self):
+		""" Returns this thread's connection. Used as a context manager it commits the statements run in it. """
+		con = getattr(self.local, "con", None)
+		if con == None:
+			con = sqlite3.connect(self.path, timeout=5.0)
+			# WAL lets readers in other processes work while one process writes
+			con.execute("PRAGMA journal_mode=WAL")
+			con.execute("PRAGMA synchronous=NORMAL")
+			self.local.con = con
+		return con
+
+	def load(self, session_id):
+		now = time.time()
+		row = self.connection().execute("SELECT data FROM sessions WHERE id = ? AND last_seen > ? AND created_at > ?",
+			[session_id, now - self.idle_ttl, now - self.max_age]).fetchone()
+		if row == None:
+			return None
+		return json.loads(row[0])
+
+	def write(self, session_id, data):
+		now = time.time()
+		with self.connection() as con:
+			con.execute("INSERT INTO sessions (id, data, created_at, last_seen) VALUES (?, ?, ?, ?) \
+				ON CONFLICT (id) DO UPDATE SET data = excluded.data, last_seen = excluded.last_seen", [session_id, data, now, now])
+
+	def touch(self, session_ids):
+		now = time.time()
+		with self.connection() as con:
+			con.executemany("UPDATE sessions SET last_seen = ? WHERE id = ?", [(now, session_id) for session_id in session_ids])
+
+	def remove(self, session_id):
+		with self.connection() as con:
+			con.execute("DELETE FROM sessions WHERE id = ?", [session_id])
+
+	def sweep(self):
+		now = time.time()
+		with self.connection() as con:
+			con.execute("DELETE FROM sessions WHERE last_seen < ? OR created_at < ?", [now - self.idle_ttl, now - self.max_age])
+			con.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY last_seen DESC LIMIT -1 OFFSET ?)", [self.max_sessions])
+
+	def stats(self):
+		stats = super().stats()
+		stats['backend'] = 'sqlite'
+		return stats
 
-	# cleanup possibly
+	def __len__(self):
+		return self.connection().execute("SELECT count(*) FROM sessions").fetchone()[0]
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from backend import GardensBackend, OK, NOT_FOUND, FORBIDDEN, flower_point, grid_size
+from garden_export import garden_line, flower_line, comment_line
+import events
+import metrics
+
+
+def version_triggers(table, columns):
+    """ Triggers giving each written row of table the next version, and leaving a tombstone for each deleted one. """
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_version_insert AFTER INSERT ON {table} BEGIN \
+            UPDATE sync_version SET version = version + 1; \
+            UPDATE {table} SET version = (SELECT version FROM sync_version) WHERE id = NEW.id; \
+        END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_version_update AFTER UPDATE OF {columns} ON {table} BEGIN \
+            UPDATE sync_version SET version = version + 1; \
+            UPDATE {table} SET version = (SELECT version FROM sync_version) WHERE id = NEW.id; \
+        END",
+        # Rows deleted along with their garden need no tombstone
+        f"CREATE TRIGGER IF NOT EXISTS {table}_tombstones_delete AFTER DELETE ON {table} BEGIN \
+            UPDATE sync_version SET version = version + 1; \
+            INSERT INTO garden_tombstones (kind, id, garden_id, version) \
+            SELECT '{table}', OLD.id, OLD.garden_id, version FROM sync_version WHERE EXISTS (SELECT 1 FROM gardens WHERE id = OLD.garden_id); \
+        END",
+    ]
+
+
+# Same tables as migrations/0001_initial.sql, the indexes of 0002_hot_path_indexes.sql and the row versions of 0006_row_versions.sql.
+# AUTOINCREMENT so ids are never reused after a delete, like a SERIAL.
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS users ( \
+        id INTEGER PRIMARY KEY AUTOINCREMENT, \
+        first_name TEXT NOT NULL, \
+        last_name TEXT NOT NULL, \
+        email TEXT NOT NULL, \
+        password TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS gardens ( \
+        id INTEGER PRIMARY KEY AUTOINCREMENT, \
+        name TEXT NOT NULL, \
+        author TEXT NOT NULL, \
+        author_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE)",
+    "CREATE TABLE IF NOT EXISTS flowers ( \
+        id INTEGER PRIMARY KEY AUTOINCREMENT, \
+        color TEXT NOT NULL, \
+        x REAL NOT NULL, \
+        y REAL NOT NULL, \
+        garden_id INTEGER NOT NULL REFERENCES gardens(id) ON DELETE CASCADE, \
+        version INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS comments ( \
+        id INTEGER PRIMARY KEY AUTOINCREMENT, \
+        content TEXT NOT NULL, \
+        garden_id INTEGER NOT NULL REFERENCES gardens(id) ON DELETE CASCADE, \
+        author_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE, \
+        version INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS garden_tombstones ( \
+        kind TEXT NOT NULL, \
+        id INTEGER NOT NULL, \
+        garden_id INTEGER NOT NULL REFERENCES gardens(id) ON DELETE CASCADE, \
+        version INTEGER NOT NULL, \
+        PRIMARY KEY (kind, id))",
+    # Last row version handed out. Writes are serialized, so a counter is enough.
+    "CREATE TABLE IF NOT EXISTS sync_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO sync_version (id, version) VALUES (1, 0)",
+    "CREATE INDEX IF NOT EXISTS gardens_author_id_idx ON gardens (author_id)",
+    "CREATE INDEX IF NOT EXISTS flowers_garden_id_idx ON flowers (garden_id)",
+    "CREATE INDEX IF NOT EXISTS comments_garden_id_idx ON comments (garden_id)",
+    "CREATE INDEX IF NOT EXISTS comments_author_id_idx ON comments (author_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_email_idx ON users (email)",
+    "CREATE INDEX IF NOT EXISTS flowers_garden_id_version_idx ON flowers (garden_id, version)",
+    "CREATE INDEX IF NOT EXISTS comments_garden_id_version_idx ON comments (garden_id, version)",
+    "CREATE INDEX IF NOT EXISTS garden_tombstones_garden_id_version_idx ON garden_tombstones (garden_id, version)",
+    # Spatial index for viewport queries. The garden id is a dimension too, so other gardens' flowers in the same box are never visited.
+    # R*Tree coordinates are 32 bit floats rounded outwards, so matches are checked against flowers again.
+    "CREATE VIRTUAL TABLE IF NOT EXISTS flowers_rtree USING rtree(id, garden_min, garden_max, x_min, x_max, y_min, y_max)",
+    "CREATE TRIGGER IF NOT EXISTS flowers_rtree_insert AFTER INSERT ON flowers BEGIN \
+        INSERT INTO flowers_rtree VALUES (NEW.id, NEW.garden_id, NEW.garden_id, NEW.x, NEW.x, NEW.y, NEW.y); \
+    END",
+    "CREATE TRIGGER IF NOT EXISTS flowers_rtree_update AFTER UPDATE OF x, y, garden_id ON flowers BEGIN \
+        UPDATE flowers_rtree SET garden_min = NEW.garden_id, garden_max = NEW.garden_id, \
+            x_min = NEW.x, x_max = NEW.x, y_min = NEW.y, y_max = NEW.y WHERE id = NEW.id; \
+    END",
+    "CREATE TRIGGER IF NOT EXISTS flowers_rtree_delete AFTER DELETE ON flowers BEGIN \
+        DELETE FROM flowers_rtree WHERE id = OLD.id; \
+    END",
+] + version_triggers('flowers', "color, x, y, garden_id") + version_triggers('comments', "content, garden_id, author_id")
+
+QUERIES = {
+    'get_user': "SELECT id, password FROM users WHERE email = ?",
+    'get_user_by_id': "SELECT id, first_name, last_name, email FROM users WHERE id = ?",
+    'get_gardens': "SELECT id, name, author, author_id FROM gardens ORDER BY id",
+    'get_gardens_page': "SELECT id, name, author, author_id FROM gardens WHERE id > ? ORDER BY id LIMIT ?",
+    'get_user_gardens': "SELECT id, name, author, author_id FROM gardens WHERE author_id = ?",
+    'get_one_garden': "SELECT id, name, author, author_id FROM gardens WHERE id = ?",
+    'get_garden_owner': "SELECT author_id FROM gardens WHERE id = ?",
+    'get_comments': "SELECT c.id, c.content, u.first_name AS author, c.author_id FROM comments c \
+        INNER JOIN users u ON u.id = c.author_id WHERE c.garden_id = ? ORDER BY c.id",
+    'get_one_comment': "SELECT id, content, garden_id, author_id FROM comments WHERE id = ?",
+    'get_flowers': "SELECT id, color, x, y, garden_id FROM flowers WHERE garden_id = ? ORDER BY id",
+    'get_one_flower': "SELECT id, color, x, y, garden_id FROM flowers WHERE id = ?",
+    'get_sync_version': "SELECT version FROM sync_version",
+    'get_changed_comments': "SELECT c.id, c.content, u.first_name AS author, c.author_id FROM comments c \
+        INNER JOIN users u ON u.id = c.author_id WHERE c.garden_id = ? AND c.version >= ? ORDER BY c.id",
+    'get_changed_flowers': "SELECT id, color, x, y, garden_id FROM flowers WHERE garden_id = ? AND version >= ? ORDER BY id",
+    'get_tombstones': "SELECT kind, id FROM garden_tombstones WHERE garden_id = ? AND version >= ? ORDER BY id",
+    # Parameters: garden id, x0, y0, x1, y1, then the limit (-1 for none) or the grid size
+    'get_flowers_in_box': "SELECT f.id, f.color, f.x, f.y, f.garden_id FROM flowers_rtree r INNER JOIN flowers f ON f.id = r.id \
+        WHERE r.garden_min <= ?1 AND r.garden_max >= ?1 AND r.x_max >= ?2 AND r.x_min <= ?4 AND r.y_max >= ?3 AND r.y_min <= ?5 \
+        AND f.garden_id = ?1 AND f.x BETWEEN ?2 AND ?4 AND f.y BETWEEN ?3 AND ?5 ORDER BY f.id LIMIT ?6",
+    # The lowest id flower of each grid cell, the other columns come from the row MIN(id) picked
+    'get_flowers_in_box_sample': "SELECT id, color, x, y, garden_id FROM ( \
+            SELECT MIN(f.id) AS id, f.color, f.x, f.y, f.garden_id FROM flowers_rtree r INNER JOIN flowers f ON f.id = r.id \
+            WHERE r.garden_min <= ?1 AND r.garden_max >= ?1 AND r.x_max >= ?2 AND r.x_min <= ?4 AND r.y_max >= ?3 AND r.y_min <= ?5 \
+            AND f.garden_id = ?1 AND f.x BETWEEN ?2 AND ?4 AND f.y BETWEEN ?3 AND ?5 \
+            GROUP BY MIN(CAST((f.x - ?2) * ?6 / NULLIF(?4 - ?2, 0) AS INTEGER), ?6 - 1), \
+                MIN(CAST((f.y - ?3) * ?6 / NULLIF(?5 - ?3, 0) AS INTEGER), ?6 - 1) \
+        ) ORDER BY id",
+}
+
+# Each finds the row and the id of whoever may change it, plus its garden
+OWNERS = {
+    'gardens': "SELECT author_id, id AS garden_id FROM gardens WHERE id = ?",
+    'comments': "SELECT author_id, garden_id FROM comments WHERE id = ?",
+    'flowers': "SELECT g.author_id, f.garden_id FROM flowers f INNER JOIN gardens g ON g.id = f.garden_id WHERE f.id = ?",
+}
+
+# (pid, connection) for each thread
+LOCAL = threading.local()
+
+
+def dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteGardensDB(GardensBackend):
+    """ Stores everything in a local SQLite file (GARDENS_SQLITE_PATH). Every thread keeps its own connection.
+    Workers on one host share the file, but writes are serialized, so it suits small deployments and development. """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("GARDENS_SQLITE_PATH", "gardens.db")
+
+    @classmethod
+    def close_shared(cls):
+        """ Closes this thread's connection. Connections opened before a fork are never reused by the children anyway. """
+        con = getattr(LOCAL, "con", None)
+        if con != None:
+            con[1].close()
+            LOCAL.con = None
+
+    def connection(self):
+        """ Returns this thread's connection, opening a new one in a forked child. """
+        con = getattr(LOCAL, "con", None)
+        if con == None or con[0] != os.getpid():
+            # Autocommit, transactions are begun explicitly
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.row_factory = dict_row
+            # WAL lets readers work while another thread or process writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            con = (os.getpid(), connection)
+            LOCAL.con = con
+        return con[1]
+
+    @contextmanager
+    def transaction(self):
+        """ Takes the write lock up front, so reads in the transaction can't go stale before its writes. Commits on success, rolls back on error. """
+        con = self.connection()
+        if con.in_transaction:
+            # Part of a batch transaction, which commits or rolls back as a whole
+            yield con
+            return
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+    @contextmanager
+    def read(self):
+        """ Runs several reads in one transaction, so they see the same snapshot. """
+        con = self.connection()
+        if con.in_transaction:
+            yield con
+            return
+        con.execute("BEGIN")
+        try:
+            yield con
+        finally:
+            con.execute("COMMIT")
+
+    @contextmanager
+    def batch(self, transaction=False):
+        """ Every call in the block already runs on this thread's connection. With transaction it is one transaction,
+        and the events of its writes are only published once it commits. """
+        if not transaction:
+            yield self
+            return
+        with events.hold(), self.transaction():
+            yield self
+
+    def fetchone(self, sql, params):
+        return self.connection().execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def insert(self, sql, params):
+        return {'id': self.connection().execute(sql, params).lastrowid}
+
+    def owned_write(self, table, id, owner, sql, params, event, data=None):
+        """ Runs sql if owner may change the row, then publishes event for its garden.
+        Returns (OK, NOT_FOUND or FORBIDDEN, garden id of the row). """
+        with self.transaction() as con:
+            row = con.execute(OWNERS[table], [id]).fetchone()
+            if row == None:
+                return NOT_FOUND, None
+            if row['author_id'] != owner:
+                return FORBIDDEN, row['garden_id']
+            con.execute(sql, params)
+        events.publish(event, row['garden_id'], data)
+        return OK, row['garden_id']
+
+    def create_tables(self):
+        """ Create the tables for initial use. Will NOT drop old tables. """
+        with self.transaction() as con:
+            for statement in SCHEMA:
+                con.execute(statement)
+
+    def reset(self):
+        """ Drop and recreate the tables. Deletes ALL data. """
+        with self.transaction() as con:
+            for table in ['flowers_rtree', 'garden_tombstones', 'sync_version', 'comments', 'flowers', 'gardens', 'users']:
+                con.execute(f"DROP TABLE IF EXISTS {table}")
+        self.create_tables()
+
+    # USERS
+    def create_user(self, first_name, last_name, email, password):
+        """ Creates a user and stores the hashed password. """
+        return self.insert("INSERT INTO users (first_name, last_name, email, password) VALUES (?, ?, ?, ?)", [first_name, last_name, email, password])
+
+    def get_user(self, email):
+        """ Returns the id and password hash of the user with email, for logging in. """
+        return self.fetchone(QUERIES['get_user'], [email])
+
+    def get_user_by_id(self, uid):
+        """ Returns the user's info, without the password hash. """
+        return self.fetchone(QUERIES['get_user_by_id'], [uid])
+
+    def update_user_password(self, uid, password):
+        """ Replaces the user's hashed password. """
+        self.connection().execute("UPDATE users SET password = ? WHERE id = ?", [password, uid])
+
+    # GARDENS
+    def create_garden(self, name, author, userid):
+        """ Creates a garden and returns the id of the created garden. """
+        return self.insert("INSERT INTO gardens (name, author, author_id) VALUES (?, ?, ?)", [name, author, userid])
+
+    def get_gardens(self):
+        """ Returns dict of garden info. """
+        return self.fetchall(QUERIES['get_gardens'])
+
+    def get_gardens_page(self, limit, after=None):
+        """ Returns up to limit gardens with id > after, in id order, and the cursor for the next page (None on the last page). """
+        rows = self.fetchall(QUERIES['get_gardens_page'], [after or 0, limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1]['id']
+        return rows, None
+
+    def iter_gardens(self, batch_size=500):
+        """ Yields lists of at most batch_size gardens, one keyset page per query so no read stays open between batches. """
+        after = None
+        while True:
+            rows, after = self.get_gardens_page(batch_size, after)
+            if rows:
+                yield rows
+            if after == None:
+                break
+
+    def get_user_gardens(self, userid):
+        """ Returns all gardens created by a user. """
+        return self.fetchall(QUERIES['get_user_gardens'], [userid])
+
+    def get_one_garden(self, id):
+        """ Returns dict of specific garden info, including comments and flowers. Read in one transaction so the parts agree. """
+        with self.read() as con:
+            data = con.execute(QUERIES['get_one_garden'], [id]).fetchone()
+            if data != None:
+                data['comments'] = con.execute(QUERIES['get_comments'], [id]).fetchall()
+                data['flowers'] = con.execute(QUERIES['get_flowers'], [id]).fetchall()
+        return data
+
+    def get_one_garden_json(self, id, materialized=False):
+        """ Returns get_one_garden serialized as JSON text, or None. There is no materialized table in SQLite. """
+        data = self.get_one_garden(id)
+        if data == None:
+            return None
+        return json.dumps(data)
+
+    def get_garden_changes(self, id, since):
+        """ Returns the garden's flowers and comments written since a version, and the ids of those deleted, as JSON text, or None. """
+        with self.read() as con:
+            data = con.execute(QUERIES['get_one_garden'], [id]).fetchone()
+            if data != None:
+                # Writes are serialized, so this read sees every version up to the current one
+                data['version'] = con.execute(QUERIES['get_sync_version']).fetchone()['version'] + 1
+                data['full'] = since == 0
+                data['comments'] = con.execute(QUERIES['get_changed_comments'], [id, since]).fetchall()
+                data['flowers'] = con.execute(QUERIES['get_changed_flowers'], [id, since]).fetchall()
+                data['deleted'] = {'comments': [], 'flowers': []}
+                if since > 0:
+                    for row in con.execute(QUERIES['get_tombstones'], [id, since]):
+                        data['deleted'][row['kind']].append(row['id'])
+        if data == None:
+            return None
+        return json.dumps(data)
+
+    def get_garden_owner(self, id):
+        """ Returns the author_id of a garden, or None if it doesn't exist. """
+        row = self.fetchone(QUERIES['get_garden_owner'], [id])
+        if row == None:
+            return None
+        return row['author_id']
+
+    def update_garden(self, id, name, owner):
+        """ Renames the garden if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        return self.owned_write('gardens', id, owner, "UPDATE gardens SET name = ? WHERE id = ?", [name, id], 'garden_updated', {'name': name})[0]
+
+    def delete_garden(self, id, owner):
+        """ Deletes the garden if owner wrote it. Returns OK, NOT_FOUND or FORBIDDEN. """
+        return self.owned_write('gardens', id, owner, "DELETE FROM gardens WHERE id = ?", [id], 'garden_deleted')[0]
+
+    # COMMENTS
+    def create_comment(self, garden_id, comment, user_id):
+        created = self.insert("INSERT INTO comments (content, garden_id, author_id) VALUES (?, ?, ?)", [comment, garden_id, user_id])
+        author = self.fetchone("SELECT first_name FROM users WHERE id = ?", [user_id])
+        events.publish('comment_added', garden_id, {'id': created['id'], 'content': comment, 'author': author and author['first_name'], 'author_id': int(user_id)})
+        return created
+
+    def get_comments(self, garden_id):
+        """ Returns all comments from the garden with {id = garden_id} """
+        return self.fetchall(QUERIES['get_comments'], [garden_id])
+
+    def get_one_comment(self, id):
+        return self.fetchone(QUERIES['get_one_comment'], [id])
+
+    def update_comment(self, id, content, owner):
+        """ Changes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        return self.owned_write('comments', id, owner, "UPDATE comments SET content = ? WHERE id = ?", [content, id], 'comment_updated', {'id': id, 'content': content})
+
+    def delete_comment(self, id, owner):
+        """ Deletes the comment if owner wrote it. Returns (OK, NOT_FOUND or FORBIDDEN, the comment's garden id). """
+        return self.owned_write('comments', id, owner, "DELETE FROM comments WHERE id = ?", [id], 'comment_deleted', {'id': id})
+
+    # FLOWERS
+    def create_flower(self, garden_id, color, x, y):
+        x, y = flower_point(x, y)
+        created = self.insert("INSERT INTO flowers (color, x, y, garden_id) VALUES (?, ?, ?, ?)", [color, x, y, garden_id])
+        events.publish('flower_added', garden_id, {'id': created['id'], 'color': color, 'x': x, 'y': y, 'garden_id': int(garden_id)})
+        return created
+
+    def create_flowers(self, garden_id, flowers):
+        """ Inserts (color, x, y) flowers into a garden in one transaction. Returns the created ids in order. """
+        if not flowers:
+            return []
+        flowers = [(color, *flower_point(x, y)) for color, x, y in flowers]
+        with self.transaction() as con:
+            ids = [con.execute("INSERT INTO flowers (color, x, y, garden_id) VALUES (?, ?, ?, ?)", [color, x, y, garden_id]).lastrowid
+                for color, x, y in flowers]
+        events.publish('flowers_added', garden_id, [{'id': id, 'color': color, 'x': x, 'y': y, 'garden_id': int(garden_id)} for id, (color, x, y) in zip(ids, flowers)])
+        return ids
+
+    def get_flowers(self, garden_id):
+        """ Returns all flowers from the garden with {id = garden_id} """
+        return self.fetchall(QUERIES['get_flowers'], [garden_id])
+
+    def get_flowers_in_box(self, garden_id, x0, y0, x1, y1, limit=None):
+        """ Returns the garden's flowers inside the box in id order, and whether they were sampled down to about limit. """
+        box = [garden_id, x0, y0, x1, y1]
+        rows = self.fetchall(QUERIES['get_flowers_in_box'], box + [limit + 1 if limit else -1])
+        if not limit or len(rows) <= limit:
+            return rows, False
+        return self.fetchall(QUERIES['get_flowers_in_box_sample'], box + [grid_size(limit)]), True
+
+    def get_one_flower(self, id):
+        return self.fetchone(QUERIES['get_one_flower'], [id])
+
+    def delete_flower(self, id, owner):
+        """ Deletes the flower if owner wrote its garden. Returns (OK, NOT_FOUND or FORBIDDEN, the flower's garden id). """
+        return self.owned_write('flowers', id, owner, "DELETE FROM flowers WHERE id = ?", [id], 'flower_deleted', {'id': id})
+
+    # EXPORT
+    def export_garden(self, id, write):
+        """ Writes the garden's lines as the cursors step through its rows, all in one read transaction. """
+        with self.read() as con:
+            garden = con.execute(QUERIES['get_one_garden'], [id]).fetchone()
+            if garden == None:
+                return
+            write(garden_line(garden))
+            for flower in con.execute(QUERIES['get_flowers'], [id]):
+                write(flower_line(flower))
+            for comment in con.execute(QUERIES['get_comments'], [id]):
+                write(comment_line(comment))
+
+    def import_garden(self, garden, userid):
+        """ Inserts the rows as they are read, in one transaction. It holds the write lock until the whole body is in. """
+        with self.transaction() as con:
+            id = con.execute("INSERT INTO gardens (name, author, author_id) VALUES (?, ?, ?)", [garden.name, garden.author, userid]).lastrowid
+            flowers = con.executemany("INSERT INTO flowers (color, x, y, garden_id) VALUES (?, ?, ?, ?)",
+                ((color, x, y, id) for color, x, y in garden.flowers())).rowcount
+            comments = con.executemany("INSERT INTO comments (content, garden_id, author_id) VALUES (?, ?, ?)",
+                ((content, id, userid) for content in garden.comments())).rowcount
+        return {'id': id, 'flowers': flowers, 'comments': comments}
+
+
+# Record call counts, durations and rows for every backend method, under the same names as postgres
+metrics.instrument(SQLiteGardensDB, metrics.REGISTRY, "gardens_db",
+    skip={'connection', 'transaction', 'read', 'batch', 'fetchone', 'fetchall', 'insert', 'owned_write', 'close_shared'})
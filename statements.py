@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+
+from metrics import REGISTRY
+
+# Set to 0 behind a pooler that doesn't keep one server session per client connection (pgbouncer in transaction mode)
+PREPARE = os.environ.get("DB_PREPARE", "1") != "0"
+
+# psycopg2 placeholders: %(name)s, %s and an escaped %
+PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+REGISTRY.describe("db_statement_executions_total", "counter", "Executions of each registered statement")
+REGISTRY.describe("db_statement_seconds", "histogram", "Execution time of each registered statement, without fetching the rows")
+REGISTRY.describe("db_statement_prepares_total", "counter", "PREPAREs of each registered statement, one per physical connection")
+
+
+def to_numbered(sql):
+    """ Returns sql with $1, $2... in place of psycopg2 placeholders, and the keys of named placeholders in parameter order (None if positional). """
+    keys = []
+    count = 0
+
+    def replace(match):
+        nonlocal count
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) == None:
+            count += 1
+            return f"${count}"
+        if match.group(1) not in keys:
+            keys.append(match.group(1))
+        return f"${keys.index(match.group(1)) + 1}"
+
+    numbered = PLACEHOLDER.sub(replace, sql)
+    if count and keys:
+        raise ValueError("can't mix positional and named placeholders")
+    if keys:
+        return numbered, keys, len(keys)
+    return numbered, None, count
+
+
+class Statement:
+    """ A query prepared under a fixed name on every connection that runs it. """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        numbered, self.keys, count = to_numbered(sql)
+        self.prepare_sql = f"PREPARE {name} AS {numbered}"
+        if count:
+            self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * count)})"
+        else:
+            self.execute_sql = f"EXECUTE {name}"
+
+    def arguments(self, params):
+        if self.keys != None:
+            return [params[key] for key in self.keys]
+        return list(params)
+
+
+class StatementRegistry:
+    """ Named queries that are PREPAREd once per physical connection and EXECUTEd after that, so postgres parses and plans them once.
+    Connections remember what they prepared in a `prepared` set (see db_pool.Connection). Others, or every connection when
+    DB_PREPARE=0, run the plain SQL. Each execution is counted and timed by statement name. """
+
+    def __init__(self, prefix):
+        # Keeps the server side names apart from anything else preparing statements on the same connections
+        self.prefix = prefix
+        self.statements = {}
+
+    def add(self, name, sql):
+        self.statements[name] = Statement(self.prefix + name, sql)
+
+    def add_all(self, queries):
+        for name, sql in queries.items():
+            self.add(name, sql)
+
+    def execute(self, cursor, name, params=()):
+        """ Runs the statement on cursor. params is a list, or a dict for named placeholders. """
+        statement = self.statements[name]
+        labels = (("statement", name),)
+        prepared = getattr(cursor.connection, "prepared", None)
+        start = time.perf_counter()
+        try:
+            if not PREPARE or prepared == None:
+                cursor.execute(statement.sql, params)
+                return
+            # Prepared statements belong to the session, not the transaction, so a rollback doesn't undo this
+            if statement.name not in prepared:
+                cursor.execute(statement.prepare_sql)
+                prepared.add(statement.name)
+                REGISTRY.inc("db_statement_prepares_total", labels)
+            cursor.execute(statement.execute_sql, statement.arguments(params))
+        finally:
+            REGISTRY.observe("db_statement_seconds", labels, time.perf_counter() - start)
+            REGISTRY.inc("db_statement_executions_total", labels)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from backend import IntegrityError, OK, NOT_FOUND, FORBIDDEN
+from garden_export import BadImport, GardenImport
+from memory_db import MemoryGardensDB, MemoryTables
+from sqlite_db import SQLiteGardensDB
+
+
+class BackendContract:
+    """ The GardensBackend contract, run against every backend that needs no server. Subclasses set up self.db. """
+
+    # What a write referencing a missing row raises
+    integrity_errors = (IntegrityError,)
+
+    def user(self, email="ann@example.com"):
+        return self.db.create_user("Ann", "Lee", email, "hash")['id']
+
+    def garden(self, owner, name="Roses"):
+        return self.db.create_garden(name, "Ann", owner)['id']
+
+    # USERS
+
+    def test_users(self):
+        uid = self.user()
+        self.assertEqual(self.db.get_user("ann@example.com"), {'id': uid, 'password': "hash"})
+        self.assertEqual(self.db.get_user_by_id(uid), {'id': uid, 'first_name': "Ann", 'last_name': "Lee", 'email': "ann@example.com"})
+        self.assertIsNone(self.db.get_user("nobody@example.com"))
+        self.db.update_user_password(uid, "new")
+        self.assertEqual(self.db.get_user("ann@example.com")['password'], "new")
+
+    def test_duplicate_email(self):
+        self.user()
+        with self.assertRaises(self.integrity_errors):
+            self.user()
+
+    # GARDENS
+
+    def test_gardens_pages(self):
+        uid = self.user()
+        ids = [self.garden(uid, f"g{n}") for n in range(5)]
+        rows, after = self.db.get_gardens_page(2)
+        self.assertEqual([row['id'] for row in rows], ids[:2])
+        self.assertEqual(after, ids[1])
+        rows, after = self.db.get_gardens_page(10, after)
+        self.assertEqual([row['id'] for row in rows], ids[2:])
+        self.assertIsNone(after)
+        self.assertEqual([row['id'] for rows in self.db.iter_gardens(2) for row in rows], ids)
+        self.assertEqual(sorted(row['id'] for row in self.db.get_user_gardens(uid)), ids)
+
+    def test_one_garden(self):
+        uid = self.user()
+        gid = self.garden(uid)
+        self.db.create_flowers(gid, [("red", 1, 2), ("blue", 3, 4)])
+        self.db.create_comment(gid, "Hello", uid)
+        garden = self.db.get_one_garden(gid)
+        self.assertEqual((garden['name'], garden['author_id']), ("Roses", uid))
+        self.assertEqual([(f['color'], f['x'], f['y'], f['garden_id']) for f in garden['flowers']], [("red", 1.0, 2.0, gid), ("blue", 3.0, 4.0, gid)])
+        self.assertEqual([(c['content'], c['author'], c['author_id']) for c in garden['comments']], [("Hello", "Ann", uid)])
+        self.assertEqual(json.loads(self.db.get_one_garden_json(gid)), garden)
+        self.assertIsNone(self.db.get_one_garden(gid + 1))
+        self.assertIsNone(self.db.get_one_garden_json(gid + 1))
+        self.assertEqual(self.db.get_garden_owner(gid), uid)
+        self.assertIsNone(self.db.get_garden_owner(gid + 1))
+
+    def test_garden_needs_user(self):
+        with self.assertRaises(self.integrity_errors):
+            self.db.create_garden("Roses", "Ann", 50)
+
+    def test_owned_writes(self):
+        uid = self.user()
+        other = self.user("bob@example.com")
+        gid = self.garden(uid)
+        flower = self.db.create_flower(gid, "red", 1, 2)['id']
+        comment = self.db.create_comment(gid, "Hello", uid)['id']
+
+        self.assertEqual(self.db.update_garden(gid, "Tulips", other), FORBIDDEN)
+        self.assertEqual(self.db.update_garden(gid + 1, "Tulips", uid), NOT_FOUND)
+        self.assertEqual(self.db.update_garden(gid, "Tulips", uid), OK)
+        self.assertEqual(self.db.get_one_garden(gid)['name'], "Tulips")
+
+        self.assertEqual(self.db.update_comment(comment, "Hi", other), (FORBIDDEN, gid))
+        self.assertEqual(self.db.update_comment(comment, "Hi", uid), (OK, gid))
+        self.assertEqual(self.db.get_comments(gid)[0]['content'], "Hi")
+        self.assertEqual(self.db.delete_comment(comment, uid), (OK, gid))
+        self.assertEqual(self.db.delete_comment(comment, uid)[0], NOT_FOUND)
+
+        self.assertEqual(self.db.delete_flower(flower, other), (FORBIDDEN, gid))
+        self.assertEqual(self.db.delete_flower(flower, uid), (OK, gid))
+        self.assertIsNone(self.db.get_one_flower(flower))
+
+        self.assertEqual(self.db.delete_garden(gid, other), FORBIDDEN)
+        self.assertEqual(self.db.delete_garden(gid, uid), OK)
+        self.assertIsNone(self.db.get_one_garden(gid))
+        self.assertEqual(self.db.delete_garden(gid, uid), NOT_FOUND)
+
+    def test_delete_garden_removes_rows(self):
+        uid = self.user()
+        gid = self.garden(uid)
+        flower = self.db.create_flower(gid, "red", 1, 2)['id']
+        comment = self.db.create_comment(gid, "Hello", uid)['id']
+        self.db.delete_garden(gid, uid)
+        self.assertIsNone(self.db.get_one_flower(flower))
+        self.assertIsNone(self.db.get_one_comment(comment))
+
+    # FLOWERS AND COMMENTS
+
+    def test_rows_need_garden(self):
+        uid = self.user()
+        missing = self.garden(uid) + 1
+        with self.assertRaises(self.integrity_errors):
+            self.db.create_flower(missing, "red", 1, 2)
+        with self.assertRaises(self.integrity_errors):
+            self.db.create_flowers(missing, [("red", 1, 2)])
+        with self.assertRaises(self.integrity_errors):
+            self.db.create_comment(missing, "Hello", uid)
+        # The garden that later gets the id must not inherit anything
+        self.assertEqual(self.garden(uid), missing)
+        garden = self.db.get_one_garden(missing)
+        self.assertEqual((garden['flowers'], garden['comments']), ([], []))
+
+    def test_comment_needs_user(self):
+        gid = self.garden(self.user())
+        with self.assertRaises(self.integrity_errors):
+            self.db.create_comment(gid, "Hello", 50)
+        self.assertEqual(self.db.get_comments(gid), [])
+
+    def test_bulk_flowers(self):
+        gid = self.garden(self.user())
+        self.assertEqual(self.db.create_flowers(gid, []), [])
+        ids = self.db.create_flowers(gid, [("red", n, n) for n in range(10)])
+        self.assertEqual(len(ids), 10)
+        self.assertEqual([flower['id'] for flower in self.db.get_flowers(gid)], ids)
+
+    def test_flowers_in_box(self):
+        gid = self.garden(self.user())
+        other = self.garden(self.user("bob@example.com"))
+        self.db.create_flowers(gid, [("red", x, y) for x in range(10) for y in range(10)])
+        self.db.create_flowers(other, [("red", 5, 5)])
+        flowers, sampled = self.db.get_flowers_in_box(gid, 2, 2, 4, 3)
+        self.assertFalse(sampled)
+        self.assertEqual(sorted((f['x'], f['y']) for f in flowers), [(x, y) for x in (2.0, 3.0, 4.0) for y in (2.0, 3.0)])
+        self.assertTrue(all(f['garden_id'] == gid for f in flowers))
+        flowers, sampled = self.db.get_flowers_in_box(gid, 0, 0, 9, 9, 4)
+        self.assertTrue(sampled)
+        self.assertLessEqual(len(flowers), 4)
+
+        # Refused before anything is stored, a flower off the grid could be neither found nor deleted
+        for x, y in ((math.nan, 1), (1, math.inf), (-math.inf, 1), ("nan", "1")):
+            with self.assertRaises(ValueError):
+                self.db.create_flower(gid, "red", x, y)
+            with self.assertRaises(ValueError):
+                self.db.create_flowers(gid, [("red", 1, 1), ("red", x, y)])
+        self.assertEqual(len(self.db.get_flowers(gid)), 100)
+        self.assertEqual(len(self.db.get_flowers_in_box(gid, 0, 0, 9, 9)[0]), 100)
+
+    # SYNC
+
+    def test_garden_changes(self):
+        uid = self.user()
+        gid = self.garden(uid)
+        first = self.db.create_flower(gid, "red", 1, 2)['id']
+        full = json.loads(self.db.get_garden_changes(gid, 0))
+        self.assertTrue(full['full'])
+        self.assertEqual([f['id'] for f in full['flowers']], [first])
+
+        second = self.db.create_flower(gid, "blue", 3, 4)['id']
+        self.db.delete_flower(first, uid)
+        delta = json.loads(self.db.get_garden_changes(gid, full['version']))
+        self.assertFalse(delta['full'])
+        self.assertEqual([f['id'] for f in delta['flowers']], [second])
+        self.assertEqual(delta['deleted'], {'comments': [], 'flowers': [first]})
+        self.assertIsNone(self.db.get_garden_changes(gid + 1, 0))
+
+    # BATCH
+
+    def test_batch_transaction_rolls_back(self):
+        uid = self.user()
+        with self.assertRaises(RuntimeError):
+            with self.db.batch(transaction=True) as db:
+                gid = self.garden(uid)
+                db.create_flower(gid, "red", 1, 2)
+                raise RuntimeError()
+        self.assertIsNone(self.db.get_one_garden(gid))
+
+    def test_batch_transaction_commits(self):
+        uid = self.user()
+        with self.db.batch(transaction=True) as db:
+            gid = self.garden(uid)
+            db.create_flower(gid, "red", 1, 2)
+        self.assertEqual(len(self.db.get_flowers(gid)), 1)
+
+    # EXPORT
+
+    def export(self, gid):
+        parts = []
+        self.db.export_garden(gid, parts.append)
+        return b"".join(parts)
+
+    def test_export_import(self):
+        uid = self.user()
+        gid = self.garden(uid)
+        self.db.create_flowers(gid, [("red", 1.5, -2), ("blue", 3, 4)])
+        self.db.create_comment(gid, 'Say "hi",\nthen go', uid)
+        exported = self.export(gid)
+        lines = [json.loads(line) for line in exported.splitlines()]
+        self.assertEqual([line['type'] for line in lines], ["garden", "flower", "flower", "comment"])
+
+        other = self.user("bob@example.com")
+        created = self.db.import_garden(GardenImport(exported.splitlines(keepends=True)), other)
+        self.assertEqual((created['flowers'], created['comments']), (2, 1))
+        copy = self.db.get_one_garden(created['id'])
+        original = self.db.get_one_garden(gid)
+        self.assertEqual(copy['author_id'], other)
+        self.assertEqual([(f['color'], f['x'], f['y']) for f in copy['flowers']], [(f['color'], f['x'], f['y']) for f in original['flowers']])
+        self.assertEqual([(c['content'], c['author_id']) for c in copy['comments']], [('Say "hi",\nthen go', other)])
+        self.assertEqual(self.export(gid + 100), b"")
+
+    def test_broken_import_keeps_nothing(self):
+        uid = self.user()
+        gid = self.garden(uid)
+        self.db.create_flowers(gid, [("red", 1, 2)])
+        lines = self.export(gid).splitlines(keepends=True) + [b'{"type": "flower", "color": "red", "x": "left", "y": 0}\n']
+        with self.assertRaises(BadImport):
+            self.db.import_garden(GardenImport(lines), uid)
+        self.assertEqual([row['id'] for rows in self.db.iter_gardens() for row in rows], [gid])
+
+
+class MemoryBackendTest(BackendContract, unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryGardensDB(MemoryTables())
+
+
+class SQLiteBackendTest(BackendContract, unittest.TestCase):
+
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = SQLiteGardensDB(os.path.join(self.dir.name, "gardens.db"))
+        self.db.create_tables()
+
+    def tearDown(self):
+        # Every thread keeps one connection, whatever the path
+        SQLiteGardensDB.close_shared()
+        self.dir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
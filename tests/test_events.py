@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+
+from events import EventHub
+
+
+class EventHubWatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = EventHub()
+        self.seen = []
+        self.hub.watch(lambda kind, garden_id: self.seen.append((kind, garden_id)))
+
+    def publish(self, kind, garden_id):
+        self.hub.publish(json.dumps({'type': kind, 'garden_id': garden_id, 'data': None}))
+
+    def test_watchers_see_every_event_once_started(self):
+        # Before the hub runs in this process nothing is delivered, and nothing can be cached yet either
+        self.publish("flower_added", 1)
+        self.assertEqual(self.seen, [])
+        self.hub.start()
+        self.publish("flower_added", 1)
+        self.publish("garden_updated", 2)
+        # Nobody subscribed to either garden
+        self.assertEqual(self.seen, [("flower_added", 1), ("garden_updated", 2)])
+
+    def test_listening_tells_watchers_events_were_missed(self):
+        self.hub.start()
+        self.hub.listening(False)
+        self.assertEqual(self.seen, [(None, None)])
+        self.hub.listening(True)
+        self.assertEqual(self.seen, [(None, None), (None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import threading
+import unittest
+
+from metrics import MIN_PRUNE_SHARDS, Registry
+
+
+class RegistryTest(unittest.TestCase):
+
+    def record(self, registry, wait=None):
+        registry.inc("requests_total", (("route", "/gardens"),))
+        registry.observe("request_seconds", (), 0.002)
+        if wait != None:
+            wait.wait()
+
+    def run_threads(self, registry, count, wait=None):
+        """ Starts count threads that record once. Without wait each one finishes before the next starts, like a thread per connection. """
+        threads = [threading.Thread(target=self.record, args=(registry, wait), daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+            if wait == None:
+                thread.join()
+        return threads
+
+    def test_exited_threads_are_folded_in_without_a_scrape(self):
+        registry = Registry()
+        most = 0
+        for _ in range(1000):
+            self.run_threads(registry, 1)
+            most = max(most, len(registry.shards))
+        self.assertLessEqual(most, MIN_PRUNE_SHARDS)
+        rendered = registry.render()
+        self.assertIn('requests_total{route="/gardens"} 1000', rendered)
+        self.assertIn("request_seconds_count 1000", rendered)
+        self.assertEqual(registry.shards, [])
+
+    def test_live_threads_keep_their_shards(self):
+        registry = Registry()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        threads = self.run_threads(registry, MIN_PRUNE_SHARDS * 2, release)
+        self.run_threads(registry, 10)
+        # Every live thread still records into its own shard
+        self.assertGreaterEqual(len(registry.shards), MIN_PRUNE_SHARDS * 2)
+        self.assertIn(f'requests_total{{route="/gardens"}} {MIN_PRUNE_SHARDS * 2 + 10}', registry.render())
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.run_threads(registry, 1)
+        self.assertIn(f'requests_total{{route="/gardens"}} {MIN_PRUNE_SHARDS * 2 + 11}', registry.render())
+        self.assertEqual(registry.shards, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
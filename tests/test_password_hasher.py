@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import time
+import unittest
+
+if importlib.util.find_spec("passlib"):
+    from password_hasher import HasherBusy, PasswordHasher
+
+# Seconds a caller waits for a job, and how long a slow job runs past it
+TIMEOUT = 0.3
+SLOW = 1.5
+
+
+@unittest.skipUnless(importlib.util.find_spec("passlib"), "password_hasher needs passlib")
+class PasswordHasherTest(unittest.TestCase):
+
+    def hasher(self, queue_limit):
+        hasher = PasswordHasher(workers=1, queue_limit=queue_limit, timeout=TIMEOUT)
+        self.addCleanup(hasher.close)
+        # Starts the process, so its start up isn't taken for a slow job
+        self.assertEqual(hasher.run(abs, -1), 1)
+        return hasher
+
+    def wait_idle(self, hasher):
+        deadline = time.monotonic() + SLOW * 4
+        while hasher.stats()['pending'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return hasher.stats()
+
+    def test_timed_out_job_keeps_its_slot(self):
+        hasher = self.hasher(queue_limit=1)
+        with self.assertRaises(HasherBusy):
+            hasher.run(time.sleep, SLOW)
+        # The caller gave up, but the job still holds the process
+        self.assertEqual(hasher.stats()['pending'], 1)
+        start = time.monotonic()
+        with self.assertRaises(HasherBusy):
+            hasher.run(abs, -2)
+        # Refused straight away instead of waiting for the timeout
+        self.assertLess(time.monotonic() - start, TIMEOUT)
+        self.assertEqual(hasher.stats()['rejected'], 1)
+
+        stats = self.wait_idle(hasher)
+        self.assertEqual((stats['pending'], stats['completed']), (0, 2))
+        self.assertEqual(hasher.run(abs, -3), 3)
+
+    def test_unstarted_jobs_are_cancelled(self):
+        hasher = self.hasher(queue_limit=8)
+        for _ in range(4):
+            with self.assertRaises(HasherBusy):
+                hasher.run(time.sleep, SLOW)
+        # Only the running job and the ones the pool already handed to its process keep their slots
+        self.assertLess(hasher.stats()['pending'], 4)
+        stats = self.wait_idle(hasher)
+        self.assertEqual(stats['pending'], 0)
+        self.assertLess(stats['completed'], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
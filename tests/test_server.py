@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from urllib.parse import urlencode
+
+# Where server.py is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds a started server has to accept connections
+START_TIMEOUT = 15
+# Body limits the servers under test run with, small enough to cross cheaply
+MAX_BODY = 64 * 1024
+MAX_IMPORT = 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Client:
+    """ One keep-alive connection to the server, sending back the session cookie it was given. """
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        """ Returns the response and its body. dict bodies are sent as form fields, lists as JSON and bytes as they are. """
+        headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif isinstance(body, list):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";")[0]
+        return response, data
+
+    def status(self, method, path, body=None, headers=None):
+        return self.request(method, path, body, headers)[0].status
+
+    def json(self, method, path, body=None, headers=None):
+        """ Returns the status and the parsed JSON body. """
+        response, data = self.request(method, path, body, headers)
+        return response.status, json.loads(data) if data else None
+
+    def close(self):
+        self.connection.close()
+
+
+@unittest.skipUnless(importlib.util.find_spec("passlib"), "server.py needs passlib")
+class ServerContract:
+    """ The HTTP API, run against a server.py on the memory backend. Subclasses pick the engine. """
+
+    engine = None
+    # Tells the users each test signs up apart, the server is shared by the whole class
+    emails = itertools.count()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = free_port()
+        # The lowest bcrypt cost, every test signs up and logs in
+        env = dict(os.environ, GARDENS_BACKEND="memory", SESSION_BACKEND="memory", SERVER_ENGINE=cls.engine, BCRYPT_ROUNDS="4",
+            SERVER_MAX_BODY=str(MAX_BODY), SERVER_MAX_IMPORT=str(MAX_IMPORT))
+        cls.server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(cls.port)], cwd=ROOT, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", cls.port), timeout=1).close()
+                return
+            except OSError:
+                if cls.server.poll() != None or time.monotonic() > deadline:
+                    cls.server.kill()
+                    raise RuntimeError(f"server.py --engine {cls.engine} didn't start")
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait(START_TIMEOUT)
+
+    def client(self):
+        client = Client(self.port)
+        self.addCleanup(client.close)
+        return client
+
+    def user(self):
+        """ Returns a client logged in as a new user, and the user's id. """
+        client = self.client()
+        email = f"user{next(self.emails)}@example.com"
+        self.assertEqual(client.status("POST", "/users", {'first_name': "Ann", 'last_name': "Lee", 'email': email, 'password': "pw"}), 201)
+        self.assertEqual(client.status("POST", "/sessions", {'email': email, 'password': "pw"}), 201)
+        return client, client.json("GET", "/me")[1]['id']
+
+    def garden(self, client, name="Roses"):
+        status, created = client.json("POST", "/gardens", {'name': name, 'author': "Ann"})
+        self.assertEqual(status, 201)
+        return created['id']
+
+    def raw(self, data):
+        """ Sends data on a new connection and returns the socket, for what http.client can't send. """
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        self.addCleanup(sock.close)
+        sock.sendall(data)
+        return sock
+
+    def receive(self, sock, until):
+        """ Reads from sock until until has arrived, or the server closed it. """
+        data = b""
+        while until not in data:
+            part = sock.recv(65536)
+            if not part:
+                break
+            data += part
+        return data
+
+    # USERS AND SESSIONS
+
+    def test_sessions(self):
+        client = self.client()
+        self.assertEqual(client.status("POST", "/users", {'first_name': "Ann", 'last_name': "Lee", 'email': "ann@example.com", 'password': "pw"}), 201)
+        self.assertEqual(client.status("POST", "/users", {'first_name': "Ann", 'last_name': "Lee", 'email': "ann@example.com", 'password': "pw"}), 422)
+        self.assertEqual(client.status("GET", "/me"), 401)
+        self.assertEqual(client.status("POST", "/sessions", {'email': "ann@example.com", 'password': "wrong"}), 401)
+        self.assertEqual(client.status("POST", "/sessions", {'email': "ann@example.com", 'password': "pw"}), 201)
+        status, me = client.json("GET", "/me")
+        self.assertEqual((status, me['first_name'], me['last_name'], me['gardens']), (200, "Ann", "Lee", []))
+        self.assertEqual(client.status("DELETE", "/sessions"), 200)
+        self.assertEqual(client.status("GET", "/me"), 401)
+
+    # GARDENS
+
+    def test_gardens(self):
+        client, uid = self.user()
+        other, _ = self.user()
+        gid = self.garden(client)
+        status, garden = client.json("GET", f"/gardens/{gid}")
+        self.assertEqual((status, garden['name'], garden['author_id']), (200, "Roses", uid))
+        self.assertIn(gid, [row['id'] for row in client.json("GET", "/gardens")[1]])
+        self.assertEqual(self.client().status("POST", "/gardens", {'name': "Tulips", 'author': "Ann"}), 401)
+
+        self.assertEqual(other.status("PUT", f"/gardens/{gid}", {'name': "Tulips"}), 403)
+        self.assertEqual(client.status("PUT", f"/gardens/{gid}", {'name': "Tulips"}), 204)
+        self.assertEqual(client.json("GET", f"/gardens/{gid}")[1]['name'], "Tulips")
+        self.assertEqual(other.status("DELETE", f"/gardens/{gid}"), 403)
+        self.assertEqual(client.status("DELETE", f"/gardens/{gid}"), 204)
+        self.assertEqual(client.status("GET", f"/gardens/{gid}"), 404)
+
+    # FLOWERS AND COMMENTS
+
+    def test_flowers_and_comments(self):
+        client, uid = self.user()
+        other, _ = self.user()
+        gid = self.garden(client)
+        self.assertEqual(client.status("POST", "/flowers", {'gardenId': gid, 'color': "red", 'x': 1, 'y': 2}), 201)
+        status, created = client.json("POST", f"/gardens/{gid}/flowers", [{'color': "blue", 'x': 5, 'y': 5}, {'color': "white", 'x': 9, 'y': 9}])
+        self.assertEqual((status, len(created)), (201, 2))
+        self.assertEqual(other.status("POST", f"/gardens/{gid}/flowers", [{'color': "blue", 'x': 5, 'y': 5}]), 403)
+
+        status, flowers = client.json("GET", f"/gardens/{gid}/flowers")
+        self.assertEqual((status, [flower['color'] for flower in flowers]), (200, ["red", "blue", "white"]))
+        response, data = client.request("GET", f"/gardens/{gid}/flowers?bbox=0,0,6,6")
+        self.assertEqual([flower['color'] for flower in json.loads(data)], ["red", "blue"])
+        self.assertEqual(response.getheader("X-Flowers-Sampled"), "0")
+
+        self.assertEqual(client.status("POST", "/comments", {'gardenId': gid, 'content': "Hello"}), 201)
+        garden = client.json("GET", f"/gardens/{gid}")[1]
+        self.assertEqual([(comment['content'], comment['author_id']) for comment in garden['comments']], [("Hello", uid)])
+        self.assertEqual(len(garden['flowers']), 3)
+        comment = garden['comments'][0]['id']
+        self.assertEqual(other.status("DELETE", f"/comments/{comment}"), 403)
+        self.assertEqual(client.status("DELETE", f"/comments/{comment}"), 204)
+        self.assertEqual(client.status("DELETE", f"/flowers/{created[0]['id']}"), 204)
+        self.assertEqual(len(client.json("GET", f"/gardens/{gid}/flowers")[1]), 2)
+
+    def test_flowers_must_be_finite(self):
+        client, _ = self.user()
+        gid = self.garden(client)
+        for x, y in (("nan", 1), (1, "inf"), ("-Infinity", 1), ("north", 1)):
+            self.assertEqual(client.status("POST", "/flowers", {'gardenId': gid, 'color': "red", 'x': x, 'y': y}), 400)
+        self.assertEqual(client.status("POST", "/flowers", {'gardenId': gid, 'color': "red", 'x': "1.5", 'y': 2}), 201)
+        self.assertEqual([(flower['x'], flower['y']) for flower in client.json("GET", f"/gardens/{gid}/flowers")[1]], [(1.5, 2.0)])
+
+    def test_bulk_flowers_must_be_finite(self):
+        client, _ = self.user()
+        gid = self.garden(client)
+        for value in ("NaN", "Infinity", "-Infinity"):
+            body = b'[{"color": "red", "x": 1, "y": 2}, {"color": "red", "x": %s, "y": 2}]' % value.encode()
+            status, error = client.json("POST", f"/gardens/{gid}/flowers", body, {"Content-Type": "application/json"})
+            self.assertEqual((status, error['message']), (400, "Expected a list of flowers with color, x and y"))
+        self.assertEqual(client.json("GET", f"/gardens/{gid}/flowers")[1], [])
+
+    # RESPONSE CACHE
+
+    def etag(self, client, path, headers=None):
+        response, _ = client.request("GET", path, headers=headers)
+        self.assertEqual(response.status, 200)
+        return response.getheader("ETag")
+
+    def test_garden_etags(self):
+        client, _ = self.user()
+        gid = self.garden(client)
+        path = f"/gardens/{gid}"
+        # Large enough to be compressed
+        created = client.json("POST", f"{path}/flowers", [{'color': "red", 'x': n, 'y': n} for n in range(50)])[1]
+        etag = self.etag(client, path)
+        self.assertTrue(etag)
+        response, body = client.request("GET", path, headers={"If-None-Match": etag})
+        self.assertEqual((response.status, body, response.getheader("ETag")), (304, b"", etag))
+
+        response, _ = client.request("GET", path, headers={"Accept-Encoding": "gzip"})
+        gzip_etag = response.getheader("ETag")
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertNotEqual(gzip_etag, etag)
+        self.assertEqual(client.status("GET", path, headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}), 304)
+        # One variant's ETag doesn't stand for the other
+        self.assertEqual(client.status("GET", path, headers={"If-None-Match": gzip_etag}), 200)
+
+        writes = [
+            ("POST", "/flowers", {'gardenId': gid, 'color': "blue", 'x': 1, 'y': 1}),
+            ("DELETE", f"/flowers/{created[0]['id']}", None),
+            ("POST", "/comments", {'gardenId': gid, 'content': "Hello"}),
+            ("PUT", path, {'name': "Tulips"}),
+        ]
+        for method, write_path, body in writes:
+            self.assertLess(client.status(method, write_path, body), 300)
+            response, _ = client.request("GET", path, headers={"If-None-Match": etag})
+            self.assertEqual(response.status, 200, (method, write_path))
+            self.assertNotEqual(response.getheader("ETag"), etag)
+            etag = response.getheader("ETag")
+        self.assertEqual(client.json("GET", path)[1]['name'], "Tulips")
+
+    # EXPORT
+
+    def test_export_import(self):
+        client, uid = self.user()
+        gid = self.garden(client)
+        client.request("POST", f"/gardens/{gid}/flowers", [{'color': "red", 'x': n, 'y': n} for n in range(100)])
+        client.request("POST", "/comments", {'gardenId': gid, 'content': "Hello"})
+        response, exported = client.request("GET", f"/gardens/{gid}/export")
+        self.assertEqual((response.status, response.getheader("Content-Type")), (200, "application/x-ndjson"))
+        self.assertEqual(len(exported.splitlines()), 102)
+
+        other, other_id = self.user()
+        self.assertEqual(self.client().status("POST", "/gardens/import", exported), 401)
+        status, created = other.json("POST", "/gardens/import", exported, {"Content-Type": "application/x-ndjson"})
+        self.assertEqual((status, created['flowers'], created['comments']), (201, 100, 1))
+        copy = other.json("GET", f"/gardens/{created['id']}")[1]
+        self.assertEqual((copy['author_id'], copy['comments'][0]['author_id']), (other_id, other_id))
+        self.assertEqual(other.status("POST", "/gardens/import", b'{"type": "flower"}\n'), 400)
+
+    def test_import_streams_past_body_limit(self):
+        client, _ = self.user()
+        flowers = b"".join(b'{"type": "flower", "color": "red", "x": %d, "y": 0}\n' % n for n in range(4000))
+        body = b'{"type": "garden", "name": "Big", "author": "Ann"}\n' + flowers
+        self.assertGreater(len(body), MAX_BODY)
+        status, created = client.json("POST", "/gardens/import", body)
+        self.assertEqual((status, created['flowers']), (201, 4000))
+        # Still the same connection
+        self.assertEqual(client.status("GET", "/me"), 200)
+
+    # BATCH
+
+    def test_batch(self):
+        client, uid = self.user()
+        status, results = client.json("POST", "/batch", [
+            {'method': "POST", 'path': "/gardens", 'body': {'name': "Roses", 'author': "Ann"}},
+            {'method': "POST", 'path': "/gardens/{0.id}/flowers", 'body': [{'color': "red", 'x': 1, 'y': 2}]},
+            {'method': "GET", 'path': "/gardens/{0.id}", 'after': [1]},
+        ])
+        self.assertEqual((status, [result['status'] for result in results]), (200, [201, 201, 200]))
+        self.assertEqual(results[2]['body']['author_id'], uid)
+        self.assertEqual(len(results[2]['body']['flowers']), 1)
+
+    # CONNECTIONS
+
+    def test_keep_alive(self):
+        client, _ = self.user()
+        sock = client.connection.sock
+        gid = self.garden(client)
+        client.request("POST", f"/gardens/{gid}/flowers", [{'color': "red", 'x': 1, 'y': 2}])
+        client.request("GET", f"/gardens/{gid}")
+        client.request("OPTIONS", "/gardens")
+        self.assertIs(client.connection.sock, sock)
+
+    def post_head(self, path, length, headers=b""):
+        """ Sends only the head of a POST with a Content-Length of length and returns the response, which must not need the body. """
+        sock = self.raw(b"POST %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+            b"Content-Length: %d\r\n%s\r\n" % (path, length, headers))
+        return self.receive(sock, b"}")
+
+    def test_body_too_large(self):
+        response = self.post_head(b"/gardens", MAX_BODY + 1)
+        self.assertTrue(response.startswith(b"HTTP/1.1 413 "), response)
+        self.assertIn(b"\r\nConnection: close\r\n", response)
+        self.assertIn(str(MAX_BODY).encode(), response)
+        self.assertTrue(self.post_head(b"/gardens/import", MAX_IMPORT + 1).startswith(b"HTTP/1.1 413 "))
+
+    def test_refused_body_isnt_asked_for(self):
+        response = self.post_head(b"/gardens", MAX_BODY + 1, b"Expect: 100-continue\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 413 "), response)
+
+    def test_expect_continue(self):
+        body = urlencode({'first_name': "Ann", 'last_name': "Lee", 'email': f"user{next(self.emails)}@example.com", 'password': "pw"}).encode()
+        sock = self.raw(b"POST /users HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+            + b"Content-Length: %d\r\nExpect: 100-continue\r\n\r\n" % len(body))
+        self.assertTrue(self.receive(sock, b"\r\n\r\n").startswith(b"HTTP/1.1 100 Continue\r\n"))
+        sock.sendall(body)
+        self.assertTrue(self.receive(sock, b"\r\n\r\n").startswith(b"HTTP/1.1 201 "))
+
+
+class ThreadsEngineTest(ServerContract, unittest.TestCase):
+    engine = "threads"
+
+
+class AsyncEngineTest(ServerContract, unittest.TestCase):
+    engine = "async"
+
+
+if __name__ == "__main__":
+    unittest.main()
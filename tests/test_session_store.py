@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from session_store import MemorySessionStore
+
+
+class Clock:
+    """ A clock the test moves by hand. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class MemorySessionStoreTest(unittest.TestCase):
+
+    def store(self, **options):
+        self.clock = Clock()
+        return MemorySessionStore(clock=self.clock, **options)
+
+    def login(self, store):
+        """ Returns a stored session, like a login leaves one. """
+        session = store.new_session()
+        session['uid'] = 1
+        return session
+
+    def test_stored_on_first_write(self):
+        store = self.store()
+        session = store.new_session()
+        self.assertIsNone(store.get_session(session.id))
+        self.assertEqual(len(store), 0)
+        session['uid'] = 7
+        self.assertTrue(session.stored)
+        self.assertEqual(store.get_session(session.id), {'uid': 7})
+        store.delete_session(session.id)
+        self.assertFalse(session.stored)
+        self.assertIsNone(store.get_session(session.id))
+
+    def test_idle_expiry_slides(self):
+        store = self.store(idle_ttl=10, max_age=100)
+        session = self.login(store)
+        for _ in range(5):
+            self.clock.advance(9)
+            self.assertIs(store.get_session(session.id), session)
+        self.clock.advance(11)
+        self.assertIsNone(store.get_session(session.id))
+        self.assertEqual((len(store), store.stats()['expired']), (0, 1))
+
+    def test_max_age_ends_used_sessions(self):
+        store = self.store(idle_ttl=10, max_age=30)
+        session = self.login(store)
+        for _ in range(3):
+            self.clock.advance(9)
+            self.assertIs(store.get_session(session.id), session)
+        self.clock.advance(9)
+        self.assertIsNone(store.get_session(session.id))
+
+    def test_evicts_least_recently_used(self):
+        store = self.store(max_sessions=3, shards=1)
+        first, second, third = [self.login(store) for _ in range(3)]
+        # Reading the first makes the second the least recently used
+        store.get_session(first.id)
+        fourth = self.login(store)
+        self.assertIsNone(store.get_session(second.id))
+        for session in (first, third, fourth):
+            self.assertIs(store.get_session(session.id), session)
+        # Writing counts as use too
+        first['uid'] = 2
+        self.login(store)
+        self.assertIsNone(store.get_session(third.id))
+        self.assertIs(store.get_session(first.id), first)
+        self.assertEqual(store.stats()['evicted'], 2)
+
+    def test_max_sessions_across_shards(self):
+        store = self.store(max_sessions=64, shards=16)
+        sessions = [self.login(store) for _ in range(1000)]
+        self.assertLessEqual(len(store), 64)
+        self.assertEqual(store.stats()['evicted'], 1000 - len(store))
+        # The newest session of each shard is always kept
+        self.assertIs(store.get_session(sessions[-1].id), sessions[-1])
+
+    def test_saves_sweep_expired_sessions(self):
+        store = self.store(idle_ttl=10, shards=1)
+        for _ in range(20):
+            self.login(store)
+        self.clock.advance(11)
+        # Each new session drops up to 8 expired ones from the least recently used end
+        self.login(store)
+        self.assertEqual((len(store), store.stats()['expired']), (13, 8))
+        self.login(store)
+        self.login(store)
+        self.assertEqual((len(store), store.stats()['expired']), (3, 20))
+
+    def test_sweep(self):
+        store = self.store(idle_ttl=10)
+        old = [self.login(store) for _ in range(50)]
+        self.clock.advance(5)
+        kept = self.login(store)
+        # The first session was used since, so only the other 49 expire
+        store.get_session(old[0].id)
+        self.clock.advance(6)
+        store.sweep()
+        self.assertEqual((len(store), store.stats()['expired']), (2, 49))
+        self.assertIs(store.get_session(kept.id), kept)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+REGISTRY.describe("http_queue_wait_seconds", "histogram", "Time accepted connections waited for a free worker thread")
+REGISTRY.describe("http_connections_rejected_total", "counter", "Connections answered with 503 before reaching a worker, by reason")
+
+
+def busy_response(retry_after):
+    """ The whole 503 response sent to connections turned away before reaching a handler. """
+    body = bytes(json.dumps({'message': "Server busy, try again later"}), "utf-8")
+    head = f"HTTP/1.1 503 Service Unavailable\r\nRetry-After: {retry_after}\r\nContent-Type: application/json\r\n" \
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    return bytes(head, "latin-1") + body
+
+
+class WorkerPoolMixIn:
+    """ Serves connections on a fixed number of threads, use in place of ThreadingMixIn.
+    Accepted connections wait in a queue of at most queue_size. When it is full, or the client's address already has
+    per_ip_limit connections queued or being served, the connection gets a 503 with Retry-After straight away. """
+
+    # Larger listen backlog, connections are taken off it quickly and shed by the queue instead
+    request_queue_size = 128
+
+    def __init__(self, *args, workers=16, queue_size=64, per_ip_limit=0, retry_after=1, idle_timeout=2.0, **kwargs):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_ip_limit = per_ip_limit
+        self.retry_after = retry_after
+        # Idle keep-alive connections hold a worker, so they are closed sooner than with a thread per connection
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        # client address -> connections queued or being served
+        self.per_ip = {}
+        self.threads = []
+        self.busy = 0
+        self.served = 0
+        self.rejected = 0
+        super().__init__(*args, **kwargs)
+
+    def start_workers(self):
+        """ Started when serving, not in __init__, so a pre-forked worker process starts its own threads. """
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"http-worker-{i}")
+            thread.start()
+            self.threads.append(thread)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        """ Runs on the accepting thread. Queues the connection or rejects it without blocking. """
+        ip = client_address[0]
+        with self.lock:
+            if self.per_ip_limit and self.per_ip.get(ip, 0) >= self.per_ip_limit:
+                reason = "per_ip"
+            else:
+                try:
+                    self.queue.put_nowait((request, client_address, time.monotonic()))
+                    self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+                    return
+                except queue.Full:
+                    reason = "queue_full"
+            self.rejected += 1
+        REGISTRY.inc("http_connections_rejected_total", (("reason", reason),))
+        self.reject(request)
+
+    def reject(self, request):
+        """ Sends a 503 without waiting on the client. A fresh connection's send buffer is empty, so the short response fits. """
+        try:
+            request.setblocking(False)
+            request.send(busy_response(self.retry_after))
+            # Read whatever the client already sent, closing with unread data resets the connection and can lose the 503
+            request.recv(65536)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                return
+            request, client_address, queued_at = item
+            REGISTRY.observe("http_queue_wait_seconds", (), time.monotonic() - queued_at)
+            with self.lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.lock:
+                    self.busy -= 1
+                    self.served += 1
+                    ip = client_address[0]
+                    self.per_ip[ip] -= 1
+                    if self.per_ip[ip] <= 0:
+                        del self.per_ip[ip]
+
+    def backlogged(self):
+        """ True when connections are waiting for a worker. Handlers then close keep-alive connections after the current response. """
+        return not self.queue.empty()
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'queue_size': self.queue_size,
+                'clients': len(self.per_ip),
+                'served': self.served,
+                'rejected': self.rejected,
+            }